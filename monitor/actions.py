@@ -13,10 +13,16 @@ from twisted.internet import threads
 
 import monitor.status
 import monitor.util.action
+import monitor.util.metrics
 import monitor.util.sendemail
 import monitor.util.ping
 import monitor.util.wake_on_lan
 
+_ACTION_SECONDS = monitor.util.metrics.histogram(
+    'action_seconds',
+    'Time to perform actions, by type. Actions that return a deferred are '
+    'timed until it fires.', ['type'])
+
 
 class Error(Exception):
   pass
@@ -74,7 +80,9 @@ class ActionManager(object):
 
       # If it's any other type of url, fetch it.
       if parsed_url:
-        return monitor.util.action.get_page_wrapper(action)
+        return _ACTION_SECONDS.time(('url',),
+                                    monitor.util.action.get_page_wrapper,
+                                    action)
 
       # If it's a dictionary, act based on the 'action' key's contents.
       action_type = None
@@ -91,7 +99,8 @@ class ActionManager(object):
         if action_type not in self.action_mapping:
           raise UnknownAction('action: %s is unknown.' % action_type)
 
-        return self.action_mapping[action_type](action)
+        return _ACTION_SECONDS.time((action_type,),
+                                    self.action_mapping[action_type], action)
 
       # We now assume it's a list, and recurse on each element.
       for a in action:
@@ -150,29 +159,38 @@ class ActionManager(object):
   def _handle_ping_action(self, action):
     host_uris = self.status.get_matching_urls(action['host'])
 
+    # The ping threads can't safely use self.status, so give them a snapshot.
+    snapshot = self.status.snapshot()
+
     # This method runs instead the thread.
     def handle_ping(ping_method, host_uri):
       """Method to run inside the ping thread."""
       hostname = os.path.basename(host_uri)
-      host_revision = self.status.revision(host_uri)
+      host_revision = snapshot.revision(host_uri)
 
       logging.debug('Action: Pinging %s', hostname)
       result = ping_method(hostname)
 
       return host_uri, host_revision, result
 
-    def handle_result(value):
-      """Method to run in main thread with ping thread results."""
-      host_uri, host_revision, result = value
-
-      flag_uri = os.path.join(host_uri, 'up')
-      try:
-        self.status.set(flag_uri, result, revision=host_revision)
-      except monitor.status.RevisionMismatch:
-        # If the revision doesn't match, throw away ping result.
-        pass
-
-      return result
+    def handle_results(results):
+      """Method to run in main thread with all ping thread results."""
+      # Record all of the results as a single status update.
+      with self.status.transaction():
+        for success, value in results:
+          if not success:
+            continue
+
+          host_uri, host_revision, result = value
+          flag_uri = os.path.join(host_uri, 'up')
+          try:
+            self.status.set(flag_uri, result, revision=host_revision)
+          except monitor.status.RevisionMismatch:
+            # If the revision doesn't match, throw away ping result.
+            pass
+
+      return [(success, value[2] if success else value)
+              for success, value in results]
 
     thread_deferreds = []
     for component_uri in host_uris:
@@ -184,11 +202,13 @@ class ActionManager(object):
       # for testing.
       d = threads.deferToThread(handle_ping,
                                 monitor.util.ping.ping, component_uri)
-      d.addCallback(handle_result)
       thread_deferreds.append(d)
 
-    # Return a deferred that shows all requested pings have completed.
-    return defer.DeferredList(thread_deferreds)
+    # Return a deferred that shows all requested pings have completed, and
+    # their results are recorded.
+    d = defer.DeferredList(thread_deferreds)
+    d.addCallback(handle_results)
+    return d
 
   # pylint: disable=R0914
   def _handle_email_action(self, action):
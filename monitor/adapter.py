@@ -7,8 +7,15 @@ import os
 from twisted.internet import inotify
 from twisted.python import filepath
 
+import monitor.util.metrics
+
 BASE_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
 
+# Used by adapters which poll their devices, labelled with the adapter name.
+POLL_SECONDS = monitor.util.metrics.histogram(
+    'adapter_poll_seconds', 'Time taken by each poll of an adapter.',
+    ['adapter'])
+
 
 # A lot of variables get defined inside setup, called from init.
 # pylint: disable=W0201
@@ -46,7 +53,8 @@ class FileAdapter(Adapter):
   def update_config_file(self):
     logging.info('Adapting %s -> %s', self.filename, self.url)
     try:
-      self.status.set(self.url, self.parse_config_file(self.filename))
+      self.status.set(self.url, self.parse_config_file(self.filename),
+                      merge=True)
     except ValueError:
       logging.info('ERROR Parsing %s', self.filename)
 
@@ -78,7 +86,10 @@ class WebAdapter(Adapter):
 
   def setup(self):
     self._web_adapters.append(self)
-    self.status.set(self.url, {})
+
+    # Keep any contents restored from before a restart.
+    if self.status.get(self.url) is None:
+      self.status.set(self.url, {})
 
   @classmethod
   def web_updatable(cls, url):
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+
+"""Micro benchmarks for the hot paths of the server.
+
+Run from the top of the project:
+
+  python -m monitor.benchmark [name ...]
+
+With no names, every benchmark is run.
+"""
+
+import copy
+import json
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+from twisted.internet import task
+from twisted.web.test.requesthelper import DummyRequest
+
+import monitor.persistence
+import monitor.status
+import monitor.util.metrics
+import monitor.web_resources
+
+
+def _timeit(func, iterations):
+  """Return the average number of seconds a call to func takes."""
+  start = time.time()
+  for _ in xrange(iterations):
+    func()
+  return (time.time() - start) / iterations
+
+
+def _report(name, seconds):
+  print '%-40s %10.1f us' % (name, seconds * 1000000)
+
+
+def _report_bytes(name, size):
+  print '%-40s %10.1f B' % (name, size)
+
+
+def synthetic_tree(adapters=10, hosts=100, values=10):
+  """Build a status value shaped like adapters full of SNMP hosts.
+
+  The default shape contains adapters * hosts * values (10k) leaves.
+  """
+  return {
+      'adapter%d' % a: {
+          'host': {
+              'host%d' % h: {
+                  'value%d' % v: 'value %d' % v for v in xrange(values)
+              } for h in xrange(hosts)
+          }
+      } for a in xrange(adapters)
+  }
+
+
+def benchmark_status():
+  """Read and write a 10k leaf tree."""
+  status = monitor.status.Status(synthetic_tree())
+  counter = [0]
+
+  def set_leaf():
+    counter[0] += 1
+    status.set('status://adapter3/host/host7/value2', counter[0])
+
+  _report('Status.get() whole tree', _timeit(status.get, 20))
+  _report('Status.get() adapter subtree',
+          _timeit(lambda: status.get('status://adapter3'), 200))
+  _report('Status.get() leaf',
+          _timeit(lambda: status.get('status://adapter3/host/host7/value2'),
+                  10000))
+  _report('Status.set() leaf', _timeit(set_leaf, 1000))
+  _report('Status.get_matching_urls() */host/<name>',
+          _timeit(lambda: status.get_matching_urls('status://*/host/host7'),
+                  1000))
+  _report('Status.get_matching_urls() */host/*',
+          _timeit(lambda: status.get_matching_urls('status://*/host/*'), 20))
+  _report('Status.get_matching_urls() */*/*/value2',
+          _timeit(lambda: status.get_matching_urls('status://*/*/*/value2'),
+                  20))
+  _report('Status.set() leaf + get() whole tree',
+          _timeit(lambda: (set_leaf(), status.get()), 20))
+  _report('json.dumps() whole tree',
+          _timeit(lambda: json.dumps(status.get(), sort_keys=True, indent=4),
+                  20))
+  _report('Status.set() leaf + get_json() whole tree',
+          _timeit(lambda: (set_leaf(), status.get_json()), 20))
+
+  # Rewriting a subtree with an identical value, like a poller would.
+  unchanged = copy.deepcopy(status.get('status://adapter4'))
+  _report('Status.set() unchanged adapter subtree',
+          _timeit(lambda: status.set('status://adapter4', unchanged), 20))
+
+
+def benchmark_expiry():
+  """Set 10k leaves with a ttl, then let them all expire."""
+  clock = task.Clock()
+  status = monitor.status.Status(synthetic_tree(), clock=clock)
+  urls = ['status://adapter%d/host/host%d/value%d' % (a, h, v)
+          for a in xrange(10) for h in xrange(100) for v in xrange(10)]
+
+  start = time.time()
+  for i, url in enumerate(urls):
+    status.set(url, i, ttl=60 + i % 600)
+  _report('Status.set() leaf with ttl', (time.time() - start) / len(urls))
+  print '%-40s %10d' % ('Reactor delayed calls', len(clock.getDelayedCalls()))
+
+  start = time.time()
+  wakeups = 0
+  while clock.getDelayedCalls():
+    wakeups += 1
+    clock.advance(clock.getDelayedCalls()[0].getTime() - clock.seconds())
+  _report('Expire leaf', (time.time() - start) / len(urls))
+  print '%-40s %10d' % ('Reactor wakeups', wakeups)
+
+
+def _size_of(obj, seen):
+  """Bytes used by obj and everything it references, counted once each."""
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    size += sum(_size_of(k, seen) + _size_of(v, seen)
+                for k, v in obj.iteritems())
+  elif isinstance(obj, (list, tuple)):
+    size += sum(_size_of(v, seen) for v in obj)
+  if hasattr(obj, '__dict__'):
+    size += _size_of(obj.__dict__, seen)
+  for name in getattr(type(obj), '__slots__', ()):
+    if hasattr(obj, name):
+      size += _size_of(getattr(obj, name), seen)
+  return size
+
+
+def benchmark_memory():
+  """Memory used by status trees loaded from JSON, per leaf."""
+  for hosts, values in ((100, 10), (1000, 10), (100, 100)):
+    tree = json.loads(json.dumps(synthetic_tree(hosts=hosts, values=values)))
+    leaves = 10 * hosts * values
+    status = monitor.status.Status(tree)
+    del tree
+
+    shape = '10x%dx%d' % (hosts, values)
+
+    # pylint: disable=protected-access
+    _report_bytes('Bytes per leaf, %s tree' % shape,
+                  _size_of(status._node, set()) / float(leaves))
+
+    # Values handed out by get() are cached alongside the nodes.
+    status.get()
+    _report_bytes('Bytes per leaf, %s tree after get()' % shape,
+                  _size_of(status._node, set()) / float(leaves))
+
+
+def benchmark_metrics():
+  """Cost of timing Status.get() and set() for /metrics."""
+  status = monitor.status.Status(synthetic_tree())
+  url = 'status://adapter3/host/host7/value2'
+  counter = [0]
+
+  # Snapshots read the same way, and make the same sampling check, but are
+  # never timed. Set is called without the timing wrapper.
+  snapshot = status.snapshot()
+  untimed_set = monitor.status.Status.set.untimed
+
+  def timed_set():
+    counter[0] += 1
+    status.set(url, counter[0])
+
+  def untimed():
+    counter[0] += 1
+    untimed_set(status, url, counter[0])
+
+  # Interleave the runs, so both see the same machine load.
+  results = {'get': [], 'untimed get': [], 'set': [], 'untimed set': []}
+  for _ in xrange(100):
+    results['get'].append(_timeit(lambda: status.get(url), 1600))
+    results['untimed get'].append(_timeit(lambda: snapshot.get(url), 1600))
+    results['set'].append(_timeit(timed_set, 200))
+    results['untimed set'].append(_timeit(untimed, 200))
+
+  best = {name: min(times) for name, times in results.iteritems()}
+  for name in ('get', 'set'):
+    _report('Status.%s() leaf' % name, best[name])
+    _report('Status.%s() leaf, untimed' % name, best['untimed ' + name])
+    print '%-40s %10.1f %%' % (
+        'Status.%s() overhead' % name,
+        100 * (best[name] / best['untimed ' + name] - 1))
+
+  histogram = monitor.util.metrics.Histogram('benchmark', '', ['adapter'])
+  _report('Histogram.observe()',
+          _timeit(lambda: histogram.observe(('adapter3',), 0.001), 100000))
+
+
+def benchmark_notify():
+  """Update one leaf with 1000 unrelated watchers pending."""
+  status = monitor.status.Status(synthetic_tree())
+  for a in xrange(10):
+    for h in xrange(100):
+      status.deferred(url='status://adapter%d/host/host%d/value0' % (a, h))
+  counter = [0]
+
+  def set_leaf():
+    counter[0] += 1
+    status.set('status://adapter3/host/host7/value2', counter[0])
+
+  _report('Status.set() leaf, 1000 watchers', _timeit(set_leaf, 100))
+
+
+def benchmark_persistence():
+  """Restore a 10k leaf snapshot, plus a log of 1000 leaf updates."""
+  directory = tempfile.mkdtemp()
+  try:
+    status = monitor.status.Status(synthetic_tree())
+    saver = monitor.persistence.Persistence(status, directory,
+                                            max_log_bytes=1024 * 1024 * 1024)
+    saver.start()
+    _report('Persistence.snapshot()', _timeit(saver.snapshot, 5))
+    for i in xrange(1000):
+      status.set('status://adapter%d/host/host%d/value2' % (i % 10, i % 100), i)
+    saver.stop()
+
+    def restore():
+      restored = monitor.status.Status()
+      monitor.persistence.Persistence(restored, directory).restore()
+
+    _report('Persistence.restore()', _timeit(restore, 5))
+  finally:
+    shutil.rmtree(directory)
+
+
+def benchmark_longpoll():
+  """Answer 500 long polls waiting on the same url of a 10k leaf tree."""
+  status = monitor.status.Status(synthetic_tree())
+  resource = monitor.web_resources.Status(status)
+  url = 'http://example/status'
+
+  park = []
+  answer = []
+  for i in xrange(20):
+    revision = status.revision('status://adapter0')
+    requests = []
+    for _ in xrange(500):
+      request = DummyRequest(['adapter0'])
+      request.addArg('revision', str(revision))
+      request.prePathURL = lambda: url
+      requests.append(request)
+
+    start = time.time()
+    for request in requests:
+      resource.render(request)
+    park.append(time.time() - start)
+
+    start = time.time()
+    status.set('status://adapter0/host/host0/value0', i)
+    answer.append(time.time() - start)
+    assert all(request.finished for request in requests)
+
+  _report('park 500 requests', sum(park) / len(park))
+  _report('set() answering 500 requests', sum(answer) / len(answer))
+
+
+def benchmark_wire():
+  """Size and encoding time of a 10k leaf tree, for each response format."""
+  status = monitor.status.Status(synthetic_tree())
+  value = status.get()
+
+  encodings = [
+      ('pretty', lambda: json.dumps(value, sort_keys=True, indent=4)),
+      ('compact', lambda: json.dumps(value, sort_keys=True,
+                                     separators=(',', ':'))),
+  ]
+  msgpack = monitor.web_resources.msgpack
+  if msgpack is not None:
+    encodings.append(('msgpack', lambda: msgpack.packb(value,
+                                                       use_bin_type=True)))
+
+  for name, encode in encodings:
+    body = encode()
+    _report_bytes('%s size' % name, len(body))
+    _report('%s encode' % name, _timeit(encode, 5))
+    for level in (6, 9):
+      _report_bytes('%s gzip %d size' % (name, level),
+                    len(zlib.compress(body, level)))
+      _report('%s gzip %d time' % (name, level),
+              _timeit(lambda: zlib.compress(body, level), 5))
+
+  # Responses for an unchanged tree come from the node caches.
+  status.get_json()
+  status.get_json(compact=True)
+  _report('pretty cached', _timeit(status.get_json, 100))
+  _report('compact cached',
+          _timeit(lambda: status.get_json(compact=True), 100))
+
+
+BENCHMARKS = {
+    'expiry': benchmark_expiry,
+    'longpoll': benchmark_longpoll,
+    'memory': benchmark_memory,
+    'metrics': benchmark_metrics,
+    'notify': benchmark_notify,
+    'persistence': benchmark_persistence,
+    'status': benchmark_status,
+    'wire': benchmark_wire,
+}
+
+
+def main(names):
+  for name in names or sorted(BENCHMARKS):
+    print '%s: %s' % (name, BENCHMARKS[name].__doc__)
+    BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
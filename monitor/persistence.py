@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+
+from twisted.internet import task
+
+SNAPSHOT_NAME = 'status.json'
+LOG_NAME = 'status.log'
+
+
+def _inside(url, parent):
+  """Is url the same as parent, or inside it?"""
+  if not parent.endswith('/'):
+    parent += '/'
+  return url == parent[:-1] or url.startswith(parent)
+
+
+class Persistence(object):
+  """Save status changes to disk, so they survive a restart.
+
+  State is kept in two files inside directory. The snapshot holds the entire
+  status at some revision. The log has one JSON line per change made after
+  that revision (as passed to Status listeners).
+
+  Disk use is bounded. Whenever the log grows past max_log_bytes, or every
+  snapshot_seconds if the log isn't empty, a new snapshot is written and the
+  log emptied. So at most there is one snapshot, one log of max_log_bytes
+  (plus the last change), and a temporary snapshot while a new one is
+  written.
+
+  If a change can't be logged, or never reaches us (the revision skips
+  ahead), nothing more is logged until a new snapshot (which includes it) is
+  written, since the log couldn't be replayed past the missing change.
+
+  Values set with a ttl are saved with the time they expire, and still
+  expire at that time after a restart (or right away, if it has passed).
+  """
+
+  def __init__(self, status, directory,
+               max_log_bytes=1024 * 1024, snapshot_seconds=600):
+    self.status = status
+    self.directory = directory
+    self.max_log_bytes = max_log_bytes
+    self.snapshot_seconds = snapshot_seconds
+
+    self._snapshot_file = os.path.join(directory, SNAPSHOT_NAME)
+    self._log_file = os.path.join(directory, LOG_NAME)
+    self._log = None
+    self._snapshot_loop = None
+    self._lost_change = False
+    # The revision of the last change logged, or of the snapshot.
+    self._revision = None
+
+  def restore(self):
+    """Load saved state into status. Should be done before anything else.
+
+    Returns:
+      The number of logged changes replayed on top of the snapshot.
+    """
+    revision = 0
+    expiries = {}
+    if os.path.exists(self._snapshot_file):
+      with open(self._snapshot_file, 'r') as f:
+        snapshot = json.load(f)
+      revision = snapshot['revision']
+      expiries = snapshot.get('expiries', {})
+      self.status.restore(snapshot['status'], revision)
+      logging.info('Restored status snapshot at revision %d', revision)
+
+    replayed = 0
+    if os.path.exists(self._log_file):
+      replayed = self._replay_log(revision, expiries)
+
+    # Expirations start once everything is restored, so they see the final
+    # revision of each value.
+    self.status.restore_expiries(expiries)
+    return replayed
+
+  def _replay_log(self, revision, expiries):
+    """Replay the log on top of the snapshot at revision.
+
+    expiries is updated with those logged alongside the replayed changes.
+    """
+    replayed = 0
+    with open(self._log_file, 'r') as f:
+      for changes in self._read_log(f, revision):
+        # Each logged revision was a single transaction on top of the one
+        # before. If one is missing, the rest can't be applied, but what we
+        # have is still the best status available.
+        if changes[0]['revision'] != self.status.revision() + 1:
+          logging.warning('Status log skips from revision %d to %d, ignoring '
+                          'the rest of it', self.status.revision(),
+                          changes[0]['revision'])
+          break
+
+        self._replay(changes, expiries)
+        replayed += len(changes)
+
+    logging.info('Replayed %d logged status changes', replayed)
+    return replayed
+
+  def _read_log(self, f, revision):
+    """Yield the logged changes after revision, grouped by revision."""
+    changes = []
+    for line in f:
+      try:
+        change = json.loads(line)
+      except ValueError:
+        # A crash can leave a partial last line.
+        logging.warning('Ignoring corrupt status log line: %r', line)
+        break
+
+      # If we crashed while replacing the snapshot, the log can contain
+      # changes that are already in it.
+      if change['revision'] <= revision:
+        continue
+
+      if changes and changes[0]['revision'] != change['revision']:
+        yield changes
+        changes = []
+      changes.append(change)
+
+    if changes:
+      yield changes
+
+  def _replay(self, changes, expiries):
+    """Apply the changes from one logged revision, as a single transaction."""
+    with self.status.transaction():
+      for change in changes:
+        self.status.set(change['url'], change['value'], merge=True)
+
+    # Each change is logged with every expiration inside it, replacing any
+    # from before.
+    for change in changes:
+      for url in expiries.keys():
+        if _inside(url, change['url']):
+          del expiries[url]
+      expiries.update(change.get('expires', {}))
+
+  def start(self):
+    """Start saving every status change."""
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+
+    # Start from a fresh snapshot, which also opens the log.
+    self.snapshot()
+    self.status.add_listener(self._log_change)
+
+    self._snapshot_loop = task.LoopingCall(self._periodic_snapshot)
+    self._snapshot_loop.start(self.snapshot_seconds, now=False)
+
+  def stop(self):
+    """Stop saving status changes, and close the log."""
+    if self._snapshot_loop:
+      self._snapshot_loop.stop()
+      self._snapshot_loop = None
+    self.status.remove_listener(self._log_change)
+    self._log.close()
+    self._log = None
+
+  def snapshot(self):
+    """Write the current status as the new snapshot, and empty the log."""
+    temp_file = self._snapshot_file + '.tmp'
+    with open(temp_file, 'w') as f:
+      json.dump({'revision': self.status.revision(),
+                 'status': self.status.get(),
+                 'expiries': self.status.expiries()}, f)
+      f.flush()
+      os.fsync(f.fileno())
+
+    # Replacing the old snapshot is atomic. If we crash before the log is
+    # emptied, restore() skips the logged changes already in the snapshot.
+    os.rename(temp_file, self._snapshot_file)
+
+    if self._log:
+      self._log.close()
+    self._log = open(self._log_file, 'w')
+    self._lost_change = False
+    self._revision = self.status.revision()
+
+  def _periodic_snapshot(self):
+    if self._log.tell() or self._lost_change:
+      try:
+        self.snapshot()
+      except Exception:  # pylint: disable=broad-except
+        # Raising would stop the LoopingCall. Try again next time.
+        logging.exception('Failed to write status snapshot')
+
+  def _log_change(self, revision, url, value):
+    if self._lost_change:
+      return
+
+    # Changes in a transaction share a revision. Anything else means a change
+    # was made without being committed to us.
+    if revision not in (self._revision, self._revision + 1):
+      logging.warning('Status skipped from revision %d to %d, not logging '
+                      'until the next snapshot', self._revision, revision)
+      self._lost_change = True
+      return
+
+    entry = {'revision': revision, 'url': url, 'value': value}
+    expires = self.status.expiries(url)
+    if expires:
+      entry['expires'] = expires
+
+    try:
+      self._log.write(json.dumps(entry) + '\n')
+      self._log.flush()
+    except Exception:
+      self._lost_change = True
+      raise
+    self._revision = revision
+
+    if self._log.tell() > self.max_log_bytes:
+      self.snapshot()
@@ -4,12 +4,16 @@ import datetime
 import logging
 import os
 
+import monitor.util.metrics
 from monitor.util import repeat
 
 from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.internet import task
 
+_FIRINGS = monitor.util.metrics.counter(
+    'rule_firings_total', 'Times each rule has fired, by rule url.', ['rule'])
+
 class UnknownRuleBehavior(Exception):
   """Raised when a rule with an unknown 'behavior' is found."""
 
@@ -111,6 +115,7 @@ class _RuleHelper(object):
 
   def fire(self, value):
     logging.info('Firing rule: %s', self._url)
+    _FIRINGS.inc((self._url,))
     # pylint: disable=W0212
     self._engine._action_manager.handle_action(
         os.path.join(self._url, 'action'))
@@ -170,22 +175,17 @@ class _IntervalHelper(_RuleHelper):
 class _WatchHelper(_RuleHelper):
 
   def next_deferred(self):
-    return self._status.deferred(url=self._rule['value'])
-
-  def fire(self, value):
-    possible_trigger_value = self._status.get(self._rule['value'])
-
-    # If a trigger exists in the rule, it must match to fire the rule.
-    if 'trigger' in self._rule:
-      fire_action = possible_trigger_value == self._rule['trigger']
-    else:
-      fire_action = True
+    # Status only calls us back when the rule should fire.
+    return self._status.deferred(url=self._rule['value'],
+                                 predicate=self._should_fire)
 
+  def _should_fire(self, possible_trigger_value):
     # If the value doesn't exist, don't fire a rule watching it.
     if possible_trigger_value is None:
-      fire_action = False
+      return False
 
-    if fire_action:
-      super(_WatchHelper, self).fire(value)
+    # If a trigger exists in the rule, it must match to fire the rule.
+    if 'trigger' in self._rule:
+      return possible_trigger_value == self._rule['trigger']
 
-    return value
+    return True
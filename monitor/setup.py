@@ -4,7 +4,6 @@ import json
 import logging
 import os
 import sys
-import StringIO
 
 from twisted.python import log
 from twisted.internet import reactor
@@ -14,10 +13,14 @@ from twisted.web.server import Site
 import monitor.actions
 import monitor.adapter
 import monitor.iogear_adapter
+import monitor.persistence
 import monitor.snmp_adapter
 import monitor.sonos_adapter
 import monitor.rules_engine
 import monitor.status
+import monitor.util.log_buffer
+import monitor.util.metrics
+import monitor.util.watchdog
 import monitor.web_resources
 
 BASE_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
@@ -33,23 +36,49 @@ def setupLogging():
   stdout_handler.setLevel(logging.DEBUG)
   stdout_handler.setFormatter(formatter)
 
-  # Setup buffer logging (for web display)
-  log_buffer = StringIO.StringIO()
-  buffer_handler = logging.StreamHandler(log_buffer)
-  buffer_handler.setLevel(logging.WARNING)
-  buffer_handler.setFormatter(formatter)
+  # Keep recent warnings in memory, for web display.
+  log_buffer = monitor.util.log_buffer.LogBuffer(level=logging.WARNING)
 
   # Setup the root logger to use both handlers.
   logger = logging.getLogger()
   logger.setLevel(logging.DEBUG)
   logger.addHandler(stdout_handler)
-  logger.addHandler(buffer_handler)
+  logger.addHandler(log_buffer)
 
   # Direct twisted logs into the standard Python logging.
   observer = log.PythonLoggingObserver()
   observer.start()
 
-  return buffer_handler, log_buffer
+  return log_buffer
+
+
+def setupMetrics(status):
+  """Add gauges for state that's only known at run time."""
+  monitor.util.metrics.gauge(
+      'status_pending_deferreds', 'Status.deferred() watchers waiting.',
+      status.pending_deferreds)
+
+  thread_pool = reactor.getThreadPool()
+  monitor.util.metrics.gauge(
+      'thread_pool_queued', 'Calls waiting for a free pool thread.',
+      thread_pool.q.qsize)
+  monitor.util.metrics.gauge(
+      'thread_pool_busy', 'Pool threads running a call.',
+      lambda: len(thread_pool.working))
+
+
+def readProfileToken(config):
+  """Return the token needed for /profile, or None to disable it.
+
+  The token is kept in its own file, since the config is readable by
+  anyone through /status/server.
+  """
+  token_file = config.get('profile_token_file')
+  if not token_file:
+    return None
+
+  with open(os.path.join(BASE_DIR, token_file), 'r') as f:
+    return f.read().strip() or None
 
 
 def setupAdapters(status):
@@ -75,14 +104,41 @@ def setupAdapters(status):
     adapter_class(status, adapter_url, name, settings)
 
 def setup():
-  log_handler, log_buffer = setupLogging()
+  log_buffer = setupLogging()
 
   status = monitor.status.Status()
 
-  # Create our global shared status. Sort of a hard coded file adapter.
   config_file = os.path.join(BASE_DIR, 'server.json')
   with open(config_file, 'r') as f:
-    status.set('status://server', json.load(f))
+    config = json.load(f)
+
+  # Restore the status saved before we last stopped.
+  persistence = monitor.persistence.Persistence(
+      status,
+      config.get('state_directory', os.path.join(BASE_DIR, 'state')),
+      config.get('state_max_log_bytes', 1024 * 1024))
+  persistence.restore()
+
+  # Drop saved state for adapters that are no longer configured, and
+  # create our global shared status. Sort of a hard coded file adapter.
+  saved = status.get()
+  restored = {name: saved[name] for name in saved
+              if name in config.get('adapters', {})}
+  restored['server'] = config
+  status.set('status://', restored, merge=True)
+
+  # Save every change from here on.
+  persistence.start()
+  reactor.addSystemEventTrigger('before', 'shutdown', persistence.stop)
+
+  setupMetrics(status)
+
+  # Watch for anything blocking the reactor. Started with the reactor, so the
+  # ticks are taken from the reactor thread.
+  watchdog = monitor.util.watchdog.ReactorWatchdog(
+      threshold=config.get('watchdog_threshold', 0.25))
+  reactor.callWhenRunning(watchdog.start)
+  reactor.addSystemEventTrigger('before', 'shutdown', watchdog.stop)
 
   # Setup the normal adapters.
   setupAdapters(status)
@@ -97,9 +153,18 @@ def setup():
   # Serve the standard static web content, overlaid with our dynamic content
   root = File("./static")
   root.putChild("button", monitor.web_resources.Button(status))
-  root.putChild("log", monitor.web_resources.Log(log_handler, log_buffer))
+  root.putChild("events", monitor.web_resources.Events(status))
+  root.putChild("log", monitor.web_resources.compressed(
+      monitor.web_resources.Log(log_buffer)))
+  root.putChild("metrics", monitor.web_resources.compressed(
+      monitor.web_resources.Metrics(monitor.util.metrics.REGISTRY)))
+  root.putChild("profile", monitor.web_resources.compressed(
+      monitor.web_resources.Profile(readProfileToken(config))))
   root.putChild("restart", monitor.web_resources.Restart(status))
-  root.putChild("status", monitor.web_resources.Status(status))
+  root.putChild("socket", monitor.web_resources.Socket(status))
+  root.putChild("status", monitor.web_resources.compressed(
+      monitor.web_resources.Status(status)))
+  root.putChild("watchdog", monitor.web_resources.Watchdog(watchdog))
 
   reactor.listenTCP(status.get('status://server/port', 8080),
                     Site(root))
@@ -6,6 +6,7 @@ import os
 
 from pysnmp.entity.rfc3413.oneliner import cmdgen
 
+from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.internet import threads
 
@@ -31,21 +32,28 @@ class SnmpAdapter(monitor.adapter.Adapter, protocol.Protocol):
 
     # Start refreshing SNMP information every 10 seconds.
     timing_helper = repeat.interval_helper(datetime.timedelta(seconds=15))
-    repeat.call_repeating(timing_helper, self.update_hosts)
+    repeat.call_repeating(timing_helper, monitor.adapter.POLL_SECONDS.time,
+                          (self.name,), self.update_hosts)
 
   def update_hosts(self):
-    for host in self._hosts:
-      self.find_host_values(host)
+    # Record the values for all hosts as a single status update.
+    d = defer.gatherResults([self.find_host_values(host)
+                             for host in self._hosts])
+    d.addCallback(lambda results: self.status.set_many(dict(results),
+                                                       merge=True))
+    return d
 
   def find_host_values(self, host):
+    """Returns a deferred which fires with (host_url, host_values)."""
     host_url = os.path.join(self.url, host)
 
     def handle_error(e):
       logging.error(e.getTraceback())
-      self.status.set(host_url, {'error': e.getErrorMessage()})
+      return host_url, {'error': e.getErrorMessage()}
 
     d = threads.deferToThread(self.read_host_values, host)
-    d.addCallbacks(lambda v: self.status.set(host_url, v), handle_error)
+    d.addCallbacks(lambda v: (host_url, v), handle_error)
+    return d
 
   def read_host_values(self, host):
     cmdGen = cmdgen.CommandGenerator()
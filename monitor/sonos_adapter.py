@@ -8,6 +8,7 @@ import xml.etree.cElementTree as XML
 
 import requests
 
+from twisted.internet import defer
 from twisted.internet import threads
 
 import monitor.adapter
@@ -27,18 +28,27 @@ class SonosAdapter(monitor.adapter.Adapter):
 
     # Start refreshing Sonos information every 10 seconds.
     timing_helper = repeat.interval_helper(datetime.timedelta(seconds=10))
-    repeat.call_repeating(timing_helper, self.refresh_players)
+    repeat.call_repeating(timing_helper, monitor.adapter.POLL_SECONDS.time,
+                          (self.name,), self.refresh_players)
 
   def refresh_players(self):
-
-    for ip in self.root_soco.get_speakers_ip():
-
-      def handle_result(info):
-        url = os.path.join(self.url, 'sonos_player', info['zone_name'])
-        self.status.set(url, info)
-
-      d = threads.deferToThread(self.refresh_player, ip)
-      d.addCallback(handle_result)
+    def handle_results(results):
+      # Record the info for all players as a single status update.
+      updates = {}
+      for success, info in results:
+        if success:
+          url = os.path.join(self.url, 'sonos_player', info['zone_name'])
+          updates[url] = info
+        else:
+          logging.error(info.getTraceback())
+
+      self.status.set_many(updates, merge=True)
+
+    d = defer.DeferredList([threads.deferToThread(self.refresh_player, ip)
+                            for ip in self.root_soco.get_speakers_ip()],
+                           consumeErrors=True)
+    d.addCallback(handle_results)
+    return d
 
   def refresh_player(self, ip):
     s = SoCo(ip)
@@ -1,12 +1,35 @@
 #!/usr/bin/python
 
+import collections
+import contextlib
 import copy
+import functools
+import itertools
+import json
 import logging
+import threading
+import time
 
 from twisted.internet import defer
 
+import monitor.util.metrics
+import monitor.util.timer_wheel
+
 PREFIX = 'status://'
 
+# Node.to_json() matches json.dumps(value, sort_keys=True, indent=4).
+_JSON_ENCODER = json.JSONEncoder(sort_keys=True, indent=4)
+_COMPACT_JSON_ENCODER = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+_JSON_INDENT = '    '
+
+_GET_SECONDS = monitor.util.metrics.histogram(
+    'status_get_seconds', 'Status.get() latency, by adapter.', ['adapter'])
+_SET_SECONDS = monitor.util.metrics.histogram(
+    'status_set_seconds', 'Status.set() latency, by adapter.', ['adapter'])
+_NOTIFY_SECONDS = monitor.util.metrics.histogram(
+    'status_notify_seconds',
+    'Time spent finding and firing deferreds after a change.')
+
 
 class BadUrl(Exception):
   """Raised when a status url isn't valid."""
@@ -17,17 +40,104 @@ class UnknownUrl(Exception):
 class RevisionMismatch(Exception):
   """Raised when an operation can't compelete because of mismatch revision."""
 
+def _read_only(*_args, **_kwargs):
+  raise TypeError('Status values are read only.')
+
+
+class _FrozenDict(dict):
+  """A dict handed out by Status which can't be modified.
+
+  Use copy.deepcopy() (or dict()) to get a mutable version.
+  """
+  __setitem__ = __delitem__ = _read_only
+  clear = pop = popitem = setdefault = update = _read_only
+
+  def __copy__(self):
+    return dict(self)
+
+  def __deepcopy__(self, memo):
+    return {key: copy.deepcopy(value, memo) for key, value in self.iteritems()}
+
+
+class _FrozenList(list):
+  """A list handed out by Status which can't be modified.
+
+  Use copy.deepcopy() (or list()) to get a mutable version.
+  """
+  __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+  __iadd__ = __imul__ = _read_only
+  append = extend = insert = pop = remove = reverse = sort = _read_only
+
+  def __copy__(self):
+    return list(self)
+
+  def __deepcopy__(self, memo):
+    return [copy.deepcopy(value, memo) for value in self]
+
+
+def _freeze(value):
+  """Return a read only equivalent of a plain (leaf) status value."""
+  if isinstance(value, (_FrozenDict, _FrozenList)):
+    return value
+  if isinstance(value, dict):
+    return _FrozenDict((key, _freeze(v)) for key, v in value.iteritems())
+  if isinstance(value, list):
+    return _FrozenList(_freeze(v) for v in value)
+  if isinstance(value, tuple):
+    return tuple(_freeze(v) for v in value)
+  return value
+
+
+def _intern_key(key):
+  """Return a shared copy of a dictionary key.
+
+  The same keys appear in many nodes (every SNMP host has the same value
+  names), so they are interned. JSON produces unicode keys, which are
+  converted to str when they're ASCII, since only str can be interned.
+  """
+  if type(key) is unicode:  # pylint: disable=unidiomatic-typecheck
+    try:
+      key = key.encode('ascii')
+    except UnicodeEncodeError:
+      return key
+  return intern(key)
+
+
 class _Node(object):
+  """An immutable node in the status tree.
+
+  Nodes are never modified once created. Updates build a new node for
+  each dictionary between the root and the changed value, and share all
+  other nodes with the previous tree. This means a node (and the value
+  derived from it) can be handed out without copying.
+
+  Trees can be large, so nodes use __slots__, and dictionary keys are
+  interned.
+  """
+  __slots__ = ('revision', '_content', '_value', '_json')
+
   def __init__(self, revision, value):
+    assert not isinstance(value, _Node)
     self.revision = revision
     self._content = self._value_to_content(value)
-    assert not isinstance(value, _Node)
+    self._value = None
+    self._json = None
+
+  @classmethod
+  def _from_content(cls, revision, content):
+    """Create a node directly from a dictionary of child nodes."""
+    node = cls.__new__(cls)
+    node.revision = revision
+    node._content = content
+    node._value = None
+    node._json = None
+    return node
 
   def _value_to_content(self, value):
     """Convert a status struct to nested _Node values (content).
 
-    Dictionary values have each sub-value converted to a node. Other a values
-    simply go through a deepcpoy (only needed for list values).
+    Dictionary values have each sub-value converted to a node. Other values
+    are frozen, so they can be shared without copying.
     """
     assert not isinstance(value, _Node)
     dict_iteritems = None
@@ -35,45 +145,154 @@ class _Node(object):
       dict_iteritems = value.iteritems()
     except AttributeError:
       # Handle everything but dict.
-      return copy.deepcopy(value)
+      return _freeze(value)
 
     result = {}
     for key, subvalue in dict_iteritems:
       assert isinstance(key, basestring)
-      result[key] = _Node(self.revision, subvalue)
+      result[_intern_key(key)] = _Node(self.revision, subvalue)
     return result
 
   def to_value(self):
-    """Convert content (_Node structure) to simple values.
+    """Convert content (_Node structure) to simple read only values.
 
-    Dictionary values have each sub-node converted to a values. Other a values
-    simply go through a deepcpoy (only needed for list values).
+    The result is computed once per node, and shared by every caller. Since
+    unchanged nodes are shared between revisions, so are their values.
+    """
+    value = self._value
+    if value is None:
+      if self.is_dict():
+        value = _FrozenDict(
+            (key, subnode.to_value())
+            for key, subnode in self._content.iteritems())
+      else:
+        value = self._content
+      self._value = value
+    return value
+
+  def drop_caches(self):
+    """Forget the cached value and JSON, once this node is replaced.
+
+    Replaced nodes are kept around for the journal, and their caches can be
+    as large as their whole subtree. Anything still needed is rebuilt from
+    the children. Other threads may be reading the node, so the cached
+    methods only touch the caches through locals.
     """
-    assert not isinstance(self._content, _Node)
+    self._value = None
+    self._json = None
 
-    if self.is_dict():
-      return {key: subvalue.to_value()
-              for key, subvalue in self._content.iteritems()}
-    else:
-      # Copy plain values that were already unpacked.
-      return copy.deepcopy(self._content)
+  def to_limited_value(self, depth):
+    """Like to_value(), but only include depth levels of dictionaries.
+
+    Dictionaries below that are summarized as {key: revision} for each of
+    their children.
+    """
+    if not self.is_dict():
+      return self.to_value()
+
+    if depth <= 0:
+      return _FrozenDict((key, subnode.revision)
+                         for key, subnode in self._content.iteritems())
+
+    return _FrozenDict((key, subnode.to_limited_value(depth - 1))
+                       for key, subnode in self._content.iteritems())
+
+  def to_json(self, level=0):
+    """Serialize the value of this node as indented JSON.
+
+    level is the nesting depth the result will be embedded at in a larger
+    JSON document. Results are cached per node (and so per revision), and a
+    dictionary is built from the cached results of its children. After an
+    update only the new nodes need to be encoded.
+    """
+    cache = self._json
+    if cache is None:
+      cache = self._json = {}
+
+    result = cache.get(level)
+    if result is None:
+      if self.is_dict() and self._content:
+        newline = '\n' + _JSON_INDENT * (level + 1)
+        items = ['%s: %s' % (_JSON_ENCODER.encode(key),
+                             self._content[key].to_json(level + 1))
+                 for key in sorted(self._content)]
+        result = '{%s%s\n%s}' % (newline, (', ' + newline).join(items),
+                                 _JSON_INDENT * level)
+      else:
+        # Encoded JSON never contains a raw newline, except as indentation.
+        result = _JSON_ENCODER.encode(self.to_value()).replace(
+            '\n', '\n' + _JSON_INDENT * level)
+      cache[level] = result
+    return result
+
+  def to_compact_json(self):
+    """Serialize the value of this node as JSON without whitespace.
+
+    Cached and built from the children like to_json().
+    """
+    cache = self._json
+    if cache is None:
+      cache = self._json = {}
+
+    # Cached alongside the indented results, with None for the level.
+    result = cache.get(None)
+    if result is None:
+      if self.is_dict():
+        result = '{%s}' % ','.join(
+            '%s:%s' % (_COMPACT_JSON_ENCODER.encode(key),
+                       self._content[key].to_compact_json())
+            for key in sorted(self._content))
+      else:
+        result = _COMPACT_JSON_ENCODER.encode(self._content)
+      cache[None] = result
+    return result
 
   def is_dict(self):
     return isinstance(self._content, dict)
 
-  def add_child(self, key, value):
-    assert isinstance(key, basestring)
-    assert self.is_dict()
+  def has_child(self, key):
+    return self.is_dict() and key in self._content
+
+  def merge(self, revision, value):
+    """Return a node for value, reusing unchanged parts of this node.
 
-    new_node = _Node(self.revision, value)
-    self._content[key] = new_node
-    return new_node
+    Only nodes whose contents differ from value (and their parents) are
+    created with revision. If nothing differs, this node is returned.
+    """
+    assert not isinstance(value, _Node)
+
+    if not self.is_dict() or not isinstance(value, dict):
+      if not self.is_dict() and not isinstance(value, dict):
+        if self._content == value:
+          return self
+      return _Node(revision, value)
 
-  def remove_child(self, key):
+    content = {}
+    changed = len(value) != len(self._content)
+    for key, subvalue in value.iteritems():
+      assert isinstance(key, basestring)
+      key = _intern_key(key)
+      old_child = self._content.get(key)
+      if old_child is None:
+        content[key] = _Node(revision, subvalue)
+        changed = True
+      else:
+        content[key] = old_child.merge(revision, subvalue)
+        changed = changed or content[key] is not old_child
+
+    if not changed:
+      return self
+    return _Node._from_content(revision, content)
+
+  def with_child(self, revision, key, node):
+    """Return a copy of this node at revision with child key set to node."""
     assert isinstance(key, basestring)
+    assert isinstance(node, _Node)
     assert self.is_dict()
 
-    del self._content[key]
+    content = self._content.copy()
+    content[_intern_key(key)] = node
+    return _Node._from_content(revision, content)
 
   def child(self, key):
     assert isinstance(key, basestring)
@@ -91,117 +310,338 @@ class _Node(object):
                                                  self.revision,
                                                  self._content)
 
-#
-# See 'status' variable at the end.
-#
+def _json_pointer(path, key):
+  """Append key to a JSON Pointer (RFC 6901) path."""
+  return '%s/%s' % (path, key.replace('~', '~0').replace('/', '~1'))
 
-class Status(object):
 
-  def __init__(self, value=None):
-    if value is None:
-      value = {}
+def _diff_nodes(old, new, path, patch):
+  """Append JSON Patch operations to patch, to turn old into new.
 
-    self._node = _Node(revision=1, value=value)
-    self._notifications = set()
+  Nodes shared by both trees are unchanged, and skipped without examining
+  their contents.
+  """
+  if old is new:
+    return
 
-  def revision(self, url='status://'):
-    """Return the current revision of the system status.
+  if old.is_dict() and new.is_dict():
+    old_keys = set(old.children())
+    new_keys = set(new.children())
+    for key in sorted(old_keys - new_keys):
+      patch.append({'op': 'remove', 'path': _json_pointer(path, key)})
+    for key in sorted(new_keys):
+      if key not in old_keys:
+        patch.append({'op': 'add', 'path': _json_pointer(path, key),
+                      'value': new.child(key).to_value()})
+      else:
+        _diff_nodes(old.child(key), new.child(key), _json_pointer(path, key),
+                    patch)
+  elif old.to_value() != new.to_value():
+    patch.append({'op': 'replace', 'path': path, 'value': new.to_value()})
 
-    This number starts 1 one at startup, and increases monotonically with
-    every change.
-    """
-    keys = self._parse_url(url)
-    return self._get_node_by_keys(keys).revision
 
-  def get(self, url='status://', default_result=None):
-    """Fetch a subtree from the status."""
-    try:
-      keys = self._parse_url(url)
-      return self._get_node_by_keys(keys).to_value()
-    except UnknownUrl:
-      return default_result
+def _keys_overlap(pattern, keys):
+  """Could a change to keys affect the url for pattern (with wildcards)?
 
-  def get_matching_urls(self, url):
-    """Accept urls with wild cards.
+  True if keys is a parent of, equal to, or inside a match of pattern.
+  """
+  for pattern_key, key in zip(pattern, keys):
+    if pattern_key != key and pattern_key != '*':
+      return False
+  return True
 
-    Returns:
-      A list of URLs that exist in status and match the wild card pattern.
-    """
-    return self._expand_wildcards(url)
 
-  def set(self, url, update_value, revision=None):
-    """Change the value of a status subtree.
+class _Pattern(object):
+  """A status url, which may contain wildcards ('*'), split for matching.
 
-    Will create parent dictionaries as needed to satisfy the URL.
+  Use _compile_pattern() to create these, which caches them.
+  """
+
+  def __init__(self, url):
+    if not url.startswith(PREFIX):
+      raise BadUrl(url)
+    keys = url[len(PREFIX):].split('/')
+
+    # Fixup empty string results to be empty.
+    if keys == ['']:
+      keys = []
+
+    self.url = url
+    self.keys = tuple(keys)
+    self.wildcards = tuple(i for i, key in enumerate(keys) if key == '*')
+
+  def match(self, node, depth=0, path=()):
+    """Yield (url, node) for each existing node that matches.
+
+    Args:
+      node: The node to search from, found at path.
+      depth: Number of pattern keys already matched to reach node.
+      path: The actual keys leading to node.
     """
-    keys = self._parse_url(url)
+    if not self.wildcards:
+      # No searching needed, just look it up.
+      for key in self.keys[depth:]:
+        if not node.is_dict():
+          return
+        node = node._content.get(key)  # pylint: disable=protected-access
+        if node is None:
+          return
+      yield self.url, node
+      return
+
+    # Depth first search. Urls are only built for matches.
+    path = list(path)
+    for match in self._match(node, depth, path):
+      yield match
+
+  def _match(self, node, depth, path):
+    if depth == len(self.keys):
+      yield PREFIX + '/'.join(path), node
+      return
+
+    if not node.is_dict():
+      return
+
+    content = node._content  # pylint: disable=protected-access
+    key = self.keys[depth]
+    if key == '*':
+      children = content.iteritems()
+    elif key in content:
+      children = [(key, content[key])]
+    else:
+      return
 
-    # Partial is okay, because we'll create missing nodes later.
-    nodes = self._get_nodes_by_keys(keys, partial_okay=True)
+    for child_key, child in children:
+      path.append(child_key)
+      for match in self._match(child, depth + 1, path):
+        yield match
+      path.pop()
 
-    # If there is a specified revision, it must exactly match revisions of
-    # the target node, or any of it's parents.
-    if revision is not None:
-      if revision not in [n.revision for n in nodes]:
-        raise RevisionMismatch('%d received, %d current' %
-                               (revision, self.revision()))
 
-    # Test to see if new value is a change.
-    try:
-      if self.get(url) == update_value:
+# Recently used patterns, most recent last. Shared by snapshots in other
+# threads, so guarded by a lock.
+_PATTERN_CACHE_SIZE = 1000
+_pattern_cache = collections.OrderedDict()
+_pattern_cache_lock = threading.Lock()
+
+
+def _compile_pattern(url):
+  """Return the _Pattern for url, reusing a recently compiled one.
+
+  Raises:
+    BadUrl if url isn't a status url.
+  """
+  with _pattern_cache_lock:
+    pattern = _pattern_cache.pop(url, None)
+    if pattern is None:
+      pattern = _Pattern(url)
+      while len(_pattern_cache) >= _PATTERN_CACHE_SIZE:
+        _pattern_cache.popitem(last=False)
+    _pattern_cache[url] = pattern
+    return pattern
+
+
+class _Subscriptions(object):
+  """Index of status watchers, keyed by the parsed keys of their url.
+
+  This is a trie with one level per url key. Wildcard keys ('*') are stored
+  as an ordinary edge, which is followed for every key when searching.
+  """
+  WILDCARD = '*'
+
+  def __init__(self):
+    self._children = {}
+    self._watchers = set()
+
+  def add(self, keys, watcher):
+    node = self
+    for key in keys:
+      node = node._children.setdefault(key, _Subscriptions())
+    node._watchers.add(watcher)
+
+  def remove(self, keys, watcher):
+    """Remove a watcher, if present. Prunes empty branches."""
+    path = [self]
+    for key in keys:
+      child = path[-1]._children.get(key)
+      if child is None:
         return
-    except UnknownUrl:
-      pass
+      path.append(child)
+
+    path[-1]._watchers.discard(watcher)
+
+    for key, parent, child in reversed(zip(keys, path, path[1:])):
+      if child._watchers or child._children:
+        break
+      del parent._children[key]
+
+  def __len__(self):
+    return sum(len(node._watchers) for node in self._nodes())
+
+  def matching(self, keys):
+    """Return the watchers whose url could overlap the url for keys.
+
+    That is every watcher on a parent of keys, on keys itself, or on any
+    child of keys (with wildcards matching any single key).
+    """
+    result = set()
+    nodes = [self]
+    for key in keys:
+      next_nodes = []
+      for node in nodes:
+        result.update(node._watchers)
+        for edge in (key, self.WILDCARD):
+          child = node._children.get(edge)
+          if child is not None:
+            next_nodes.append(child)
+      nodes = next_nodes
 
-    # We've decided we can set, update existing revisions.
-    new_revision = self.revision() + 1
     for node in nodes:
-      node.revision = new_revision
+      for descendant in node._nodes():
+        result.update(descendant._watchers)
 
-    # Ensure any missing predecessor nodes are present.
-    for i in xrange(len(keys)-1):
-      key, node = keys[i], nodes[i]
-      if not key in node.children():
-        nodes.append(node.add_child(key, {}))
+    return result
 
-    # Remove the node we are replacing, if present.
-    if len(nodes) > len(keys):
-      nodes.pop()
+  def _nodes(self):
+    """Generate this node, and all nodes below it."""
+    pending = [self]
+    while pending:
+      node = pending.pop()
+      yield node
+      pending.extend(node._children.itervalues())
 
-    # Nodes contains the root node, which has no matching key, but is
-    # missing the final node, which does.
-    assert len(keys) == len(nodes)
 
-    nodes[-1].add_child(keys[-1], update_value)
+def _observe_latency(histogram, root, url, start, weight):
+  """Observe the latency of a Status call on url, which began at start.
 
-    # Notify listeners.
-    logging.debug('Status revision %d: %s -> %s',
-                  self.revision(), update_value, url)
+  Observations are labelled with the adapter the url belongs to (the first
+  key), '' for the root, or 'unknown' if there is no such adapter, so
+  arbitrary urls can't create new labels.
+  """
+  adapter = url[len(PREFIX):].partition('/')[0]
+  if adapter and not root.has_child(adapter):
+    adapter = 'unknown'
+  histogram.observe((adapter,), time.time() - start, weight)
 
-    self._notify()
-    return update_value
 
-  def deferred(self, revision=None, url='status://'):
-    """Create a deferred that's called when status is next updated.
+def _sampler(sample):
+  """Return a function which is True for one call in every sample.
 
-       If an outdated revision is provided, we will call back right away.
-       Otherwise, revision is ignored.
+  It's the next() of a C iterator, which is cheaper than any Python call.
+  """
+  return itertools.cycle([False] * (sample - 1) + [True]).next
 
-       The deferred value (when fired) will be a list of URLs that match
-       the URL passed in (wildcards accepted),
+
+def _time_call(histogram, weight, status, url, method, *args, **kwargs):
+  """Return method(*args, **kwargs), and observe its latency on url."""
+  start = time.time()
+  try:
+    return method(*args, **kwargs)
+  finally:
+    _observe_latency(histogram, status._node, url, start, weight)
+
+
+def _timed(histogram, sample):
+  """Decorate a Status method taking a url, to observe its latency.
+
+  Only one call in sample is timed, and observed with a weight of sample, so
+  the counts and sums are still right on average.
+  """
+  def decorator(method):
+    due = _sampler(sample)
+
+    @functools.wraps(method)
+    def timed(self, url, *args, **kwargs):
+      if not due():
+        return method(self, url, *args, **kwargs)
+      return _time_call(histogram, sample, self, url, method, self, url, *args,
+                        **kwargs)
+
+    # For benchmarking the cost of timing.
+    timed.untimed = method
+    return timed
+  return decorator
+
+
+#
+# See 'status' variable at the end.
+#
+
+class _StatusReader(object):
+  """Read methods shared by Status and StatusSnapshot.
+
+  Everything here reads from self._node, the root of an immutable tree.
+  """
+
+  # True for the get() calls to time for /metrics, see _sampler(). Snapshots
+  # are read from other threads, so their reads never are.
+  _get_due = itertools.repeat(False).next
+
+  def revision(self, url='status://'):
+    """Return the current revision of the system status.
+
+    This number starts 1 one at startup, and increases monotonically with
+    every change.
     """
-    deferred = self._Deferred(self, url)
+    keys = self._parse_url(url)
+    return self._get_node_by_keys(keys).revision
 
-    if revision is not None and revision != self.revision(url):
-      # Send event right away.
-      deferred.issue_callback()
-    else:
-      # Save it off, so we can send it later.
-      self._notifications.add(deferred)
+  def get(self, url='status://', default_result=None, depth=None):
+    """Fetch a subtree from the status.
 
+    The result is read only, and is shared with other callers. Use
+    copy.deepcopy() on it if a modifiable version is needed.
 
+    If depth is given, only that many levels of dictionaries are returned.
+    Dictionaries below the cut-off are returned as {key: revision} for each
+    of their children, so a caller can decide what to fetch next. For
+    example, depth=0 returns the keys and revisions of the children of url.
+    """
+    # The check is done here, since a timing wrapper would cost almost a
+    # tenth of a cached leaf read. The timed read is of a snapshot, which
+    # isn't sampled again.
+    if self._get_due():
+      return _time_call(_GET_SECONDS, self.GET_SAMPLE, self, url,
+                        StatusSnapshot(self._node).get, url, default_result,
+                        depth)
 
-    return deferred
+    try:
+      keys = self._parse_url(url)
+      node = self._get_node_by_keys(keys)
+    except UnknownUrl:
+      return default_result
+
+    if depth is None:
+      return node.to_value()
+    return node.to_limited_value(depth)
+
+  def get_json(self, url='status://', level=0, compact=False):
+    """Fetch a subtree from the status, serialized as indented JSON.
+
+    The result is the same as json.dumps(get(url), sort_keys=True, indent=4),
+    but unchanged subtrees are not serialized again. See _Node.to_json() for
+    level.
+
+    If compact is True, the result is instead the same as
+    json.dumps(get(url), sort_keys=True, separators=(',', ':')), and level is
+    ignored.
+
+    Raises:
+      UnknownUrl if the url doesn't exist.
+    """
+    keys = self._parse_url(url)
+    node = self._get_node_by_keys(keys)
+    if compact:
+      return node.to_compact_json()
+    return node.to_json(level)
+
+  def get_matching_urls(self, url):
+    """Accept urls with wild cards.
+
+    Returns:
+      A list of URLs that exist in status and match the wild card pattern.
+    """
+    return self._expand_wildcards(url)
 
   def _validate_url(self, url):
     if not url.startswith(PREFIX):
@@ -260,65 +700,566 @@ class Status(object):
 
     May return an empty list if a single url is passed in which does not exist.
     """
-    urls = [url]
+    return [match_url for match_url, _ in self._match(_compile_pattern(url))]
+
+  def _match(self, pattern):
+    """Yield (url, node) for every node matching a _Pattern."""
+    return pattern.match(self._node)
+
+
+class StatusSnapshot(_StatusReader):
+  """A read only view of the status at a single revision.
+
+  Status nodes are never modified, only replaced, so a snapshot needs no
+  copying or locking. It's safe to read from any thread (for example, one
+  started by deferToThread) while the reactor thread keeps updating the
+  status it came from.
+  """
+
+  def __init__(self, node):
+    self._node = node
+
+
+class Status(_StatusReader):
+
+  # How many changes are remembered for changes_since(), and revisions for
+  # patch_since().
+  JOURNAL_SIZE = 1000
+
+  # Only one in this many get() or set() calls is timed for /metrics.
+  GET_SAMPLE = 64
+  SET_SAMPLE = 16
+
+  _get_due = _sampler(GET_SAMPLE)
+
+  def __init__(self, value=None, clock=None):
+    if value is None:
+      value = {}
+
+    self._node = _Node(revision=1, value=value)
+    self._notifications = _Subscriptions()
+
+    # Recent changes as (revision, keys, node) tuples, oldest first. Every
+    # change after _journal_floor is present.
+    self._journal = collections.deque()
+    self._journal_floor = self._node.revision
+
+    # Recent roots as (revision, node) tuples, oldest first. Nodes are shared
+    # between revisions, so this only keeps the nodes replaced since.
+    self._roots = collections.deque([(self._node.revision, self._node)])
+
+    # Called with every committed change.
+    self._listeners = []
+
+    # Index of components, as {type: {name: set(adapters)}}. Anything at
+    # status://<adapter>/<type>/<name> is a component.
+    self._components = {}
+    self._index_components([])
+
+    # Pending expirations from set(ttl=...), as {keys tuple: timer}.
+    self._expiry_wheel = monitor.util.timer_wheel.TimerWheel(clock)
+    self._expiries = {}
+
+    # State for the transaction in progress, if any.
+    self._transaction_depth = 0
+    self._transaction_revision = None
+    self._transaction_changes = []
+    self._transaction_expiries = []
+
+  def snapshot(self):
+    """Return a StatusSnapshot of the current status.
+
+    This is cheap (nothing is copied), and the result can be handed to other
+    threads. Status itself must only be used from the reactor thread.
+    """
+    return StatusSnapshot(self._node)
+
+  @_timed(_SET_SECONDS, SET_SAMPLE)
+  def set(self, url, update_value, revision=None, merge=False, ttl=None):
+    """Change the value of a status subtree.
+
+    Will create parent dictionaries as needed to satisfy the URL.
+
+    If merge is True, update_value is compared against the existing subtree,
+    and only values which actually changed (and their parents) receive the new
+    revision. The resulting value is the same either way.
+
+    If ttl is given, the value is set to None after ttl seconds, unless it
+    changes first. Setting it again (even to the same value) replaces the
+    ttl, or without a ttl removes it.
+
+    Raises:
+      ValueError if ttl isn't a finite, non-negative number of seconds.
+    """
+    self._check_ttl(ttl)
+    keys = self._parse_url(url)
+
+    # Partial is okay, because we'll create missing nodes later.
+    nodes = self._get_nodes_by_keys(keys, partial_okay=True)
+
+    self._check_revision(nodes, revision)
+
+    if self._transaction_revision is not None:
+      # Every write in a transaction shares a single revision.
+      new_revision = self._transaction_revision
+    else:
+      new_revision = self.revision() + 1
+
+    # Test to see if new value is a change, and build the new node.
+    existing = nodes[-1] if len(nodes) > len(keys) else None
+    if merge and existing is not None:
+      new_node = existing.merge(new_revision, update_value)
+      if new_node is existing:
+        self._set_expiry(keys, ttl)
+        return
+    else:
+      # Compare against the cached value of the existing node. This is done
+      # in C, so it's cheap even for large subtrees.
+      existing_value = existing.to_value() if existing is not None else None
+      if existing_value == update_value:
+        if existing is not None:
+          self._set_expiry(keys, ttl)
+        return
+      new_node = _Node(new_revision, update_value)
+
+    # We've decided we can set. Copy each node between the new value and the
+    # root with the new revision. Everything else is shared with the previous
+    # tree.
+    for depth in reversed(xrange(len(keys))):
+      if depth < len(nodes):
+        parent = nodes[depth]
+      else:
+        # Create missing predecessor nodes.
+        parent = _Node(new_revision, {})
+      new_node = parent.with_child(new_revision, keys[depth], new_node)
+
+    self._node = new_node
+
+    # None of the nodes we looked up are in the new tree. Only the journal
+    # still refers to them, so they don't need their caches.
+    for node in nodes:
+      node.drop_caches()
+
+    # Journal the change. If parents were created, the change is the creation
+    # of the top most new parent.
+    journal_keys = keys[:len(nodes)]
+    self._index_components(journal_keys)
+    change = (new_revision, journal_keys, self._get_node_by_keys(journal_keys))
+    self._add_journal(*change)
+    self._set_expiry(keys, ttl)
+
+    # Notify listeners.
+    logging.debug('Status revision %d: %s -> %s',
+                  self.revision(), update_value, url)
+
+    if self._transaction_depth:
+      self._transaction_revision = new_revision
+      self._transaction_changes.append(change)
+    else:
+      self._committed([change])
+    return update_value
+
+  def compare_and_set(self, updates, merge=False):
+    """Set several urls as a single transaction, if none of them changed.
+
+    Args:
+      updates: Dictionary of {url: (expected_revision, value)}. Each expected
+               revision is checked the same way as the revision passed to
+               set(). None means don't check that url.
+      merge: Passed along to set().
+
+    Raises:
+      RevisionMismatch if any expected revision doesn't match, in which case
+      nothing is changed.
+    """
+    # Check everything first, since each write changes the revisions that
+    # later ones would be checked against.
+    for url, (expected_revision, _) in updates.iteritems():
+      nodes = self._get_nodes_by_keys(self._parse_url(url), partial_okay=True)
+      self._check_revision(nodes, expected_revision)
+
+    self.set_many({url: value for url, (_, value) in updates.iteritems()},
+                  merge=merge)
+
+  def set_many(self, updates, merge=False):
+    """Set a dictionary of {url: value} as a single transaction.
+
+    Updates are applied in sorted url order, so parents are written before
+    their children. merge is passed along to set().
+    """
+    with self.transaction():
+      for url, update_value in sorted(updates.iteritems()):
+        self.set(url, update_value, merge=merge)
+
+  @contextlib.contextmanager
+  def transaction(self):
+    """Context manager which groups set() calls into a single update.
+
+    All changes made inside the transaction share one new revision, and
+    deferreds are only notified (at most once each) when the outermost
+    transaction exits. If an exception escapes the outermost transaction, all
+    changes made inside it are discarded.
+
+      with status.transaction():
+        status.set('status://foo', 1)
+        status.set('status://bar', 2)
+    """
+    original_node = self._node
+    self._transaction_depth += 1
+    try:
+      yield
+    except Exception:
+      if self._transaction_depth == 1:
+        self._node = original_node
+        self._index_components([])
+        while (self._journal and
+               self._journal[-1][0] == self._transaction_revision):
+          self._journal.pop()
+        while self._roots[-1][0] == self._transaction_revision:
+          self._roots.pop()
+        self._transaction_revision = None
+        self._transaction_changes = []
+        self._transaction_expiries = []
+      raise
+    finally:
+      self._transaction_depth -= 1
+
+    if not self._transaction_depth:
+      changes = self._transaction_changes
+      expiries = self._transaction_expiries
+      self._transaction_revision = None
+      self._transaction_changes = []
+      self._transaction_expiries = []
+      for keys, ttl in expiries:
+        self._apply_expiry(keys, ttl)
+      self._committed(changes)
+
+  def add_listener(self, listener):
+    """Call listener(revision, url, value) for every committed change.
+
+    Changes are described the same way as by changes_since(). Changes made in
+    a transaction are passed along when the transaction completes, and
+    never if it fails. Exceptions raised by listener are logged, and
+    otherwise ignored.
+    """
+    self._listeners.append(listener)
+
+  def remove_listener(self, listener):
+    self._listeners.remove(listener)
+
+  def restore(self, value, revision):
+    """Replace the entire status with value at revision.
+
+    This is for restoring saved state at startup. Nothing is notified, and
+    the journal is cleared.
+    """
+    assert not self._transaction_depth
+    self._node = _Node(revision, value)
+    self._journal.clear()
+    self._journal_floor = revision
+    self._roots = collections.deque([(revision, self._node)])
+    self._index_components([])
+
+    for timer in self._expiries.itervalues():
+      timer.cancel()
+    self._expiries.clear()
+
+  def expiries(self, url='status://'):
+    """Return {url: time} for values at or inside url that will expire.
+
+    Times are when the ttl runs out, in seconds from the same clock as the
+    ttl itself, so they can be saved and passed to restore_expiries().
+    """
+    prefix = tuple(self._parse_url(url))
+    return {self._join_url(keys): timer.deadline
+            for keys, timer in self._expiries.iteritems()
+            if keys[:len(prefix)] == prefix}
+
+  def restore_expiries(self, expiries):
+    """Expire values again, after restore(), from a saved expiries().
+
+    Values whose time has already passed expire as soon as possible. Urls
+    that no longer exist are ignored.
+    """
+    assert not self._transaction_depth
+    now = self._expiry_wheel.seconds()
+    for url, deadline in expiries.iteritems():
+      self._apply_expiry(tuple(self._parse_url(url)), max(0, deadline - now))
+
+  def changes_since(self, revision, url='status://'):
+    """Return the changes made after revision which overlap url.
+
+    url may contain wildcards. A change overlaps url if it was made to a
+    parent of url, to url itself, or to anything inside url.
+
+    Returns:
+      A list of (revision, url, value) tuples, oldest first. Each says that
+      the subtree at url was set to value at that revision. Returns None if
+      revision is too old to be in the journal, or is newer than the current
+      revision.
+    """
+    if revision < self._journal_floor or revision > self.revision():
+      return None
+
+    pattern = self._parse_url(url)
     result = []
+    # The journal is short, and newest last. Walk back to revision.
+    for entry_revision, keys, node in reversed(self._journal):
+      if entry_revision <= revision:
+        break
+      if _keys_overlap(pattern, keys):
+        result.append((entry_revision, self._join_url(keys), node.to_value()))
+
+    result.reverse()
+    return result
 
-    # For each url in urls, we look to see if it contains any wild cards.
-    # If not, we look to see if it exists in our values. If it does, add
-    # to results.
-    #
-    # If the url contains a wildcard, expand it, and add all discovered urls
-    # back to the urls list to start over. This expands any additional wild
-    # cards, and tests for existence of the fully expanded urls.
-    while urls:
-      keys = self._parse_url(urls.pop())
-      try:
-        index = keys.index('*')
-      except ValueError:
-        # There is no wildcard in the URL.
-        try:
-          self._get_node_by_keys(keys)
-        except (UnknownUrl, BadUrl):
-          # URL doesn't exist, skip it.
-          continue
+  def patch_since(self, revision, url='status://'):
+    """Return a JSON Patch (RFC 6902) from url at revision to url now.
 
-        # We found a concrete URL that exists, it's a result.
-        result.append(self._join_url(keys))
-        continue
+    The patch is found by comparing the tree at revision with the current
+    one. Nodes that haven't changed since revision are shared by both, so
+    only the parts which changed are examined.
+
+    Returns:
+      A list of patch operations, with paths relative to url. Returns None
+      if revision is too old to be remembered, or url didn't exist then.
+    """
+    if revision > self.revision():
+      return None
+
+    # The newest root at or before revision is the tree as of revision.
+    keys = self._parse_url(url)
+    for root_revision, root in reversed(self._roots):
+      if root_revision <= revision:
+        break
+    else:
+      return None
+
+    try:
+      old = StatusSnapshot(root)._get_node_by_keys(keys)
+    except UnknownUrl:
+      return None
+
+    patch = []
+    _diff_nodes(old, self._get_node_by_keys(keys), '', patch)
+    return patch
+
+  def pending_deferreds(self):
+    """Return how many deferred() results are waiting to be called back."""
+    return len(self._notifications)
+
+  def deferred(self, revision=None, url='status://', predicate=None):
+    """Create a deferred that's called when status is next updated.
+
+       If an outdated revision is provided, we will call back right away.
+       Otherwise, revision is ignored.
 
-      pre_wildcard_keys = keys[:index]
-      post_wildcard_keys = keys[index+1:]
+       If predicate is provided, updates only count if predicate(value) is
+       True for the new value of at least one updated url (None for urls that
+       were removed). It's checked as part of every update, so the deferred
+       isn't called back for updates that would just be ignored.
+
+       The deferred value (when fired) will be a list of URLs that match
+       the URL passed in (wildcards accepted),
+    """
+    deferred = self._Deferred(self, url, predicate)
+
+    if (revision is not None and revision != self.revision(url) and
+        deferred.accepts(self.get_matching_urls(url))):
+      # Send event right away.
+      deferred.issue_callback()
+    else:
+      # Save it off, so we can send it later.
+      self._notifications.add(deferred.keys, deferred)
+
+    return deferred
+
+  def _check_revision(self, nodes, revision):
+    """Raise RevisionMismatch unless revision is None, or matches a node.
+
+    nodes are those from the root to a url (or as much of it as exists). So
+    revision must exactly match the revision of the url, or of any of its
+    parents.
+    """
+    if revision is not None:
+      if revision not in [n.revision for n in nodes]:
+        raise RevisionMismatch('%d received, %d current' %
+                               (revision, self.revision()))
+
+  def _check_ttl(self, ttl):
+    """Make sure ttl can be scheduled, before anything is changed."""
+    if ttl is None:
+      return
+    # bool is an int, and nan fails every comparison.
+    if (isinstance(ttl, bool) or not isinstance(ttl, (int, long, float)) or
+        not 0 <= ttl < float('inf')):
+      raise ValueError('Invalid ttl: %r' % (ttl,))
+
+  def _set_expiry(self, keys, ttl):
+    """Start, replace or remove the expiration of keys after a set()."""
+    if ttl is None and not self._expiries:
+      return
+
+    if self._transaction_depth:
+      # Only applied if the transaction succeeds.
+      self._transaction_expiries.append((tuple(keys), ttl))
+    else:
+      self._apply_expiry(tuple(keys), ttl)
+
+  def _apply_expiry(self, keys, ttl):
+    timer = self._expiries.pop(keys, None)
+    if timer:
+      timer.cancel()
+
+    if ttl is not None:
+      # The value only expires if it's unchanged, which means it still has
+      # the same revision.
       try:
-        wildcard_node = self._get_node_by_keys(pre_wildcard_keys)
+        revision = self._get_node_by_keys(keys).revision
       except (UnknownUrl, BadUrl):
-        # partial URL doesn't exist, skip it.
-        continue
+        return
+      self._expiries[keys] = self._expiry_wheel.call_later(
+          ttl, self._expire, keys, revision)
 
-      if not wildcard_node.is_dict():
-        # The wildcard_node isn't a dictionary, can't expand it.
+  def _expire(self, keys, revision):
+    del self._expiries[keys]
+    try:
+      if self._get_node_by_keys(keys).revision != revision:
+        return
+    except (UnknownUrl, BadUrl):
+      return
+
+    url = self._join_url(keys)
+    logging.debug('Status expired: %s', url)
+    self.set(url, None)
+
+  def _add_journal(self, revision, keys, node):
+    """Remember a change for changes_since, forgetting the oldest if needed."""
+    self._journal.append((revision, keys, node))
+    while len(self._journal) > self.JOURNAL_SIZE:
+      self._journal_floor = self._journal.popleft()[0]
+
+    # Every change in a transaction shares a revision. Keep the last root.
+    if self._roots[-1][0] == revision:
+      self._roots.pop()
+    self._roots.append((revision, self._node))
+    while len(self._roots) > self.JOURNAL_SIZE + 1:
+      self._roots.popleft()
+
+  def _match(self, pattern):
+    """Yield (url, node) for every node matching a _Pattern.
+
+    Patterns of the form status://*/<type>/<name>... are matched starting from
+    the component index, instead of searching every adapter.
+    """
+    keys = pattern.keys
+    if len(keys) < 3 or keys[0] != '*' or keys[1] == '*':
+      return pattern.match(self._node)
+    return self._match_components(pattern)
+
+  def _match_components(self, pattern):
+    component_type, name_key = pattern.keys[1:3]
+    names = self._components.get(component_type, {})
+    if name_key == '*':
+      components = [(adapter, name)
+                    for name, adapters in names.iteritems()
+                    for adapter in adapters]
+    else:
+      components = [(adapter, name_key)
+                    for adapter in names.get(name_key, ())]
+
+    # Indexed components are known to exist.
+    # pylint: disable=protected-access
+    root = self._node._content
+    for adapter, name in components:
+      node = root[adapter]._content[component_type]._content[name]
+      if len(pattern.keys) == 3:
+        yield '%s%s/%s/%s' % (PREFIX, adapter, component_type, name), node
+      else:
+        for match in pattern.match(node, 3, (adapter, component_type, name)):
+          yield match
+
+  def _index_components(self, keys):
+    """Update the component index after the node at keys was replaced."""
+    if len(keys) >= 3:
+      # A single component was created or replaced. set() never deletes, so
+      # this can only add to the index.
+      self._components.setdefault(keys[1], {}).setdefault(
+          keys[2], set()).add(keys[0])
+      return
+
+    # An adapter, a component type, or everything was replaced. Forget the
+    # old components in that area, and scan for the new ones.
+    for component_type, names in self._components.items():
+      if len(keys) > 1 and component_type != keys[1]:
         continue
+      for name, adapters in names.items():
+        if keys:
+          adapters.discard(keys[0])
+        else:
+          adapters.clear()
+        if not adapters:
+          del names[name]
+      if not names:
+        del self._components[component_type]
+
+    if not self._node.is_dict():
+      return
+    for adapter in keys[:1] or self._node.children():
+      adapter_node = self._node.child(adapter)
+      if not adapter_node.is_dict():
+        continue
+      for component_type in keys[1:2] or adapter_node.children():
+        type_node = adapter_node.child(component_type)
+        if not type_node.is_dict():
+          continue
+        for name in type_node.children():
+          self._components.setdefault(component_type, {}).setdefault(
+              name, set()).add(adapter)
+
+  def _committed(self, changes):
+    """Tell listeners and deferreds about a list of completed changes."""
+    for listener in self._listeners:
+      for revision, keys, node in changes:
+        try:
+          listener(revision, self._join_url(keys), node.to_value())
+        except Exception:  # pylint: disable=broad-except
+          # The change is already made, so the caller shouldn't see an error,
+          # and watchers must still be told.
+          logging.exception('Status listener failed: %r', listener)
 
-      for expanded_key in wildcard_node.children():
-        urls.append(self._join_url(pre_wildcard_keys +
-                                   [expanded_key] +
-                                   post_wildcard_keys))
+    self._notify(*[keys for _, keys, _ in changes])
 
-    return result
+  def _notify(self, *changed_keys):
+    """Look for deferreds that need to fire after changed_keys were updated.
+
+    Only deferreds watching a url that overlaps one of changed_keys are
+    examined, and each is examined once.
+    """
+    start = time.time()
+    candidates = set()
+    for keys in changed_keys:
+      candidates.update(self._notifications.matching(keys))
 
-  def _notify(self):
-    """Look for deferreds that need to fire."""
     # Firing a deferred can modify (add or remove) our set of notifications
     # underneath us.
-    for d in self._notifications.copy():
-      # If the deferred was handled in a nested call and removed...
+    for d in candidates:
+      # If the deferred was fired (or cancelled) in a nested call...
       #   skip it.
-      if d not in self._notifications:
+      if d.called:
         continue
 
       if d.changed():
-        self._notifications.remove(d)
+        self._notifications.remove(d.keys, d)
         d.issue_callback()
 
+    # Includes the callbacks, since they run as part of the change.
+    _NOTIFY_SECONDS.observe((), time.time() - start)
+
+  def _cancel_deferred(self, deferred):
+    """Stop watching for a deferred that was cancelled."""
+    self._notifications.remove(deferred.keys, deferred)
+
   class _Deferred(defer.Deferred):
     """Helper class for watching part of the status to see if it was updated.
 
@@ -326,24 +1267,40 @@ class Status(object):
     out if it's time for it to call back or not, and what value to send to
     the callback.
     """
-    def __init__(self, status, url):
-      defer.Deferred.__init__(self)
+    def __init__(self, status, url, predicate=None):
+      # pylint: disable=W0212
+      defer.Deferred.__init__(self, canceller=status._cancel_deferred)
       self._status = status
-      self._url = url
+      self._pattern = _compile_pattern(url)
+      self._predicate = predicate
+      self.keys = self._pattern.keys
       self._watching = self._find_revisions()
 
     def changed(self):
-      return self._watching != self._find_revisions()
+      current = self._find_revisions()
+      if current == self._watching:
+        return False
+
+      if self._predicate is None:
+        return True
+
+      # Only check urls that changed, and don't check them again unless they
+      # change again.
+      changed_urls = [url for url in set(current).union(self._watching)
+                      if current.get(url) != self._watching.get(url)]
+      self._watching = current
+      return self.accepts(changed_urls)
+
+    def accepts(self, urls):
+      """Do the values of urls satisfy our predicate?"""
+      if self._predicate is None:
+        return True
+      return any(self._predicate(self._status.get(url)) for url in urls)
 
     def issue_callback(self):
-      self.callback(self._status.get_matching_urls(self._url))
+      self.callback(self._status.get_matching_urls(self._pattern.url))
 
     def _find_revisions(self):
-      result = {}
-      urls = self._status.get_matching_urls(self._url)
-      for url in urls:
-        try:
-          result[url] = self._status.revision(url)
-        except UnknownUrl:
-          result[url] = None
-      return result
+      # pylint: disable=W0212
+      return {url: node.revision
+              for url, node in self._status._match(self._pattern)}
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+import monitor.persistence
+import monitor.status
+import monitor.util.test_base
+
+
+class TestPersistence(monitor.util.test_base.TestBase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _restore(self):
+    status = monitor.status.Status()
+    monitor.persistence.Persistence(status, self.directory).restore()
+    return status
+
+  def test_empty(self):
+    status = self._restore()
+    self.assertEqual(status.get(), {})
+    self.assertEqual(status.revision(), 1)
+
+  def test_snapshot_and_log(self):
+    status = self._create_status()
+    saver = monitor.persistence.Persistence(status, self.directory)
+    saver.start()
+
+    # Changes after the snapshot come from the log.
+    status.set('status://int', 5)
+    status.set_many({'status://dict/sub1': 6, 'status://new': {'a': 'b'}})
+    saver.stop()
+
+    restored = self._restore()
+    self.assertEqual(restored.get(), status.get())
+    self.assertEqual(restored.revision(), status.revision())
+    self.assertEqual(restored.revision('status://list'),
+                     status.revision('status://list'))
+
+    # Restored status can be saved again.
+    saver = monitor.persistence.Persistence(restored, self.directory)
+    saver.start()
+    restored.set('status://int', 7)
+    saver.stop()
+
+    self.assertEqual(self._restore().get('status://int'), 7)
+
+  def test_log_bound(self):
+    status = self._create_status()
+    saver = monitor.persistence.Persistence(status, self.directory,
+                                            max_log_bytes=200)
+    saver.start()
+    log_file = os.path.join(self.directory, monitor.persistence.LOG_NAME)
+
+    for i in xrange(100):
+      status.set('status://int', i)
+      self.assertLessEqual(os.path.getsize(log_file), 250)
+    saver.stop()
+
+    restored = self._restore()
+    self.assertEqual(restored.get(), status.get())
+    self.assertEqual(restored.revision(), status.revision())
+
+  def test_logged_changes_in_snapshot(self):
+    status = self._create_status()
+    saver = monitor.persistence.Persistence(status, self.directory)
+    saver.start()
+    status.set('status://int', 5)
+    status.set('status://int', 6)
+
+    # Simulate a crash after a snapshot was written, but before the log was
+    # emptied.
+    log_file = os.path.join(self.directory, monitor.persistence.LOG_NAME)
+    with open(log_file) as f:
+      log = f.read()
+    saver.snapshot()
+    saver.stop()
+    with open(log_file, 'w') as f:
+      f.write(log)
+
+    restored = self._restore()
+    self.assertEqual(restored.get(), status.get())
+    self.assertEqual(restored.revision(), status.revision())
+
+  def test_partial_log_line(self):
+    status = self._create_status()
+    saver = monitor.persistence.Persistence(status, self.directory)
+    saver.start()
+    status.set('status://int', 5)
+    saver.stop()
+
+    log_file = os.path.join(self.directory, monitor.persistence.LOG_NAME)
+    with open(log_file, 'a') as f:
+      f.write('{"revision": 3, "url": "stat')
+
+    self.assertEqual(self._restore().get(), status.get())
+
+  def test_unloggable_change(self):
+    status = self._create_status()
+    saver = monitor.persistence.Persistence(status, self.directory)
+    saver.start()
+
+    # A value that can't be saved doesn't break set(), or notifications.
+    d = status.deferred(url='status://int')
+    status.set('status://int', '\xff')
+    self.assertTrue(d.called)
+
+    # Nothing more is logged, until a snapshot includes the lost change.
+    status.set('status://int', 5)
+    self.assertEqual(self._restore().revision(), 1)
+    saver._periodic_snapshot()
+    status.set('status://dict/sub1', 6)
+    saver.stop()
+
+    restored = self._restore()
+    self.assertEqual(restored.get(), status.get())
+    self.assertEqual(restored.revision(), status.revision())
+
+  def test_ttl(self):
+    clock = task.Clock()
+    clock.advance(100)
+    status = monitor.status.Status({'int': 1, 'other': 1}, clock=clock)
+    saver = monitor.persistence.Persistence(status, self.directory)
+    saver.start()
+
+    # Expirations are saved in both the snapshot, and the log.
+    status.set('status://int', 2, ttl=10)
+    status.set('status://other', 3, ttl=10)
+    saver.snapshot()
+    status.set('status://new/a', 4, ttl=20)
+    status.set('status://other', 5)
+    saver.stop()
+
+    def restore(now):
+      restored_clock = task.Clock()
+      restored_clock.advance(now)
+      restored = monitor.status.Status(clock=restored_clock)
+      monitor.persistence.Persistence(restored, self.directory).restore()
+      self.assertEqual(restored.get(), status.get())
+      return restored, restored_clock
+
+    # They still expire at the same time, after a restart.
+    restored, restored_clock = restore(105)
+    restored_clock.advance(5)
+    self.assertEqual(restored.get(),
+                     {'int': None, 'other': 5, 'new': {'a': 4}})
+    restored_clock.advance(10)
+    self.assertIsNone(restored.get('status://new/a'))
+
+    # Or right away, if that time has already passed.
+    restored, restored_clock = restore(200)
+    restored_clock.advance(1)
+    self.assertEqual(restored.get(),
+                     {'int': None, 'other': 5, 'new': {'a': None}})
+
+  def test_log_gap(self):
+    status = self._create_status()
+    saver = monitor.persistence.Persistence(status, self.directory)
+    saver.start()
+    status.set('status://int', 5)
+    status.set('status://dict/sub1', 6)
+    status.set('status://int', 7)
+    saver.stop()
+
+    # Lose the second logged change.
+    log_file = os.path.join(self.directory, monitor.persistence.LOG_NAME)
+    with open(log_file) as f:
+      lines = f.readlines()
+    with open(log_file, 'w') as f:
+      f.writelines(lines[:1] + lines[2:])
+
+    # Replaying stops at the gap, keeping what came before it.
+    restored = self._restore()
+    self.assertEqual(restored.get('status://int'), 5)
+    self.assertEqual(restored.get('status://dict/sub1'), 3)
+    self.assertEqual(restored.revision(), status.revision() - 2)
+
+  def test_missed_change(self):
+    status = self._create_status()
+    saver = monitor.persistence.Persistence(status, self.directory)
+    saver.start()
+    status.set('status://int', 5)
+
+    # A change that never reaches the listener stops logging, since the log
+    # couldn't be replayed past it.
+    status.remove_listener(saver._log_change)
+    status.set('status://int', 6)
+    status.add_listener(saver._log_change)
+    status.set('status://dict/sub1', 7)
+    self.assertEqual(self._restore().get('status://int'), 5)
+
+    # Until a snapshot includes it.
+    saver._periodic_snapshot()
+    status.set('status://int', 8)
+    saver.stop()
+
+    restored = self._restore()
+    self.assertEqual(restored.get(), status.get())
+    self.assertEqual(restored.revision(), status.revision())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -152,6 +152,31 @@ class TestRulesEngine(monitor.util.test_base.TestBase):
 
     return d
 
+  def test_watch_rule_trigger(self):
+    """A watch rule with a trigger only fires for the trigger value."""
+    status, engine = self._setup_status_engine({
+        'watch_test': {
+            'behavior': 'watch',
+            'value': 'status://values/one',
+            'trigger': 3,
+            'action': 'take_action'
+        }
+    })
+
+    expected_actions = ['status://config/rule/watch_test/action']
+    d = self._test_actions_fired(engine, expected_actions)
+
+    # Values that don't match don't even wake up the rule.
+    helper = engine._helpers[0]
+    deferred = helper._deferred
+    status.set('status://values/one', 2)
+    self.assertIs(helper._deferred, deferred)
+    self.assertFalse(deferred.called)
+
+    status.set('status://values/one', 3)
+
+    return d
+
   def test_watch_rules_fired(self):
     """Setup and fire two watch rules in the rules_engine."""
     status, engine = self._setup_status_engine({
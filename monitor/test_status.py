@@ -1,8 +1,13 @@
 #!/usr/bin/python
 
+import copy
 import json
+import mock
 import unittest
 
+from twisted.internet import defer
+from twisted.internet import task
+
 import monitor.status
 import monitor.util.test_base
 
@@ -72,49 +77,153 @@ class TestNode(monitor.util.test_base.TestBase):
     self.assertEqual(node.revision, 12)
 
     # Test adding a child to an empty node.
-    node.add_child('foo', 1)
-    self.assertEqual(node.to_value(), {'foo': 1})
-    self.assertEqual(node.child('foo').to_value(), 1)
-    self.assertEqual(node.child('foo').revision, node.revision)
-    self.assertEqual(node.children(), ['foo'])
+    foo = node.with_child(13, 'foo', monitor.status._Node(13, 1))
+    self.assertEqual(foo.to_value(), {'foo': 1})
+    self.assertEqual(foo.child('foo').to_value(), 1)
+    self.assertEqual(foo.revision, 13)
+    self.assertEqual(foo.child('foo').revision, 13)
+    self.assertEqual(foo.children(), ['foo'])
 
     # Add a second child.
-    node.add_child('bar', 2)
-    self.assertEqual(node.to_value(), {'foo': 1, 'bar': 2})
-    self.assertEqual(node.child('foo').to_value(), 1)
-    self.assertEqual(node.child('bar').to_value(), 2)
-    self.assertEqual(node.child('foo').revision, node.revision)
-    self.assertEqual(node.child('bar').revision, node.revision)
-    self.assertEqual(node.children(), ['foo', 'bar'])
+    bar = foo.with_child(14, 'bar', monitor.status._Node(14, 2))
+    self.assertEqual(bar.to_value(), {'foo': 1, 'bar': 2})
+    self.assertEqual(bar.revision, 14)
+    self.assertEqual(bar.child('foo').revision, 13)
+    self.assertEqual(bar.child('bar').revision, 14)
+    self.assertEqual(sorted(bar.children()), ['bar', 'foo'])
+
+    # The unchanged child is shared, not copied.
+    self.assertIs(bar.child('foo'), foo.child('foo'))
 
     # Replace a child.
-    node.add_child('bar', 3)
-    self.assertEqual(node.to_value(), {'foo': 1, 'bar': 3})
-    self.assertEqual(node.child('foo').to_value(), 1)
-    self.assertEqual(node.child('bar').to_value(), 3)
-    self.assertEqual(node.child('foo').revision, node.revision)
-    self.assertEqual(node.child('bar').revision, node.revision)
-    self.assertEqual(node.children(), ['foo', 'bar'])
-
-    # Remove a child.
-    node.remove_child('bar')
-    self.assertEqual(node.to_value(), {'foo': 1})
-    self.assertEqual(node.child('foo').to_value(), 1)
-    self.assertEqual(node.child('foo').revision, node.revision)
-    self.assertEqual(node.children(), ['foo'])
-
-    # Remove a non-existent child.
-    self.assertRaises(KeyError, node.remove_child, 'bar')
-    self.assertEqual(node.to_value(), {'foo': 1})
-    self.assertEqual(node.child('foo').to_value(), 1)
-    self.assertEqual(node.child('foo').revision, node.revision)
-    self.assertEqual(node.children(), ['foo'])
+    replaced = bar.with_child(15, 'bar', monitor.status._Node(15, 3))
+    self.assertEqual(replaced.to_value(), {'foo': 1, 'bar': 3})
+    self.assertEqual(replaced.child('bar').revision, 15)
 
     # Try to fetch a non-existent child.
-    self.assertRaises(KeyError, node.child, 'nonexistant')
+    self.assertRaises(KeyError, replaced.child, 'nonexistant')
 
-    # None of these operations should have modified the base revision.
+    # None of these operations should have modified the original nodes.
     self.assertEqual(node.revision, 12)
+    self.assertEqual(node.to_value(), {})
+    self.assertEqual(foo.to_value(), {'foo': 1})
+    self.assertEqual(bar.to_value(), {'foo': 1, 'bar': 2})
+    self.assertEqual(replaced.to_value(), {'foo': 1, 'bar': 3})
+
+  def test_merge(self):
+    node = monitor.status._Node(12, {'same': 1,
+                                     'changed': 2,
+                                     'removed': 3,
+                                     'sub': {'same': 4, 'changed': 5},
+                                     'unchanged_sub': {'same': 6}})
+
+    # An identical value returns the original node.
+    self.assertIs(node.merge(13, node.to_value()), node)
+
+    merged = node.merge(13, {'same': 1,
+                             'changed': 20,
+                             'added': 7,
+                             'sub': {'same': 4, 'changed': 50},
+                             'unchanged_sub': {'same': 6}})
+
+    self.assertEqual(merged.to_value(), {'same': 1,
+                                         'changed': 20,
+                                         'added': 7,
+                                         'sub': {'same': 4, 'changed': 50},
+                                         'unchanged_sub': {'same': 6}})
+    self.assertEqual(merged.revision, 13)
+    self.assertEqual(merged.child('same').revision, 12)
+    self.assertEqual(merged.child('changed').revision, 13)
+    self.assertEqual(merged.child('added').revision, 13)
+    self.assertEqual(merged.child('sub').revision, 13)
+    self.assertEqual(merged.child('sub').child('same').revision, 12)
+    self.assertEqual(merged.child('sub').child('changed').revision, 13)
+    self.assertIs(merged.child('unchanged_sub'), node.child('unchanged_sub'))
+
+    # Removing a key is a change.
+    removed = node.merge(14, {'same': 1})
+    self.assertEqual(removed.to_value(), {'same': 1})
+    self.assertEqual(removed.revision, 14)
+    self.assertEqual(removed.child('same').revision, 12)
+
+    # Switching between dictionaries and plain values is a change.
+    self.assertEqual(node.merge(15, 'foo').to_value(), 'foo')
+    self.assertEqual(node.child('same').merge(15, {}).to_value(), {})
+    self.assertEqual(node.child('same').merge(15, {}).revision, 15)
+
+  def test_to_json(self):
+    value = {'a': 1, 'b': {'c': [1, {'d': 'e'}], 'empty': {}},
+             u'\u00e9': u'\u00e9', 'none': None}
+    node = monitor.status._Node(12, value)
+
+    expected = json.dumps(value, sort_keys=True, indent=4)
+    self.assertEqual(node.to_json(), expected)
+    self.assertEqual(node.to_json(2).replace('\n' + ' ' * 8, '\n'), expected)
+    self.assertEqual(monitor.status._Node(12, 'a').to_json(), '"a"')
+
+    # Updated nodes reuse the serialization of unchanged children.
+    b_json = node.child('b').to_json(1)
+    updated = node.with_child(15, 'a', monitor.status._Node(15, 2))
+    self.assertIs(updated.child('b').to_json(1), b_json)
+    value['a'] = 2
+    self.assertEqual(updated.to_json(),
+                     json.dumps(value, sort_keys=True, indent=4))
+
+  def test_to_compact_json(self):
+    value = {'a': 1, 'b': {'c': [1, {'d': 'e'}], 'empty': {}},
+             u'\u00e9': u'\u00e9', 'none': None}
+    node = monitor.status._Node(12, value)
+
+    expected = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    self.assertEqual(node.to_compact_json(), expected)
+    self.assertEqual(monitor.status._Node(12, 'a').to_compact_json(), '"a"')
+
+    # Both encodings are cached side by side.
+    self.assertEqual(node.to_json(), json.dumps(value, sort_keys=True,
+                                                indent=4))
+    self.assertIs(node.to_compact_json(), node.to_compact_json())
+
+    # Updated nodes reuse the serialization of unchanged children.
+    b_json = node.child('b').to_compact_json()
+    updated = node.with_child(15, 'a', monitor.status._Node(15, 2))
+    self.assertIs(updated.child('b').to_compact_json(), b_json)
+
+  def test_compact(self):
+    """Nodes have no __dict__, and share their keys."""
+    first = monitor.status._Node(12, json.loads('{"host": {"value": 1}}'))
+    second = monitor.status._Node(13, json.loads('{"value": 2, "\\u00e9": 3}'))
+
+    self.assertFalse(hasattr(first, '__dict__'))
+
+    first_key = [k for k in first.child('host').children()][0]
+    second_key = [k for k in second.children() if k == 'value'][0]
+    self.assertIs(first_key, second_key)
+    self.assertIsInstance(first_key, str)
+
+    # Keys that can't be str are left alone.
+    self.assertEqual(second.child(u'\u00e9').to_value(), 3)
+
+  def test_frozen_values(self):
+    """Values handed out by nodes can't be modified."""
+    node = monitor.status._Node(12, {'list': [1, {'a': 2}], 'dict': {'b': 3}})
+    value = node.to_value()
+
+    self.assertRaises(TypeError, value.__setitem__, 'new', 1)
+    self.assertRaises(TypeError, value.pop, 'list')
+    self.assertRaises(TypeError, value['dict'].update, {'c': 4})
+    self.assertRaises(TypeError, value['list'].append, 1)
+    self.assertRaises(TypeError, value['list'][1].__setitem__, 'a', 5)
+
+    # Unchanged nodes return the same value, without copying.
+    self.assertIs(node.to_value(), value)
+
+    # Deep copies are ordinary, modifiable values.
+    mutable = copy.deepcopy(value)
+    self.assertIs(type(mutable), dict)
+    self.assertIs(type(mutable['list']), list)
+    self.assertIs(type(mutable['list'][1]), dict)
+    mutable['list'].append(1)
+    self.assertEqual(value, {'list': [1, {'a': 2}], 'dict': {'b': 3}})
 
 
 class TestStatus(monitor.util.test_base.TestBase):
@@ -157,11 +266,28 @@ class TestStatus(monitor.util.test_base.TestBase):
                       status.get, 'status://list/1')
 
 
-    # Ensure values copied out are copied, not referenced.
+    # Ensure values handed out can't be used to modify the status.
     l = status.get('status://list')
-    l.append(1)
+    self.assertRaises(TypeError, l.append, 1)
     self.assertEqual(status.get('status://list'), [5, 6, 7])
 
+  def test_get_depth(self):
+    status = self._create_status({
+        'int': 1,
+        'dict': {'sub1': {'leaf': 2}, 'sub2': 3},
+    })
+    status.set('status://dict/sub2', 4)
+
+    self.assertEqual(status.get(depth=0), {'int': 1, 'dict': 2})
+    self.assertEqual(status.get(depth=1),
+                     {'int': 1, 'dict': {'sub1': 1, 'sub2': 2}})
+    self.assertEqual(status.get(depth=2),
+                     {'int': 1, 'dict': {'sub1': {'leaf': 1}, 'sub2': 4}})
+    self.assertEqual(status.get(depth=3), status.get())
+    self.assertEqual(status.get('status://dict/sub1', depth=0), {'leaf': 1})
+    self.assertEqual(status.get('status://int', depth=0), 1)
+    self.assertIsNone(status.get('status://missing', depth=0))
+
   def test_get_matching(self):
     contents = {
         'match1': {'foo': 1},
@@ -298,6 +424,617 @@ class TestStatus(monitor.util.test_base.TestBase):
 
 
 
+  def test_set_shares_unchanged(self):
+    """Test Status.set() only replaces the path to the changed value."""
+    status = self._create_status({
+        'deep1': {'foo': {'bar': 1}},
+        'deep2': {'sub1': {'foo': 2}, 'sub2': {'foo': 3}},
+    })
+
+    before = status.get()
+    deep1 = status.get('status://deep1')
+    sub2 = status.get('status://deep2/sub2')
+
+    status.set('status://deep2/sub1/foo', 4)
+
+    # Values fetched earlier are not modified.
+    self.assertEqual(before['deep2']['sub1']['foo'], 2)
+
+    # Unchanged subtrees are shared, not copied.
+    self.assertIs(status.get('status://deep1'), deep1)
+    self.assertIs(status.get('status://deep2/sub2'), sub2)
+    self.assertEqual(status.get('status://deep2/sub1/foo'), 4)
+
+  def test_set_merge(self):
+    status = self._create_status({
+        'adapter': {'host1': {'a': 1, 'b': 2},
+                    'host2': {'a': 3, 'b': 4}},
+        'other': 5,
+    })
+
+    d_host1 = status.deferred(url='status://adapter/host1')
+    d_host2 = status.deferred(url='status://adapter/host2')
+
+    status.set('status://adapter',
+               {'host1': {'a': 1, 'b': 2},
+                'host2': {'a': 3, 'b': 40}},
+               merge=True)
+
+    self.assertEqual(status.get('status://adapter'),
+                     {'host1': {'a': 1, 'b': 2},
+                      'host2': {'a': 3, 'b': 40}})
+    self.assertEqual(status.revision(), 2)
+    self.assertEqual(status.revision('status://adapter'), 2)
+    self.assertEqual(status.revision('status://adapter/host1'), 1)
+    self.assertEqual(status.revision('status://adapter/host2'), 2)
+    self.assertEqual(status.revision('status://adapter/host2/a'), 1)
+    self.assertEqual(status.revision('status://adapter/host2/b'), 2)
+
+    # Only watchers of changed values are notified.
+    self.assertFalse(d_host1.called)
+    self.assertTrue(d_host2.called)
+
+    # Merging an identical value is not a change.
+    status.set('status://adapter',
+               {'host1': {'a': 1, 'b': 2},
+                'host2': {'a': 3, 'b': 40}},
+               merge=True)
+    self.assertEqual(status.revision(), 2)
+
+    # Merging into a non-existent url creates it.
+    status.set('status://new/sub', {'a': 1}, merge=True)
+    self.assertEqual(status.get('status://new'), {'sub': {'a': 1}})
+    self.assertEqual(status.revision('status://new/sub/a'), 3)
+
+  def test_set_many(self):
+    status = self._create_status()
+
+    status.set_many({'status://int': 10,
+                     'status://dict/sub1': 5,
+                     'status://new/sub': 'foo'})
+
+    self.assertEqual(status.get('status://'),
+                     {'int': 10,
+                      'list': [],
+                      'dict': {'sub1': 5, 'sub2': 4},
+                      'new': {'sub': 'foo'}})
+
+    # All values were updated with a single revision.
+    self.assertEqual(status.revision(), 2)
+    self.assertEqual(status.revision('status://int'), 2)
+    self.assertEqual(status.revision('status://dict/sub1'), 2)
+    self.assertEqual(status.revision('status://dict/sub2'), 1)
+    self.assertEqual(status.revision('status://new/sub'), 2)
+    self.assertEqual(status.revision('status://list'), 1)
+
+    # Unchanged values don't create a revision.
+    status.set_many({'status://int': 10, 'status://dict/sub1': 5})
+    self.assertEqual(status.revision(), 2)
+
+  def test_compare_and_set(self):
+    status = self._create_status()
+    status.set('status://dict/sub1', 5)
+
+    # Matching revisions (of the url, or a parent) and unchecked urls.
+    status.compare_and_set({'status://int': (1, 10),
+                            'status://dict/sub1': (2, 6),
+                            'status://new/sub': (2, 'foo'),
+                            'status://list': (None, [1])})
+
+    self.assertEqual(status.get('status://'),
+                     {'int': 10,
+                      'list': [1],
+                      'dict': {'sub1': 6, 'sub2': 4},
+                      'new': {'sub': 'foo'}})
+
+    # All values were updated with a single revision.
+    self.assertEqual(status.revision(), 3)
+    self.assertEqual(status.revision('status://int'), 3)
+    self.assertEqual(status.revision('status://new/sub'), 3)
+    self.assertEqual(status.revision('status://dict/sub2'), 1)
+
+    # One stale revision means nothing is written.
+    self.assertRaises(monitor.status.RevisionMismatch,
+                      status.compare_and_set,
+                      {'status://int': (3, 11),
+                       'status://dict/sub2': (2, 12)})
+    self.assertEqual(status.get('status://int'), 10)
+    self.assertEqual(status.get('status://dict/sub2'), 4)
+    self.assertEqual(status.revision(), 3)
+
+  def test_transaction(self):
+    status = self._create_status()
+
+    with status.transaction():
+      status.set('status://int', 10)
+      status.set('status://dict/sub1', 5)
+
+      # Values are visible inside the transaction.
+      self.assertEqual(status.get('status://int'), 10)
+
+      # Nested transactions are part of the outer transaction.
+      with status.transaction():
+        status.set('status://dict/sub2', 6)
+
+    self.assertEqual(status.get('status://'),
+                     {'int': 10, 'list': [], 'dict': {'sub1': 5, 'sub2': 6}})
+    self.assertEqual(status.revision(), 2)
+    self.assertEqual(status.revision('status://dict/sub2'), 2)
+
+    # The next change gets the next revision.
+    status.set('status://int', 11)
+    self.assertEqual(status.revision(), 3)
+
+  def test_transaction_exception(self):
+    status = self._create_status()
+
+    def failed_transaction():
+      with status.transaction():
+        status.set('status://int', 10)
+        status.set('status://new', 'foo')
+        raise ValueError()
+
+    d = status.deferred(url='status://int')
+
+    self.assertRaises(ValueError, failed_transaction)
+
+    # Nothing changed, and no one was notified.
+    self.assertEqual(status.get('status://'),
+                     {'int': 2, 'list': [], 'dict': {'sub1': 3, 'sub2': 4}})
+    self.assertEqual(status.revision(), 1)
+    self.assertFalse(d.called)
+
+    # Revisions continue normally after a failed transaction.
+    status.set('status://int', 10)
+    self.assertEqual(status.revision(), 2)
+
+  def test_changes_since(self):
+    status = self._create_status({'int': 1, 'deep': {'foo': 2, 'bar': 3}})
+
+    # No changes yet.
+    self.assertEqual(status.changes_since(1), [])
+
+    status.set('status://int', 10)
+    status.set('status://deep/foo', 20)
+    status.set('status://new/sub/sub', 'created')
+    with status.transaction():
+      status.set('status://deep/bar', 30)
+      status.set('status://int', 11)
+
+    self.assertEqual(status.revision(), 5)
+    self.assertEqual(status.changes_since(1),
+                     [(2, 'status://int', 10),
+                      (3, 'status://deep/foo', 20),
+                      (4, 'status://new', {'sub': {'sub': 'created'}}),
+                      (5, 'status://deep/bar', 30),
+                      (5, 'status://int', 11)])
+    self.assertEqual(status.changes_since(4),
+                     [(5, 'status://deep/bar', 30),
+                      (5, 'status://int', 11)])
+    self.assertEqual(status.changes_since(5), [])
+
+    # Only changes overlapping the url are returned.
+    self.assertEqual(status.changes_since(1, 'status://deep'),
+                     [(3, 'status://deep/foo', 20),
+                      (5, 'status://deep/bar', 30)])
+    self.assertEqual(status.changes_since(1, 'status://deep/foo'),
+                     [(3, 'status://deep/foo', 20)])
+    self.assertEqual(status.changes_since(1, 'status://deep/*'),
+                     [(3, 'status://deep/foo', 20),
+                      (5, 'status://deep/bar', 30)])
+
+    # Changes to top level values could create a match for the wildcard.
+    self.assertEqual(status.changes_since(1, 'status://*/bar'),
+                     [(2, 'status://int', 10),
+                      (4, 'status://new', {'sub': {'sub': 'created'}}),
+                      (5, 'status://deep/bar', 30),
+                      (5, 'status://int', 11)])
+    self.assertEqual(status.changes_since(1, 'status://new/sub/sub'),
+                     [(4, 'status://new', {'sub': {'sub': 'created'}})])
+
+    # A change to a parent overlaps its children.
+    status.set('status://deep', {'foo': 21})
+    self.assertEqual(status.changes_since(5, 'status://deep/foo'),
+                     [(6, 'status://deep', {'foo': 21})])
+
+    # Unknown revisions.
+    self.assertEqual(status.changes_since(0), None)
+    self.assertEqual(status.changes_since(7), None)
+
+  def test_changes_since_window(self):
+    status = self._create_status({'int': 1})
+    status.JOURNAL_SIZE = 3
+
+    for i in xrange(2, 6):
+      status.set('status://int', i)
+
+    # Revision 2 was forgotten, so changes since 1 are unknown.
+    self.assertEqual(status.revision(), 5)
+    self.assertEqual(status.changes_since(1), None)
+    self.assertEqual(status.changes_since(2),
+                     [(3, 'status://int', 3),
+                      (4, 'status://int', 4),
+                      (5, 'status://int', 5)])
+
+  def test_changes_since_failed_transaction(self):
+    status = self._create_status({'int': 1})
+
+    def failed_transaction():
+      with status.transaction():
+        status.set('status://int', 10)
+        raise ValueError()
+
+    self.assertRaises(ValueError, failed_transaction)
+    self.assertEqual(status.changes_since(1), [])
+
+  def _apply_patch(self, value, patch):
+    """Apply a JSON Patch, as produced by patch_since()."""
+    value = copy.deepcopy(value)
+    for operation in patch:
+      keys = [k.replace('~1', '/').replace('~0', '~')
+              for k in operation['path'].split('/')[1:]]
+      if not keys:
+        value = copy.deepcopy(operation['value'])
+        continue
+      parent = value
+      for key in keys[:-1]:
+        parent = parent[key]
+      if operation['op'] == 'remove':
+        del parent[keys[-1]]
+      else:
+        parent[keys[-1]] = copy.deepcopy(operation['value'])
+    return value
+
+  def test_patch_since(self):
+    status = self._create_status({'int': 1,
+                                  'deep': {'foo': 2, 'bar': 3, 'a/b': 4}})
+    values = {1: copy.deepcopy(status.get())}
+
+    # No changes yet.
+    self.assertEqual(status.patch_since(1), [])
+
+    status.set('status://deep/foo', 20)
+    status.set('status://deep/a/b', 40)
+    status.set('status://deep', {'foo': 20, 'baz': 5, 'a': {'b': 40}})
+    status.set('status://deep', {'baz': 5, 'extra': 6, 'a': {'b': 40}},
+               merge=True)
+    with status.transaction():
+      status.set('status://new/sub', 'created')
+      status.set('status://int', [1, 2])
+      status.set('status://deep/baz', None)
+    self.assertEqual(status.revision(), 6)
+
+    # Only what changed is in the patch, even when a whole subtree was set.
+    self.assertEqual(status.patch_since(1, 'status://deep'), [
+        {'op': 'remove', 'path': '/a~1b'},
+        {'op': 'remove', 'path': '/bar'},
+        {'op': 'remove', 'path': '/foo'},
+        {'op': 'add', 'path': '/a', 'value': {'b': 40}},
+        {'op': 'add', 'path': '/baz', 'value': None},
+        {'op': 'add', 'path': '/extra', 'value': 6}])
+    self.assertEqual(status.patch_since(4, 'status://deep'), [
+        {'op': 'remove', 'path': '/foo'},
+        {'op': 'replace', 'path': '/baz', 'value': None},
+        {'op': 'add', 'path': '/extra', 'value': 6}])
+    self.assertEqual(status.patch_since(5), [
+        {'op': 'replace', 'path': '/deep/baz', 'value': None},
+        {'op': 'replace', 'path': '/int', 'value': [1, 2]},
+        {'op': 'add', 'path': '/new', 'value': {'sub': 'created'}}])
+    self.assertEqual(status.patch_since(5, 'status://int'),
+                     [{'op': 'replace', 'path': '', 'value': [1, 2]}])
+    self.assertEqual(status.patch_since(6), [])
+
+    # Patches recreate the current status.
+    self.assertEqual(self._apply_patch(values[1], status.patch_since(1)),
+                     status.get())
+
+    # Unknown revisions, and urls that didn't exist.
+    self.assertEqual(status.patch_since(0), None)
+    self.assertEqual(status.patch_since(7), None)
+    self.assertEqual(status.patch_since(5, 'status://new'), None)
+
+  def test_patch_since_window(self):
+    status = self._create_status({'int': 1})
+    status.JOURNAL_SIZE = 3
+
+    for i in xrange(2, 6):
+      status.set('status://int', i)
+
+    # Revision 2 is the oldest remembered.
+    self.assertEqual(status.patch_since(1), None)
+    self.assertEqual(status.patch_since(2),
+                     [{'op': 'replace', 'path': '/int', 'value': 5}])
+
+    # As is the restored revision, after a restore.
+    status.restore({'int': 6}, 10)
+    self.assertEqual(status.patch_since(5), None)
+    self.assertEqual(status.patch_since(10), [])
+
+  def test_patch_since_failed_transaction(self):
+    status = self._create_status({'int': 1})
+
+    def failed_transaction():
+      with status.transaction():
+        status.set('status://int', 10)
+        raise ValueError()
+
+    self.assertRaises(ValueError, failed_transaction)
+    status.set('status://int', 2)
+    self.assertEqual(status.patch_since(1),
+                     [{'op': 'replace', 'path': '/int', 'value': 2}])
+
+  def test_listener(self):
+    status = self._create_status({'int': 1})
+    changes = []
+    listener = lambda *change: changes.append(change)
+    status.add_listener(listener)
+
+    status.set('status://int', 2)
+    status.set('status://int', 2)
+    status.set_many({'status://a': 'a', 'status://b': 'b'})
+    self.assertEqual(changes, [(2, 'status://int', 2),
+                               (3, 'status://a', 'a'),
+                               (3, 'status://b', 'b')])
+
+    # Failed transactions are never seen.
+    def failed_transaction():
+      with status.transaction():
+        status.set('status://int', 10)
+        raise ValueError()
+
+    self.assertRaises(ValueError, failed_transaction)
+    self.assertEqual(len(changes), 3)
+
+    status.remove_listener(listener)
+    status.set('status://int', 3)
+    self.assertEqual(len(changes), 3)
+
+  def test_listener_failure(self):
+    status = self._create_status({'int': 1})
+    changes = []
+
+    def failing_listener(*_change):
+      raise IOError('Disk full')
+
+    status.add_listener(failing_listener)
+    status.add_listener(lambda *change: changes.append(change))
+    d = status.deferred(url='status://int')
+
+    # The change is still made, and everyone else is told about it.
+    status.set('status://int', 2)
+    self.assertEqual(status.get('status://int'), 2)
+    self.assertEqual(changes, [(2, 'status://int', 2)])
+    self.assertTrue(d.called)
+
+  def test_get_matching_components(self):
+    """status://*/<type>/<name> urls are found through the component index."""
+    status = self._create_status({
+        'a1': {'button': {'b1': {}, 'b2': {}}, 'host': {'h1': {'up': True}}},
+        'a2': {'button': {'b1': {}}},
+        'a3': 'not a dict',
+    })
+
+    def _validate(url, expected_urls):
+      self.assertEqual(sorted(status.get_matching_urls(url)),
+                       sorted(expected_urls))
+      # Matches an exhaustive search.
+      pattern = monitor.status._compile_pattern(url)
+      self.assertEqual(sorted(u for u, _ in pattern.match(status._node)),
+                       sorted(expected_urls))
+
+    _validate('status://*/button/b1',
+              ['status://a1/button/b1', 'status://a2/button/b1'])
+    _validate('status://*/button/*', ['status://a1/button/b1',
+                                      'status://a1/button/b2',
+                                      'status://a2/button/b1'])
+    _validate('status://*/host/*/up', ['status://a1/host/h1/up'])
+    _validate('status://*/host/*/down', [])
+    _validate('status://*/button/b3', [])
+    _validate('status://*/rule/*', [])
+
+    # Components added and replaced at each depth are indexed.
+    status.set('status://a2/button/b3', {})
+    status.set('status://a3', {'button': {'b3': {}}})
+    status.set('status://a4/rule/r1', {})
+    _validate('status://*/button/b3',
+              ['status://a2/button/b3', 'status://a3/button/b3'])
+    _validate('status://*/rule/*', ['status://a4/rule/r1'])
+
+    status.set('status://a1/button', {'b3': {}})
+    status.set('status://a2', {})
+    _validate('status://*/button/*',
+              ['status://a1/button/b3', 'status://a3/button/b3'])
+
+    # Failed transactions are forgotten.
+    def failed_transaction():
+      with status.transaction():
+        status.set('status://a1/button/b4', {})
+        status.set('status://a3', {})
+        raise ValueError()
+
+    self.assertRaises(ValueError, failed_transaction)
+    _validate('status://*/button/*',
+              ['status://a1/button/b3', 'status://a3/button/b3'])
+
+    # As is everything, when the status is replaced.
+    status.set('status://', {'a5': {'button': {'b1': {}}}})
+    _validate('status://*/button/*', ['status://a5/button/b1'])
+    status.restore({'a6': {'button': {'b2': {}}}}, 20)
+    _validate('status://*/button/*', ['status://a6/button/b2'])
+
+  def test_set_ttl(self):
+    clock = task.Clock()
+    status = monitor.status.Status({'int': 1, 'dict': {'a': 1}}, clock=clock)
+
+    status.set('status://int', 2, ttl=10)
+    status.set('status://new', 3, ttl=20)
+    d = status.deferred(url='status://int')
+
+    clock.advance(9)
+    self.assertEqual(status.get('status://int'), 2)
+    self.assertFalse(d.called)
+
+    clock.advance(1)
+    self.assertIsNone(status.get('status://int'))
+    self.assertEqual(status.get('status://new'), 3)
+    self.assertTrue(d.called)
+
+    clock.advance(10)
+    self.assertIsNone(status.get('status://new'))
+
+    # Setting the same value again restarts the ttl, without one removes it.
+    status.set('status://int', 2, ttl=10)
+    status.set('status://dict', {'a': 1}, ttl=10)
+    clock.advance(5)
+    status.set('status://int', 2, ttl=10)
+    status.set('status://dict', {'a': 1}, merge=True)
+    clock.advance(5)
+    self.assertEqual(status.get('status://int'), 2)
+    self.assertEqual(status.get('status://dict'), {'a': 1})
+    clock.advance(5)
+    self.assertIsNone(status.get('status://int'))
+
+    # A value that changed in the meantime doesn't expire.
+    status.set('status://dict', {'a': 2}, ttl=10)
+    status.set('status://dict/a', 3)
+    clock.advance(10)
+    self.assertEqual(status.get('status://dict'), {'a': 3})
+
+  def test_set_ttl_transaction(self):
+    clock = task.Clock()
+    status = monitor.status.Status({'int': 1}, clock=clock)
+
+    def failed_transaction():
+      with status.transaction():
+        status.set('status://int', 2, ttl=10)
+        raise ValueError()
+
+    self.assertRaises(ValueError, failed_transaction)
+    clock.advance(10)
+    self.assertEqual(status.get('status://int'), 1)
+
+    with status.transaction():
+      status.set('status://int', 3, ttl=10)
+      status.set('status://other', 4, ttl=20)
+    clock.advance(10)
+    self.assertIsNone(status.get('status://int'))
+    self.assertEqual(status.get('status://other'), 4)
+
+    # Restoring the status forgets pending expirations.
+    status.restore({'other': 4}, 10)
+    clock.advance(10)
+    self.assertEqual(status.get('status://other'), 4)
+    self.assertEqual(clock.getDelayedCalls(), [])
+
+  def test_set_ttl_invalid(self):
+    clock = task.Clock()
+    status = monitor.status.Status({'int': 1}, clock=clock)
+    d = status.deferred()
+
+    # Nothing changes if the ttl can't be used.
+    for ttl in (float('nan'), float('inf'), -1, True, '5'):
+      self.assertRaises(ValueError, status.set, 'status://int', 2, ttl=ttl)
+      self.assertRaises(ValueError, status.set, 'status://new', 2, ttl=ttl)
+    self.assertEqual(status.get(), {'int': 1})
+    self.assertEqual(status.revision(), 1)
+    self.assertFalse(d.called)
+
+    def failed_transaction():
+      with status.transaction():
+        status.set('status://int', 2)
+        status.set('status://int', 3, ttl=float('nan'))
+
+    self.assertRaises(ValueError, failed_transaction)
+    self.assertEqual(status.get(), {'int': 1})
+    self.assertEqual(status.revision(), 1)
+    self.assertFalse(d.called)
+
+  def test_expiries(self):
+    clock = task.Clock()
+    clock.advance(100)
+    status = monitor.status.Status({'a': {'b': 1}, 'c': 2}, clock=clock)
+
+    status.set('status://a/b', 3, ttl=10)
+    status.set('status://c', 4, ttl=20)
+    self.assertEqual(status.expiries(),
+                     {'status://a/b': 110, 'status://c': 120})
+    self.assertEqual(status.expiries('status://a'), {'status://a/b': 110})
+
+    # Restored expirations use the saved times, not the ttl.
+    clock.advance(5)
+    status.restore({'a': {'b': 3}, 'c': 4}, 10)
+    self.assertEqual(status.expiries(), {})
+    status.restore_expiries({'status://a/b': 110, 'status://c': 90,
+                             'status://missing': 110})
+    self.assertEqual(status.expiries(),
+                     {'status://a/b': 110, 'status://c': 105})
+
+    clock.advance(1)
+    self.assertEqual(status.get(), {'a': {'b': 3}, 'c': None})
+    clock.advance(4)
+    self.assertEqual(status.get(), {'a': {'b': None}, 'c': None})
+
+  def test_replaced_nodes_drop_caches(self):
+    status = self._create_status({'int': 1, 'dict': {'sub1': 2, 'sub2': 3}})
+    snapshot = status.snapshot()
+    value = snapshot.get()
+    json_value = snapshot.get_json()
+    old_root = snapshot._node
+    old_dict = old_root.child('dict')
+
+    status.set('status://dict/sub1', 4)
+
+    # The replaced nodes forget their caches, the shared ones keep them.
+    for node in (old_root, old_dict, old_dict.child('sub1')):
+      self.assertIsNone(node._value)
+      self.assertIsNone(node._json)
+    shared = old_dict.child('sub2')
+    self.assertIs(shared, status._node.child('dict').child('sub2'))
+    self.assertIsNotNone(shared._json)
+
+    # The old revision can still be read.
+    self.assertEqual(snapshot.get(), value)
+    self.assertEqual(snapshot.get_json(), json_value)
+
+  def test_snapshot(self):
+    status = self._create_status({'int': 1, 'dict': {'sub1': 2, 'sub2': 3}})
+    snapshot = status.snapshot()
+
+    status.set('status://int', 4)
+    status.set('status://dict/sub3', 5)
+
+    # The snapshot doesn't see later changes.
+    self.assertEqual(snapshot.get(),
+                     {'int': 1, 'dict': {'sub1': 2, 'sub2': 3}})
+    self.assertEqual(snapshot.revision(), 1)
+    self.assertEqual(snapshot.revision('status://dict/sub1'), 1)
+    self.assertEqual(sorted(snapshot.get_matching_urls('status://dict/*')),
+                     ['status://dict/sub1', 'status://dict/sub2'])
+    self.assertEqual(snapshot.get_json('status://int'), '1')
+    self.assertIsNone(snapshot.get('status://dict/sub3'))
+    self.assertRaises(monitor.status.UnknownUrl,
+                      snapshot.revision, 'status://dict/sub3')
+    self.assertFalse(hasattr(snapshot, 'set'))
+
+    self.assertEqual(status.snapshot().get(), status.get())
+    self.assertEqual(status.snapshot().revision(), 3)
+
+  def test_restore(self):
+    status = self._create_status({'int': 1})
+    d = status.deferred(url='status://int')
+
+    status.restore({'int': 5, 'dict': {'sub': 6}}, 10)
+    self.assertFalse(d.called)
+    self.assertEqual(status.get(), {'int': 5, 'dict': {'sub': 6}})
+    self.assertEqual(status.revision(), 10)
+    self.assertEqual(status.revision('status://dict/sub'), 10)
+    self.assertIsNone(status.changes_since(9))
+    self.assertEqual(status.changes_since(10), [])
+
+    status.set('status://int', 7)
+    self.assertEqual(status.revision('status://int'), 11)
+    self.assertTrue(d.called)
+
   def test_nested_revisions(self):
     """Test Status.revision() handles nested revision numbers."""
 
@@ -501,6 +1238,42 @@ class TestStatus(monitor.util.test_base.TestBase):
     self.assertEqual(status.revision('status://deep/foo'), 5)
     self.assertEqual(status.revision('status://deep/bar'), 6)
 
+  def test_metrics(self):
+    status = self._create_status()
+
+    def count(histogram, adapter):
+      counts = histogram._values.get((adapter,))
+      return sum(counts[:-1]) if counts else 0
+
+    adapters = ('', 'dict', 'new', 'unknown')
+    gets = {a: count(monitor.status._GET_SECONDS, a) for a in adapters}
+    sets = {a: count(monitor.status._SET_SECONDS, a) for a in adapters}
+
+    # Only some calls are timed, but each run of GET_SAMPLE gets (or
+    # SET_SAMPLE sets) of the same url is counted exactly.
+    for url in ('status://', 'status://dict/sub1', 'status://missing/sub1'):
+      for _ in xrange(status.GET_SAMPLE):
+        status.get(url)
+    for url in ('status://dict/sub1', 'status://new/sub1'):
+      for i in xrange(status.SET_SAMPLE):
+        status.set(url, i)
+
+    # Snapshots aren't timed.
+    status.snapshot().get('status://dict')
+
+    self.assertEqual(
+        {a: count(monitor.status._GET_SECONDS, a) - gets[a] for a in adapters},
+        {'': 64, 'dict': 64, 'new': 0, 'unknown': 64})
+    self.assertEqual(
+        {a: count(monitor.status._SET_SECONDS, a) - sets[a] for a in adapters},
+        {'': 0, 'dict': 16, 'new': 16, 'unknown': 0})
+
+    status.deferred(url='status://dict')
+    status.deferred(url='status://int')
+    self.assertEqual(status.pending_deferreds(), 2)
+    status.set('status://int', 3)
+    self.assertEqual(status.pending_deferreds(), 1)
+
   def test_helpers(self):
     status = self._create_status({
         'int': 2,
@@ -571,6 +1344,100 @@ class TestStatus(monitor.util.test_base.TestBase):
                 'status://nested/sub2/subsub1']))
 
 
+class TestPattern(monitor.util.test_base.TestBase):
+
+  def test_compile(self):
+    pattern = monitor.status._compile_pattern('status://foo/*/bar')
+    self.assertEqual(pattern.keys, ('foo', '*', 'bar'))
+    self.assertEqual(pattern.wildcards, (1,))
+    self.assertEqual(monitor.status._compile_pattern('status://').keys, ())
+    self.assertRaises(monitor.status.BadUrl,
+                      monitor.status._compile_pattern, 'foo/bar')
+
+    # Patterns are cached, until enough others are used.
+    self.assertIs(monitor.status._compile_pattern('status://foo/*/bar'),
+                  pattern)
+    with mock.patch('monitor.status._PATTERN_CACHE_SIZE', 2):
+      monitor.status._compile_pattern('status://a')
+      monitor.status._compile_pattern('status://b')
+    self.assertIsNot(monitor.status._compile_pattern('status://foo/*/bar'),
+                     pattern)
+
+  def test_match(self):
+    node = monitor.status._Node(12, {
+        'a': {'x': {'v': 1}, 'y': {'v': 2}, 'z': 3},
+        'b': {'x': {'w': 4}},
+    })
+
+    def _validate(url, expected):
+      pattern = monitor.status._compile_pattern(url)
+      self.assertEqual(
+          sorted((u, n.to_value()) for u, n in pattern.match(node)),
+          sorted(expected))
+
+    _validate('status://', [('status://', node.to_value())])
+    _validate('status://a/x/v', [('status://a/x/v', 1)])
+    _validate('status://a/x/missing', [])
+    _validate('status://a/z/v', [])
+    _validate('status://*/x', [('status://a/x', {'v': 1}),
+                               ('status://b/x', {'w': 4})])
+    _validate('status://a/*/v', [('status://a/x/v', 1),
+                                 ('status://a/y/v', 2)])
+    _validate('status://*/*/*', [('status://a/x/v', 1),
+                                 ('status://a/y/v', 2),
+                                 ('status://b/x/w', 4)])
+
+    # Matching can start part way down.
+    pattern = monitor.status._compile_pattern('status://*/x/*')
+    x_node = node.child('a').child('x')
+    self.assertEqual(list(pattern.match(x_node, 2, ('a', 'x'))),
+                     [('status://a/x/v', x_node.child('v'))])
+
+
+class TestSubscriptions(monitor.util.test_base.TestBase):
+
+  def test_matching(self):
+    subscriptions = monitor.status._Subscriptions()
+    subscriptions.add([], 'root')
+    subscriptions.add(['foo'], 'foo')
+    subscriptions.add(['foo', 'bar'], 'foo/bar')
+    subscriptions.add(['foo', 'baz'], 'foo/baz')
+    subscriptions.add(['*', 'bar'], '*/bar')
+    subscriptions.add(['other', 'bar'], 'other/bar')
+    self.assertEqual(len(subscriptions), 6)
+
+    def _validate_result(keys, expected):
+      self.assertEqual(sorted(subscriptions.matching(keys)), sorted(expected))
+
+    _validate_result([], ['root', 'foo', 'foo/bar', 'foo/baz', '*/bar',
+                          'other/bar'])
+    _validate_result(['foo'], ['root', 'foo', 'foo/bar', 'foo/baz', '*/bar'])
+    _validate_result(['foo', 'bar'], ['root', 'foo', 'foo/bar', '*/bar'])
+    _validate_result(['foo', 'bar', 'deep'],
+                     ['root', 'foo', 'foo/bar', '*/bar'])
+    _validate_result(['foo', 'other'], ['root', 'foo'])
+    _validate_result(['other'], ['root', '*/bar', 'other/bar'])
+    _validate_result(['unrelated'], ['root', '*/bar'])
+    _validate_result(['unrelated', 'baz'], ['root'])
+
+  def test_remove(self):
+    subscriptions = monitor.status._Subscriptions()
+    subscriptions.add(['foo', 'bar'], 'first')
+    subscriptions.add(['foo', 'bar'], 'second')
+
+    subscriptions.remove(['foo', 'bar'], 'first')
+    self.assertEqual(subscriptions.matching(['foo']), set(['second']))
+
+    # Removing unknown watchers is harmless.
+    subscriptions.remove(['foo', 'bar'], 'first')
+    subscriptions.remove(['not', 'present'], 'first')
+
+    # Removing the last watcher prunes the empty branch.
+    subscriptions.remove(['foo', 'bar'], 'second')
+    self.assertEqual(len(subscriptions), 0)
+    self.assertEqual(subscriptions._children, {})
+
+
 class TestStatusDeferred(monitor.util.test_base.TestBase):
 
   def test_mismatch_revision_no_url(self):
@@ -729,6 +1596,92 @@ class TestStatusDeferred(monitor.util.test_base.TestBase):
     d.addCallback(self.assertEquals, [url])
     self.assertTrue(d.called)
 
+  def test_cancel(self):
+    status = self._create_status({'int': 2})
+
+    d = status.deferred(url='status://int')
+    self.assertEqual(len(status._notifications), 1)
+
+    # Cancelling stops watching, and later updates don't try to fire it.
+    d.addErrback(lambda failure: failure.trap(defer.CancelledError))
+    d.cancel()
+    self.assertEqual(len(status._notifications), 0)
+    status.set('status://int', 3)
+
+  def test_unrelated_not_checked(self):
+    """Only deferreds watching an overlapping url are examined."""
+    status = self._create_status({'foo': {'bar': 1}, 'other': 2})
+
+    d = status.deferred(url='status://other')
+    with mock.patch.object(d, 'changed', autospec=True) as changed:
+      status.set('status://foo/bar', 2)
+      self.assertFalse(changed.called)
+
+      status.set('status://', {'other': 3})
+      self.assertTrue(changed.called)
+
+  def test_predicate(self):
+    status = self._create_status({'int': 1, 'sub': {'a': 1, 'b': 1}})
+
+    d = status.deferred(url='status://int', predicate=lambda v: v > 5)
+    status.set('status://int', 3)
+    self.assertFalse(d.called)
+    status.set('status://int', 6)
+    self.assertEqual(d.result, ['status://int'])
+
+    # With wildcards, only the updated values are checked.
+    d = status.deferred(url='status://sub/*', predicate=lambda v: v == 2)
+    status.set('status://sub/a', 2)
+    self.assertTrue(d.called)
+
+    d = status.deferred(url='status://sub/*', predicate=lambda v: v == 2)
+    status.set('status://sub/b', 3)
+    status.set('status://sub/b', 4)
+    self.assertFalse(d.called)
+    status.set('status://sub/b', 2)
+    self.assertEqual(sorted(d.result), ['status://sub/a', 'status://sub/b'])
+
+    # Removed values are checked as None.
+    d = status.deferred(url='status://int', predicate=lambda v: v is None)
+    status.set('status://', {})
+    self.assertEqual(d.result, [])
+
+  def test_predicate_old_revision(self):
+    status = self._create_status({'int': 1})
+    status.set('status://int', 2)
+
+    # An outdated revision only calls back if the value is accepted.
+    d = status.deferred(1, 'status://int', predicate=lambda v: v == 3)
+    self.assertFalse(d.called)
+    status.set('status://int', 3)
+    self.assertTrue(d.called)
+
+    d = status.deferred(1, 'status://int', predicate=lambda v: v == 3)
+    self.assertTrue(d.called)
+
+  def test_transaction_notifies_once(self):
+    status = self._create_status({'foo': 1, 'bar': 1, 'other': 1})
+
+    d_root = status.deferred()
+    d_foo = status.deferred(url='status://foo')
+    d_other = status.deferred(url='status://other')
+
+    results = []
+    d_root.addCallback(results.append)
+
+    with status.transaction():
+      status.set('status://foo', 2)
+      status.set('status://bar', 2)
+      status.set('status://foo', 3)
+
+      # Nothing is notified until the transaction is complete.
+      self.assertFalse(d_root.called)
+      self.assertFalse(d_foo.called)
+
+    self.assertEqual(results, [['status://']])
+    self.assertTrue(d_foo.called)
+    self.assertFalse(d_other.called)
+
   def test_find_revisions(self):
     status = self._create_status({'sub1': 1, 'sub2': {'subsub': 2}})
 
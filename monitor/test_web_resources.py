@@ -2,14 +2,27 @@
 
 import monitor.web_resources
 
+import json
+import logging
 import unittest
+import zlib
 import mock
 
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import task
+from twisted.python import failure
+from twisted.python import threadable
+from twisted.test import proto_helpers
+from twisted.web import server
 from twisted.web.test.test_web import DummyRequest
-from twisted.python.urlpath import URLPath
 
 import monitor.adapter
+import monitor.util.log_buffer
+import monitor.util.metrics
+import monitor.util.watchdog
 import monitor.util.test_base
+from monitor.util.test_web_socket import client_frame
 
 # pylint: disable=W0212
 
@@ -64,19 +77,202 @@ class TestWebResourcesButton(monitor.util.test_base.TestBase):
                                     'status://adapter/button/foo/pushed')
 
 
+
+class TestWebResourcesLog(monitor.util.test_base.TestBase):
+  """Test /log handler."""
+
+  def setUp(self):
+    threadable.registerAsIOThread()
+    self.clock = task.Clock()
+    self.buffer = monitor.util.log_buffer.LogBuffer(clock=self.clock)
+    self.logger = logging.getLogger('test_web_resources_log')
+    self.logger.propagate = False
+    self.logger.addHandler(self.buffer)
+    self.resource = monitor.web_resources.Log(self.buffer)
+
+  def tearDown(self):
+    self.logger.removeHandler(self.buffer)
+
+  def _get(self, revision=None):
+    request = DummyRequest([])
+    if revision is not None:
+      request.addArg('revision', str(revision))
+    self.assertIs(self.resource.render(request), server.NOT_DONE_YET)
+    return request
+
+  def _response(self, request):
+    self.assertTrue(request.finished)
+    response = json.loads(''.join(request.written))
+    return response['revision'], [r['message'] for r in response['log']]
+
+  def test_log(self):
+    # Without a revision, everything is returned right away.
+    self.assertEqual(self._response(self._get()), (0, []))
+
+    self.logger.warning('first')
+    self.logger.warning('second')
+    self.assertEqual(self._response(self._get()), (2, ['first', 'second']))
+    self.assertEqual(self._response(self._get(1)), (2, ['second']))
+
+  def test_log_wait(self):
+    self.logger.warning('first')
+    request = self._get(1)
+    self.assertFalse(request.finished)
+
+    # Waiting clients are answered as soon as there is a new record.
+    self.logger.warning('second')
+    self.clock.advance(0)
+    self.assertEqual(self._response(request), (2, ['second']))
+
+  def test_log_disconnect(self):
+    request = self._get(0)
+    request.processingFailed(failure.Failure(error.ConnectionDone()))
+
+    self.logger.warning('first')
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+    self.assertEqual(request.written, [])
+
+
+
+class TestWebResourcesMetrics(monitor.util.test_base.TestBase):
+  """Test /metrics handler."""
+
+  def test_metrics(self):
+    registry = monitor.util.metrics.Registry()
+    registry.counter('things_total', 'Things.').inc()
+    resource = monitor.web_resources.Metrics(registry)
+
+    request = DummyRequest([])
+    d = self._render(resource, request)
+
+    def rendered(_):
+      self.assertEqual(request.responseHeaders.getRawHeaders('content-type'),
+                       ['text/plain; version=0.0.4'])
+      self.assertEqual(''.join(request.written), registry.render())
+
+    d.addCallback(rendered)
+    return d
+
+
+
+class TestWebResourcesWatchdog(monitor.util.test_base.TestBase):
+  """Test /watchdog handler."""
+
+  def test_watchdog(self):
+    clock = task.Clock()
+    watchdog = monitor.util.watchdog.ReactorWatchdog(threshold=0.5,
+                                                     interval=0.1, clock=clock)
+    watchdog.start(watch=False)
+    self.addCleanup(watchdog.stop)
+    resource = monitor.web_resources.Watchdog(watchdog)
+
+    def get():
+      request = DummyRequest([])
+      self.assertIs(resource.render(request), server.NOT_DONE_YET)
+      self.assertTrue(request.finished)
+      return json.loads(''.join(request.written))
+
+    self.assertEqual(get(), {'threshold': 0.5, 'stalls': []})
+
+    watchdog.check(clock.seconds() + 1)
+    clock.advance(1.1)
+    stalls = get()['stalls']
+    self.assertEqual(len(stalls), 1)
+    self.assertAlmostEqual(stalls[0]['seconds'], 1.0)
+    self.assertIn('in test_watchdog', '\n'.join(stalls[0]['stack']))
+
+
+
+class TestWebResourcesProfile(monitor.util.test_base.TestBase):
+  """Test /profile handler."""
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.resource = monitor.web_resources.Profile('secret', clock=self.clock)
+
+  def _get(self, args=None, token='secret', resource=None):
+    request = DummyRequest([])
+    for key, value in (args or {}).iteritems():
+      request.addArg(key, value)
+    if token:
+      request.requestHeaders.setRawHeaders('authorization',
+                                           ['Bearer %s' % token])
+    result = (resource or self.resource).render(request)
+    if result is not server.NOT_DONE_YET:
+      request.write(result)
+      request.finish()
+    return request
+
+  def test_auth(self):
+    disabled = monitor.web_resources.Profile(None, clock=self.clock)
+    self.assertEqual(self._get(resource=disabled).responseCode, 403)
+
+    for token in (None, 'wrong'):
+      request = self._get(token=token)
+      self.assertEqual(request.responseCode, 401)
+      self.assertEqual(
+          request.responseHeaders.getRawHeaders('www-authenticate'),
+          ['Bearer'])
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+
+  def test_bad_request(self):
+    for args in ({'seconds': '0'}, {'seconds': '1000'}, {'seconds': 'x'},
+                 {'format': 'bogus'}, {'sort': 'bogus'}):
+      self.assertEqual(self._get(args).responseCode, 400, args)
+
+  def test_pstats(self):
+    request = self._get({'seconds': '5'})
+    self.assertFalse(request.finished)
+    self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 5)
+
+    # Only one profile at a time.
+    self.assertEqual(self._get().responseCode, 409)
+
+    # Something to be profiled.
+    json.dumps({'profiled': True})
+    self.clock.advance(5)
+    self.assertTrue(request.finished)
+    self.assertEqual(request.responseHeaders.getRawHeaders('content-type'),
+                     ['text/plain'])
+    self.assertIn('(dumps)', ''.join(request.written))
+
+    # The next one can start. The sampler runs in real time, so it may not
+    # have any samples here.
+    request = self._get({'seconds': '1', 'format': 'collapsed'})
+    self.assertFalse(request.finished)
+    self.clock.advance(1)
+    self.assertTrue(request.finished)
+
+  def test_disconnect(self):
+    request = self._get({'format': 'collapsed'})
+    request.processingFailed(failure.Failure(error.ConnectionDone()))
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+    self.assertEqual(request.written, [])
+
+    # Profiling was stopped.
+    request = self._get({'seconds': '1'})
+    self.assertFalse(request.finished)
+    self.clock.advance(1)
+    self.assertTrue(request.finished)
+
+
 class TestWebResourcesStatus(monitor.util.test_base.TestBase):
   """Test /status handler."""
 
   def _dummy_request_get(self,
                          url='http://example/status',
                          path=None,
-                         revision=None):
+                         revision=None,
+                         user_agent='Mozilla/5.0'):
     if path is None:
       path = []
 
-    # The request to make.
+    # The request to make. By default it's from a browser, which gets
+    # indented JSON.
     request = DummyRequest(path)
-    request.URLPath = lambda: URLPath.fromString(url)
+    request.prePathURL = lambda: url
+    if user_agent is not None:
+      request.requestHeaders.setRawHeaders('user-agent', [user_agent])
 
     if revision is not None:
       request.addArg('revision', str(revision))
@@ -123,6 +319,369 @@ class TestWebResourcesStatus(monitor.util.test_base.TestBase):
     d.addCallback(rendered)
     return d
 
+  def test_status_etag(self):
+    status = self._create_status({'int': 2, 'sub1': {'foo': 3}})
+    resource = monitor.web_resources.Status(status)
+
+    first = self._dummy_request_get(path=['sub1'])
+    d = self._render(resource, first)
+
+    def first_rendered(_):
+      self.assertEqual(first.responseCode, 200)
+      etag = first.responseHeaders.getRawHeaders('etag')[0]
+
+      # Asking again with the ETag finds the content unmodified.
+      second = self._dummy_request_get(path=['sub1'])
+      second.requestHeaders.setRawHeaders('if-none-match', [etag])
+      with mock.patch.object(status, 'get_json') as get_json:
+        d_second = self._render(resource, second)
+      # Nothing was serialized for it.
+      self.assertFalse(get_json.called)
+
+      def second_rendered(_):
+        self.assertEqual(second.responseCode, 304)
+        self.assertEqual(second.written, [])
+        self.assertEqual(second.responseHeaders.getRawHeaders('etag'),
+                         [etag])
+
+      d_second.addCallback(second_rendered)
+
+      # After a change, the ETag no longer matches.
+      status.set('status://sub1/foo', 4)
+      third = self._dummy_request_get(path=['sub1'])
+      third.requestHeaders.setRawHeaders('if-none-match', [etag])
+      d_third = self._render(resource, third)
+
+      def third_rendered(_):
+        self.assertEqual(third.responseCode, 200)
+        self.assertNotEqual(third.responseHeaders.getRawHeaders('etag'),
+                            [etag])
+
+      d_third.addCallback(third_rendered)
+      return defer.gatherResults([d_second, d_third])
+
+    d.addCallback(first_rendered)
+    return d
+
+  def test_status_compact(self):
+    """Programs get compact JSON, unless they ask otherwise."""
+    status = self._create_status({'int': 2, 'sub1': {'foo': [3, {'bar': 4}]}})
+    resource = monitor.web_resources.Status(status)
+
+    compact = self._dummy_request_get(user_agent='python-requests/2.0')
+    pretty = self._dummy_request_get(user_agent=None)
+    pretty.addArg('pretty', '1')
+    browser_compact = self._dummy_request_get()
+    browser_compact.addArg('pretty', '0')
+
+    expected = {'revision': 1,
+                'status': status.get(),
+                'url': 'http://example/status'}
+
+    d = defer.gatherResults([self._render(resource, r)
+                             for r in (compact, pretty, browser_compact)])
+
+    def rendered(_):
+      self.assertEqual(''.join(compact.written),
+                       json.dumps(expected, sort_keys=True,
+                                  separators=(',', ':')))
+      self.assertEqual(''.join(browser_compact.written),
+                       ''.join(compact.written))
+      self.assertEqual(''.join(pretty.written),
+                       json.dumps(expected, sort_keys=True, indent=4))
+
+      # They are different representations.
+      self.assertNotEqual(compact.responseHeaders.getRawHeaders('etag'),
+                          pretty.responseHeaders.getRawHeaders('etag'))
+      self.assertEqual(compact.responseHeaders.getRawHeaders('vary'),
+                       ['Accept, Accept-Encoding, User-Agent'])
+
+    d.addCallback(rendered)
+    return d
+
+  def test_status_msgpack(self):
+    if monitor.web_resources.msgpack is None:
+      raise unittest.SkipTest('msgpack is not installed.')
+
+    status = self._create_status({'int': 2, 'sub1': {'foo': [3, {'bar': 4}]}})
+    resource = monitor.web_resources.Status(status)
+
+    request = self._dummy_request_get()
+    request.requestHeaders.setRawHeaders('accept', ['application/msgpack'])
+
+    d = self._render(resource, request)
+
+    def rendered(_):
+      self.assertEqual(request.responseHeaders.getRawHeaders('content-type'),
+                       ['application/msgpack'])
+      self.assertEqual(
+          monitor.web_resources.msgpack.unpackb(''.join(request.written),
+                                                raw=False),
+          {'revision': 1,
+           'status': {'int': 2, 'sub1': {'foo': [3, {'bar': 4}]}},
+           'url': 'http://example/status'})
+
+    d.addCallback(rendered)
+    return d
+
+  def test_status_gzip(self):
+    status = self._create_status({'int': 2, 'sub1': {'foo': 3}})
+
+    # Make a request through a real web server, which does the compression.
+    root = monitor.web_resources.Resource()
+    root.putChild('status', monitor.web_resources.compressed(
+        monitor.web_resources.Status(status)))
+    transport = proto_helpers.StringTransport()
+    channel = server.Site(root).buildProtocol(None)
+    channel.makeConnection(transport)
+    channel.dataReceived('GET /status/sub1 HTTP/1.1\r\n'
+                         'Host: example\r\n'
+                         'Accept-Encoding: gzip, deflate\r\n\r\n')
+
+    channel.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    headers, body = transport.value().split('\r\n\r\n', 1)
+    self.assertIn('Content-Encoding: gzip', headers)
+    self.assertIn('Transfer-Encoding: chunked', headers)
+
+    # The compressed body is a different representation.
+    self.assertIn('ETag: "1-compact-gzip"', headers)
+
+    # Reassemble the chunks, and decompress them.
+    compressed = ''
+    while body:
+      size, body = body.split('\r\n', 1)
+      compressed += body[:int(size, 16)]
+      body = body[int(size, 16) + 2:]
+    response = json.loads(zlib.decompress(compressed, 16 + zlib.MAX_WBITS))
+    self.assertEqual(response['status'], {'foo': 3})
+    self.assertEqual(response['revision'], 1)
+
+  def test_status_json(self):
+    """Responses match the normal JSON encoding."""
+    value = {'int': 2, 'sub1': {'foo': [3, {'bar': 4}], 'empty': {}}}
+    status = self._create_status(value)
+    resource = monitor.web_resources.Status(status)
+
+    request = self._dummy_request_get()
+    d = self._render(resource, request)
+    def rendered(_):
+      self.assertEqual(''.join(request.written),
+                       json.dumps({'revision': 1,
+                                   'status': value,
+                                   'url': 'http://example/status'},
+                                  sort_keys=True, indent=4))
+    d.addCallback(rendered)
+    return d
+
+  def test_status_depth(self):
+    status = self._create_status({'int': 2, 'sub1': {'foo': {'bar': 3}}})
+    status.set('status://sub1/foo/bar', 4)
+    resource = monitor.web_resources.Status(status)
+
+    request = self._dummy_request_get()
+    request.addArg('depth', '1')
+    d = self._render(resource, request)
+    def rendered(_):
+      self.assertEqual(json.loads(''.join(request.written)),
+                       {'revision': 2,
+                        'status': {'int': 2, 'sub1': {'foo': 2}},
+                        'url': 'http://example/status'})
+    d.addCallback(rendered)
+    return d
+
+  def test_status_paged(self):
+    status = self._create_status({
+        'host': {'host%d' % i: {'up': i} for i in xrange(10)}})
+    resource = monitor.web_resources.Status(status)
+
+    def _validate(args, expected_status, expected_total):
+      request = self._dummy_request_get(path=['host'])
+      for arg, value in args.iteritems():
+        request.addArg(arg, str(value))
+      d = self._render(resource, request)
+
+      def rendered(_):
+        result = json.loads(''.join(request.written))
+        self.assertEqual(result['status'], expected_status)
+        self.assertEqual(result.get('total'), expected_total)
+      d.addCallback(rendered)
+      return d
+
+    return defer.gatherResults([
+        _validate({'offset': 2, 'limit': 2},
+                  {'host2': {'up': 2}, 'host3': {'up': 3}}, 10),
+        _validate({'offset': 8},
+                  {'host8': {'up': 8}, 'host9': {'up': 9}}, 10),
+        _validate({'limit': 1, 'depth': 0}, {'host0': 1}, 10),
+        _validate({'limit': 1, 'depth': 1}, {'host0': {'up': 1}}, 10),
+        _validate({'offset': 20}, {}, 10),
+    ])
+
+  def test_status_changes(self):
+    status = self._create_status({'int': 2, 'sub1': {'foo': 3, 'bar': 4}})
+    status.set('status://sub1/foo', 5)
+    status.set('status://int', 6)
+
+    resource = monitor.web_resources.Status(status)
+    request = self._dummy_request_get(path=['sub1'], revision=1)
+    request.addArg('format', 'changes')
+
+    d = self._render(resource, request)
+    def rendered(_):
+      self.assertEqual(request.responseCode, 200)
+      self.assertEqual(json.loads(''.join(request.written)),
+                       {'revision': 2,
+                        'changes': [{'revision': 2,
+                                     'url': 'status://sub1/foo',
+                                     'value': 5}],
+                        'url': 'http://example/status/sub1'})
+    d.addCallback(rendered)
+    return d
+
+  def test_status_changes_unknown(self):
+    """Fall back to the full status, if the changes aren't known."""
+    status = self._create_status({'int': 2})
+    status.set('status://int', 3)
+
+    resource = monitor.web_resources.Status(status)
+    request = self._dummy_request_get(revision=0)
+    request.addArg('format', 'changes')
+
+    d = self._render(resource, request)
+    def rendered(_):
+      self.assertEqual(request.responseCode, 200)
+      self.assertEqual(json.loads(''.join(request.written)),
+                       {'revision': 2,
+                        'status': {'int': 3},
+                        'url': 'http://example/status'})
+    d.addCallback(rendered)
+    return d
+
+  def test_status_patch(self):
+    status = self._create_status({'int': 2, 'sub1': {'foo': 3, 'bar': 4}})
+    status.set('status://sub1/foo', 5)
+    status.set('status://int', 6)
+
+    resource = monitor.web_resources.Status(status)
+    request = self._dummy_request_get(path=['sub1'], revision=1)
+    request.addArg('format', 'patch')
+    unknown = self._dummy_request_get(path=['sub1'], revision=0)
+    unknown.addArg('format', 'patch')
+
+    d = self._render(resource, request)
+    def rendered(_):
+      self.assertEqual(request.responseCode, 200)
+      self.assertEqual(json.loads(''.join(request.written)),
+                       {'revision': 2,
+                        'patch': [{'op': 'replace',
+                                   'path': '/foo',
+                                   'value': 5}],
+                        'url': 'http://example/status/sub1'})
+      return self._render(resource, unknown)
+
+    # Fall back to the full status, if a patch isn't possible.
+    def rendered_unknown(_):
+      self.assertEqual(json.loads(''.join(unknown.written)),
+                       {'revision': 2,
+                        'status': {'foo': 5, 'bar': 4},
+                        'url': 'http://example/status/sub1'})
+
+    d.addCallback(rendered)
+    d.addCallback(rendered_unknown)
+    return d
+
+  def test_status_shared_wait(self):
+    """Long polls on the same url and revision share a notification."""
+    status = self._create_status({'int': 2, 'sub1': {'foo': 3}})
+    resource = monitor.web_resources.Status(status)
+
+    requests = [self._dummy_request_get(path=['sub1'], revision=1)
+                for _ in xrange(3)]
+    requests.append(self._dummy_request_get(path=['sub1'], revision=1,
+                                            user_agent=None))
+    other = self._dummy_request_get(path=['int'], revision=1)
+    for request in requests + [other]:
+      resource.render(request)
+
+    self.assertEqual(len(resource._waiters), 2)
+    self.assertEqual(len(status._notifications.matching(('sub1',))), 1)
+
+    status.set('status://sub1/foo', 4)
+
+    # Everyone asking for the same response gets the same body.
+    self.assertEqual(resource._waiters.keys(), [('status://int', 1)])
+    for request in requests[:3]:
+      self.assertTrue(request.finished)
+      self.assertIs(request.written[0], requests[0].written[0])
+    self.assertEqual(json.loads(requests[3].written[0]),
+                     json.loads(requests[0].written[0]))
+    self.assertNotEqual(requests[3].written[0], requests[0].written[0])
+    self.assertFalse(other.finished)
+
+  def test_status_shared_wait_disconnect(self):
+    status = self._create_status({'int': 2})
+    resource = monitor.web_resources.Status(status)
+
+    requests = [self._dummy_request_get(revision=1) for _ in xrange(2)]
+    for request in requests:
+      resource.render(request)
+
+    # Once every request is gone, so is the notification.
+    lost = failure.Failure(error.ConnectionDone())
+    requests[0].processingFailed(lost)
+    self.assertEqual(len(resource._waiters), 1)
+    requests[1].processingFailed(lost)
+    self.assertEqual(resource._waiters, {})
+    self.assertEqual(status._notifications.matching(()), set())
+
+    status.set('status://int', 3)
+    self.assertEqual(requests[0].written, [])
+
+  def test_status_unknown_url(self):
+    status = self._create_status({'int': 2})
+    resource = monitor.web_resources.Status(status)
+
+    missing = self._dummy_request_get(path=['new'], revision=1)
+    self.assertRaises(monitor.status.UnknownUrl, resource.render, missing)
+    self.assertEqual(resource._waiters, {})
+
+    # Once the url exists, long polls on it are answered.
+    status.set('status://new', 3)
+    request = self._dummy_request_get(path=['new'], revision=2)
+    resource.render(request)
+    status.set('status://new', 4)
+    self.assertTrue(request.finished)
+
+  def test_status_shared_wait_failure(self):
+    """A request that can't be written doesn't stop the others."""
+    status = self._create_status({'int': 2})
+    resource = monitor.web_resources.Status(status)
+
+    requests = [self._dummy_request_get(revision=1) for _ in xrange(2)]
+    for request in requests:
+      resource.render(request)
+    requests[0].write = mock.Mock(side_effect=RuntimeError('finished'))
+
+    status.set('status://int', 3)
+    self.assertTrue(requests[1].finished)
+    self.assertEqual(json.loads(requests[1].written[0])['revision'], 2)
+
+    # The failed request is still answered.
+    self.assertTrue(requests[0].finished)
+    self.assertEqual(requests[0].responseCode, 500)
+
+  def test_status_removed_wait(self):
+    status = self._create_status({'web': {'foo': 1}})
+    resource = monitor.web_resources.Status(status)
+
+    # A long poll on a url which is removed gets a 404.
+    request = self._dummy_request_get(path=['web', 'foo'], revision=1)
+    resource.render(request)
+    status.set('status://web', {})
+    self.assertTrue(request.finished)
+    self.assertEqual(request.responseCode, 404)
+
   def test_status_wrong_version(self):
     status = self._create_status({'int': 2})
 
@@ -365,6 +924,100 @@ class TestWebResourcesStatus(monitor.util.test_base.TestBase):
     d.addCallback(rendered)
     return d
 
+  def test_post_ttl(self):
+    monitor.adapter.WebAdapter._test_clear_state()
+    clock = task.Clock()
+    status = monitor.status.Status(clock=clock)
+
+    # Create a web adapter for /web.
+    monitor.adapter.WebAdapter(status, 'status://web', 'web', {})
+
+    # The resource to test.
+    resource = monitor.web_resources.Status(status)
+
+    # The request to make.
+    request = self._dummy_request_put(path=['web', 'heartbeat'],
+                                      content='"alive"')
+    request.addArg('ttl', '30')
+
+    # Create and validate the response.
+    d = self._render(resource, request)
+
+    def rendered(_):
+      self.assertEqual(request.responseCode, 200)
+      self.assertEqual(status.get('status://web/heartbeat'), 'alive')
+      clock.advance(30)
+      self.assertIsNone(status.get('status://web/heartbeat'))
+
+    d.addCallback(rendered)
+    return d
+
+  def test_post_ttl_invalid(self):
+    monitor.adapter.WebAdapter._test_clear_state()
+    status = monitor.status.Status()
+    monitor.adapter.WebAdapter(status, 'status://web', 'web', {})
+    resource = monitor.web_resources.Status(status)
+
+    requests = []
+    for ttl in ('nan', 'inf', '-1', 'soon'):
+      request = self._dummy_request_put(path=['web', 'heartbeat'],
+                                        content='"alive"')
+      request.addArg('ttl', ttl)
+      requests.append(request)
+
+    d = defer.gatherResults([self._render(resource, r) for r in requests])
+
+    def rendered(_):
+      for request in requests:
+        self.assertEqual(request.responseCode, 400)
+      self.assertIsNone(status.get('status://web/heartbeat'))
+      self.assertEqual(status.revision(), 2)
+
+    d.addCallback(rendered)
+    return d
+
+  def test_post_batch(self):
+    monitor.adapter.WebAdapter._test_clear_state()
+    status = self._create_status({'web': {'a': 1, 'b': 2}})
+
+    # Create a web adapter for /web.
+    monitor.adapter.WebAdapter(status, 'status://web', 'web', {})
+
+    # The resource to test.
+    resource = monitor.web_resources.Status(status)
+
+    def put(content):
+      request = self._dummy_request_put(path=['web'], content=content)
+      request.addArg('format', 'batch')
+      return request
+
+    good = put('{"a": {"revision": 1, "value": 3},'
+               ' "b": {"value": 4},'
+               ' "c/d": {"revision": 1, "value": 5}}')
+    stale = put('{"a": {"revision": 2, "value": 6},'
+                ' "b": {"revision": 1, "value": 7}}')
+
+    # Create and validate the responses.
+    d = self._render(resource, good)
+
+    def rendered_good(_):
+      self.assertEqual(good.responseCode, 200)
+      self.assertEqual(''.join(good.written), 'Success')
+      self.assertEqual(status.get('status://web'),
+                       {'a': 3, 'b': 4, 'c': {'d': 5}})
+      self.assertEqual(status.revision(), 2)
+      return self._render(resource, stale)
+
+    def rendered_stale(_):
+      self.assertEqual(stale.responseCode, 412)
+      self.assertEqual(''.join(stale.written), 'Revision mismatch.')
+      self.assertEqual(status.get('status://web'),
+                       {'a': 3, 'b': 4, 'c': {'d': 5}})
+
+    d.addCallback(rendered_good)
+    d.addCallback(rendered_stale)
+    return d
+
   def test_post_invalid(self):
     monitor.adapter.WebAdapter._test_clear_state()
     status = self._create_status({})
@@ -494,5 +1147,245 @@ class TestWebResourcesRestart(monitor.util.test_base.TestBase):
     return d
 
 
+
+class TestWebResourcesEvents(monitor.util.test_base.TestBase):
+  """Test /events handler."""
+
+  def _connect(self, resource, path, last_event_id=None):
+    request = DummyRequest(path)
+    if last_event_id is not None:
+      request.requestHeaders.setRawHeaders('last-event-id', [last_event_id])
+    self.assertIs(resource.render(request), server.NOT_DONE_YET)
+    return request
+
+  def test_events(self):
+    status = self._create_status()
+    clock = task.Clock()
+    resource = monitor.web_resources.Events(status, clock)
+
+    # New clients get the full status.
+    first = self._connect(resource, ['dict'])
+    second = self._connect(resource, ['dict'])
+    self.assertEqual(first.responseHeaders.getRawHeaders('content-type'),
+                     ['text/event-stream'])
+    self.assertEqual(''.join(first.written),
+                     'event: status\nid: 1\ndata: {"sub1":3,"sub2":4}\n\n')
+    self.assertEqual(first.written, second.written)
+
+    # Both share a single stream.
+    self.assertEqual(len(resource._streams), 1)
+
+    # Changes elsewhere aren't sent.
+    del first.written[:]
+    status.set('status://int', 5)
+    self.assertEqual(first.written, [])
+
+    # Each revision is a single event.
+    with status.transaction():
+      status.set('status://dict/sub1', 6)
+      status.set('status://dict/sub2', 7)
+    self.assertEqual(
+        ''.join(first.written),
+        'event: changes\nid: 3\ndata: ['
+        '{"revision":3,"url":"status://dict/sub1","value":6},'
+        '{"revision":3,"url":"status://dict/sub2","value":7}]\n\n')
+    self.assertEqual(first.written[-1], second.written[-1])
+
+    # Idle connections are kept alive.
+    clock.advance(resource.KEEPALIVE_SECONDS)
+    self.assertEqual(first.written[-1], ':\n\n')
+
+    # Once every client disconnects, nothing is left watching.
+    first.processingFailed(failure.Failure(error.ConnectionDone()))
+    second.processingFailed(failure.Failure(error.ConnectionDone()))
+    self.assertEqual(resource._streams, {})
+    self.assertEqual(clock.getDelayedCalls(), [])
+    status.set('status://dict/sub1', 8)
+
+  def test_events_resume(self):
+    status = self._create_status()
+    resource = monitor.web_resources.Events(status, task.Clock())
+
+    status.set('status://dict/sub1', 5)
+    status.set('status://int', 6)
+    status.set('status://dict/sub2', 7)
+
+    # Resume from a known revision.
+    request = self._connect(resource, ['dict'], last_event_id='2')
+    self.assertEqual(
+        ''.join(request.written),
+        'event: changes\nid: 4\ndata: '
+        '[{"revision":4,"url":"status://dict/sub2","value":7}]\n\n')
+
+    # Resume from the current revision.
+    request = self._connect(resource, ['dict'], last_event_id='4')
+    self.assertEqual(request.written, [''])
+
+    # Resume from an unknown revision.
+    request = self._connect(resource, ['dict'], last_event_id='10')
+    self.assertEqual(
+        ''.join(request.written),
+        'event: status\nid: 4\ndata: {"sub1":5,"sub2":7}\n\n')
+
+  def test_events_removed(self):
+    status = self._create_status()
+    clock = task.Clock()
+    resource = monitor.web_resources.Events(status, clock)
+
+    request = self._connect(resource, ['dict', 'sub1'])
+    self.assertEqual(''.join(request.written),
+                     'event: status\nid: 1\ndata: 3\n\n')
+
+    # Replacing the parent removes the url, which ends the stream.
+    status.set('status://dict', {'sub2': 5})
+    self.assertEqual(request.written[-1],
+                     'event: removed\nid: 2\ndata: null\n\n')
+    self.assertTrue(request.finished)
+    self.assertEqual(resource._streams, {})
+    self.assertEqual(clock.getDelayedCalls(), [])
+    self.assertEqual(status._notifications.matching(('dict', 'sub1')), set())
+
+    # Until it's back, there's nothing to stream.
+    request = DummyRequest(['dict', 'sub1'])
+    self.assertEqual(resource.render(request), 'Unknown url.')
+    self.assertEqual(request.responseCode, 404)
+
+
+
+class TestWebResourcesSocket(monitor.util.test_base.TestBase):
+  """Test /socket handler."""
+
+  def setUp(self):
+    monitor.adapter.WebAdapter._test_clear_state()
+    self.status = self._create_status({
+        'web': {'led': 'off'},
+        'adapter': {'button': {'foo': {'pushed': 4}}},
+    })
+    monitor.adapter.WebAdapter(self.status, 'status://web', 'web', {})
+
+    # Connect through a real web server, so the connection is taken over.
+    root = monitor.web_resources.Resource()
+    root.putChild('socket', monitor.web_resources.Socket(self.status))
+    self.transport = proto_helpers.StringTransport()
+    channel = server.Site(root).buildProtocol(None)
+    channel.makeConnection(self.transport)
+    channel.dataReceived('GET /socket HTTP/1.1\r\n'
+                         'Host: example\r\n'
+                         'Upgrade: websocket\r\n'
+                         'Connection: Upgrade\r\n'
+                         'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                         'Sec-WebSocket-Version: 13\r\n\r\n')
+
+    self.assertEqual(self.transport.value(),
+                     'HTTP/1.1 101 Switching Protocols\r\n'
+                     'Upgrade: websocket\r\n'
+                     'Connection: Upgrade\r\n'
+                     'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n'
+                     '\r\n')
+    self.transport.clear()
+
+  def _send(self, message):
+    """Send a request, and return the messages sent back."""
+    self.transport.clear()
+    self.transport.protocol.dataReceived(client_frame(json.dumps(message)))
+    return self._received()
+
+  def _received(self):
+    # Server frames are short, and unmasked.
+    data = self.transport.value()
+    self.transport.clear()
+    messages = []
+    while data:
+      length = ord(data[1])
+      messages.append(json.loads(data[2:2 + length]))
+      data = data[2 + length:]
+    return messages
+
+  def test_subscribe(self):
+    self.assertEqual(
+        self._send({'id': 1, 'op': 'subscribe', 'url': 'status://*/led'}),
+        [{'subscription': 1, 'revision': 1,
+          'values': {'status://web/led': 'off'}},
+         {'id': 1, 'result': 'Success'}])
+
+    # A write on the same connection updates the subscription.
+    self.assertEqual(
+        self._send({'id': 2, 'op': 'set', 'url': 'status://web/led',
+                    'value': 'on'}),
+        [{'subscription': 1, 'revision': 2,
+          'values': {'status://web/led': 'on'}},
+         {'id': 2, 'result': 'Success'}])
+
+    # So do changes from elsewhere, and unrelated changes don't.
+    self.status.set('status://web/other', 1)
+    self.status.set('status://web/led', 'off')
+    self.assertEqual(self._received(),
+                     [{'subscription': 1, 'revision': 4,
+                       'values': {'status://web/led': 'off'}}])
+
+    self.assertEqual(
+        self._send({'id': 3, 'op': 'unsubscribe', 'subscription': 1}),
+        [{'id': 3, 'result': 'Success'}])
+    self.status.set('status://web/led', 'on')
+    self.assertEqual(self._received(), [])
+
+  def test_writes(self):
+    self.assertEqual(
+        self._send({'id': 1, 'op': 'set', 'url': 'status://web/led',
+                    'value': 'on', 'revision': 5}),
+        [{'id': 1, 'error': 'Revision mismatch.'}])
+
+    self.assertEqual(
+        self._send({'id': 2, 'op': 'compare_and_set', 'updates': {
+            'status://web/led': {'revision': 1, 'value': 'on'},
+            'status://web/new': {'value': 1}}}),
+        [{'id': 2, 'result': 'Success'}])
+    self.assertEqual(self.status.get('status://web'), {'led': 'on', 'new': 1})
+
+    self.assertEqual(
+        self._send({'id': 3, 'op': 'button', 'button': 'foo'}),
+        [{'id': 3, 'result': 'Success'}])
+    self.assertTrue(
+        self.status.get('status://adapter/button/foo/pushed') > 100)
+
+    # Only web adapter urls can be written.
+    self.assertEqual(
+        self._send({'id': 4, 'op': 'set', 'url': 'status://adapter/foo',
+                    'value': 1}),
+        [{'id': 4, 'error': 'Invalid request.'}])
+
+    # A ttl that isn't a number is refused before anything changes.
+    revision = self.status.revision()
+    self.assertEqual(
+        self._send({'id': 6, 'op': 'set', 'url': 'status://web/led',
+                    'value': 'off', 'ttl': '5'}),
+        [{'id': 6, 'error': 'Invalid request.'}])
+    self.assertEqual(self.status.get('status://web/led'), 'on')
+    self.assertEqual(self.status.revision(), revision)
+
+    self.assertEqual(self._send({'id': 5, 'op': 'explode'}),
+                     [{'id': 5, 'error': 'Unknown op.'}])
+
+  def test_disconnect(self):
+    self._send({'id': 1, 'op': 'subscribe', 'url': 'status://web'})
+    self.transport.protocol.connectionLost(None)
+    self.assertEqual(self.status._notifications.matching(('web',)), set())
+
+  def test_not_upgrade(self):
+    request = DummyRequest([])
+    resource = monitor.web_resources.Socket(self.status)
+    self.assertEqual(resource.render(request), 'WebSocket upgrade required.')
+    self.assertEqual(request.responseCode, 400)
+
+  def test_cross_origin(self):
+    request = DummyRequest([])
+    request.requestHeaders.setRawHeaders('host', ['example'])
+    request.requestHeaders.setRawHeaders('origin', ['http://evil.example'])
+    resource = monitor.web_resources.Socket(self.status)
+    self.assertEqual(resource.render(request),
+                     'Cross origin WebSocket refused.')
+    self.assertEqual(request.responseCode, 403)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+import logging
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import threadable
+
+
+class LogBuffer(logging.Handler):
+  """Keep the most recent log records, for display on the web.
+
+  Records are kept in a fixed size ring, so memory use is bounded no matter
+  how long the server runs. Each record gets the next revision number, and
+  is stored as a dictionary:
+
+    {'revision': 12, 'time': 1380000000.0, 'level': 'WARNING',
+     'module': 'adapter', 'line': 45, 'message': '...'}
+
+  Log calls can come from any thread. Waiting deferreds are always called
+  from the reactor thread, once per burst of records.
+  """
+
+  # Longer messages (tracebacks, mostly) are cut down to this many characters.
+  MAX_MESSAGE = 4096
+
+  def __init__(self, capacity=1000, level=logging.NOTSET, clock=None):
+    logging.Handler.__init__(self, level)
+    self._clock = clock or reactor
+    self._records = [None] * capacity
+
+    # The revision of the last record, and of the oldest still in the ring.
+    self._revision = 0
+    self._first = 1
+
+    self._waiting = []
+    self._wake_call = None
+
+  def revision(self):
+    return self._revision
+
+  def records_since(self, revision):
+    """Return the records after revision, oldest first.
+
+    If some have already been dropped from the ring, everything still
+    present is returned.
+    """
+    self.acquire()
+    try:
+      start = max(revision + 1, self._first)
+      return [self._records[r % len(self._records)]
+              for r in xrange(start, self._revision + 1)]
+    finally:
+      self.release()
+
+  def deferred(self, revision):
+    """Return a deferred called back once there are records after revision.
+
+    Must be called from the reactor thread. The callback value is the
+    current revision.
+    """
+    d = defer.Deferred(lambda cancelled: self._waiting.remove(cancelled))
+    if revision < self._revision:
+      d.callback(self._revision)
+    else:
+      self._waiting.append(d)
+    return d
+
+  def emit(self, record):
+    # Like the standard handlers, a record that can't be handled (a bad
+    # format string, say) is reported by handleError() instead of raising
+    # into the code that logged it.
+    try:
+      message = record.getMessage()
+      if record.exc_info and not record.exc_text:
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+      if record.exc_text:
+        message = '%s\n%s' % (message, record.exc_text)
+
+      # Called with the handler lock held.
+      self._revision += 1
+      self._records[self._revision % len(self._records)] = {
+          'revision': self._revision,
+          'time': record.created,
+          'level': record.levelname,
+          'module': record.module,
+          'line': record.lineno,
+          'message': message[:self.MAX_MESSAGE],
+      }
+      self._first = max(self._first, self._revision - len(self._records) + 1)
+
+      if threadable.isInIOThread():
+        self._schedule_wake()
+      else:
+        reactor.callFromThread(self._schedule_wake)
+    except Exception:  # pylint: disable=broad-except
+      self.handleError(record)
+
+  def _schedule_wake(self):
+    # Waiters are woken after the current log call returns, and a burst of
+    # records only wakes them once.
+    if self._wake_call is None and self._waiting:
+      self._wake_call = self._clock.callLater(0, self._wake)
+
+  def _wake(self):
+    self._wake_call = None
+    waiting, self._waiting = self._waiting, []
+    for d in waiting:
+      d.callback(self._revision)
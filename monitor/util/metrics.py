@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+"""Counters, gauges and histograms, exported in the Prometheus text format.
+
+Metrics are created once, at import time, in a registry (normally the
+module level REGISTRY):
+
+  _GETS = monitor.util.metrics.counter('gets_total', 'Gets, by adapter.',
+                                       ['adapter'])
+  ...
+  _GETS.inc(('house',))
+
+Values are identified by a tuple of label values, in the order the label
+names were given. Updates are plain dictionary and list operations, cheap
+enough for the hot paths of the reactor thread, which is the only thread
+that should make them.
+"""
+
+import bisect
+import time
+
+from twisted.internet import defer
+
+
+class _Metric(object):
+  """Base class for the metric types."""
+
+  TYPE = None
+
+  def __init__(self, name, help_text, labels=()):
+    self.name = name
+    self.help_text = help_text
+    self.labels = tuple(labels)
+
+    # {label values tuple: value}
+    self._values = {}
+
+  def samples(self):
+    """Return the current values as a list of (suffix, labels, value).
+
+    labels is a list of (name, value) pairs.
+    """
+    return [('', zip(self.labels, label_values), value)
+            for label_values, value in sorted(self._values.iteritems())]
+
+
+class Counter(_Metric):
+  """A count that only goes up, such as a number of calls."""
+
+  TYPE = 'counter'
+
+  def inc(self, label_values=(), amount=1):
+    self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+  """A value read when the metrics are rendered, such as a queue length.
+
+  func returns the value, or a dictionary of {label values tuple: value} if
+  the gauge has labels.
+  """
+
+  TYPE = 'gauge'
+
+  def __init__(self, name, help_text, func, labels=()):
+    super(Gauge, self).__init__(name, help_text, labels)
+    self._func = func
+
+  def samples(self):
+    self._values = self._func() if self.labels else {(): self._func()}
+    return super(Gauge, self).samples()
+
+
+class Histogram(_Metric):
+  """Counts of observations (usually durations in seconds) by size.
+
+  Each observation is counted in the first bucket it's no bigger than, and
+  the buckets are only made cumulative when rendered.
+  """
+
+  TYPE = 'histogram'
+
+  # From 10us (a status read) up to the length of a slow network poll.
+  BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+             0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+             30, 60)
+
+  def __init__(self, name, help_text, labels=(), buckets=None):
+    super(Histogram, self).__init__(name, help_text, labels)
+    self.buckets = tuple(buckets or self.BUCKETS)
+
+  def observe(self, label_values, value, weight=1):
+    """Count value weight times, for callers that only sample."""
+    # A count for each bucket, then +Inf, then the sum of the values.
+    counts = self._values.get(label_values)
+    if counts is None:
+      counts = self._values[label_values] = [0] * (len(self.buckets) + 1)
+      counts.append(0.0)
+    counts[bisect.bisect_left(self.buckets, value)] += weight
+    counts[-1] += value * weight
+
+  def time(self, label_values, func, *args, **kwargs):
+    """Call func(*args, **kwargs), and observe how long it takes.
+
+    If func returns a deferred, the time is observed when the deferred
+    fires, successfully or not.
+
+    Returns:
+      The result of func.
+    """
+    start = time.time()
+    try:
+      result = func(*args, **kwargs)
+    except Exception:
+      self.observe(label_values, time.time() - start)
+      raise
+
+    if isinstance(result, defer.Deferred):
+      def observe(value):
+        self.observe(label_values, time.time() - start)
+        return value
+      result.addBoth(observe)
+    else:
+      self.observe(label_values, time.time() - start)
+    return result
+
+  def samples(self):
+    result = []
+    bounds = [_format_value(b) for b in self.buckets] + ['+Inf']
+    for label_values, counts in sorted(self._values.iteritems()):
+      labels = zip(self.labels, label_values)
+      total = 0
+      for bound, count in zip(bounds, counts):
+        total += count
+        result.append(('_bucket', labels + [('le', bound)], total))
+      result.append(('_sum', labels, counts[-1]))
+      result.append(('_count', labels, total))
+    return result
+
+
+def _format_value(value):
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join(
+      '%s="%s"' % (name, unicode(value).encode('utf-8').replace(
+          '\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+      for name, value in labels)
+
+
+class Registry(object):
+  """A set of metrics, rendered together."""
+
+  def __init__(self):
+    # {name: metric}
+    self._metrics = {}
+
+  def _add(self, metric_type, name, *args, **kwargs):
+    # Modules can be reloaded (in tests), so return an existing metric if
+    # it's the same type.
+    existing = self._metrics.get(name)
+    if existing is not None:
+      if type(existing) is not metric_type:
+        raise ValueError('Metric %s is already a %s.' % (name, existing.TYPE))
+      return existing
+
+    metric = metric_type(name, *args, **kwargs)
+    self._metrics[name] = metric
+    return metric
+
+  def counter(self, name, help_text, labels=()):
+    return self._add(Counter, name, help_text, labels)
+
+  def gauge(self, name, help_text, func, labels=()):
+    return self._add(Gauge, name, help_text, func, labels)
+
+  def histogram(self, name, help_text, labels=(), buckets=None):
+    return self._add(Histogram, name, help_text, labels, buckets)
+
+  def render(self):
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    for name, metric in sorted(self._metrics.iteritems()):
+      lines.append('# HELP %s %s' % (name, metric.help_text))
+      lines.append('# TYPE %s %s' % (name, metric.TYPE))
+      for suffix, labels, value in metric.samples():
+        lines.append('%s%s%s %s' % (name, suffix, _format_labels(labels),
+                                    _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
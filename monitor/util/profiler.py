@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+"""Profilers for the running server.
+
+Each is started and stopped from the thread it profiles (the reactor
+thread), and has the same interface:
+
+  profiler.start()
+  ...
+  profiler.stop()
+  text = profiler.result()
+"""
+
+import cProfile
+import collections
+import os
+import pstats
+import StringIO
+import sys
+import threading
+
+
+class DeterministicProfiler(object):
+  """cProfile of everything the thread runs, as pstats text.
+
+  This counts every call exactly, but makes Python code run around twice as
+  slow while it's enabled.
+  """
+
+  SORTS = ('calls', 'cumulative', 'tottime')
+
+  def __init__(self, sort='cumulative'):
+    if sort not in self.SORTS:
+      raise ValueError('Unknown sort: %s' % sort)
+    self._sort = sort
+    self._profile = cProfile.Profile()
+
+  def start(self):
+    self._profile.enable()
+
+  def stop(self):
+    self._profile.disable()
+
+  def result(self):
+    stream = StringIO.StringIO()
+    stats = pstats.Stats(self._profile, stream=stream)
+    stats.sort_stats(self._sort).print_stats()
+    return stream.getvalue()
+
+
+class StackSampler(object):
+  """Sample the stack of a thread from another thread.
+
+  The result is in the collapsed format read by flamegraph.pl: a line for
+  each distinct stack, with its frames (outermost first) separated by ';',
+  followed by the number of samples it was seen in. Only the sampled thread
+  is slowed, by however long each sample holds the GIL.
+  """
+
+  def __init__(self, thread_ident=None, interval=0.005):
+    if thread_ident is None:
+      thread_ident = threading.current_thread().ident
+    self._thread_ident = thread_ident
+    self._interval = interval
+
+    # {stack tuple: samples}
+    self._counts = collections.Counter()
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._sample_loop,
+                                    name='StackSampler')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stopped.set()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+
+  def result(self):
+    return ''.join('%s %d\n' % (';'.join(stack), count)
+                   for stack, count in sorted(self._counts.iteritems()))
+
+  def sample(self):
+    """Take one sample. Called from the sampling thread."""
+    frame = sys._current_frames().get(  # pylint: disable=protected-access
+        self._thread_ident)
+    stack = []
+    while frame is not None:
+      code = frame.f_code
+      stack.append('%s (%s:%d)' % (code.co_name,
+                                   os.path.basename(code.co_filename),
+                                   code.co_firstlineno))
+      frame = frame.f_back
+    if stack:
+      self._counts[tuple(reversed(stack))] += 1
+
+  def _sample_loop(self):
+    while not self._stopped.wait(self._interval):
+      self.sample()
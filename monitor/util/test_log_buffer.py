@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+import logging
+import mock
+import threading
+import unittest
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import threadable
+
+import monitor.util.test_base
+from monitor.util import log_buffer
+
+
+class TestLogBuffer(monitor.util.test_base.TestBase):
+
+  def setUp(self):
+    # The reactor does this when it starts, which it may not have yet.
+    threadable.registerAsIOThread()
+
+    self.clock = task.Clock()
+    self.buffer = log_buffer.LogBuffer(capacity=3, clock=self.clock)
+    self.logger = logging.getLogger('test_log_buffer')
+    self.logger.propagate = False
+    self.logger.addHandler(self.buffer)
+
+  def tearDown(self):
+    self.logger.removeHandler(self.buffer)
+
+  def _messages(self, revision):
+    return [r['message'] for r in self.buffer.records_since(revision)]
+
+  def test_records(self):
+    self.assertEqual(self.buffer.revision(), 0)
+    self.assertEqual(self.buffer.records_since(0), [])
+
+    self.logger.warning('first %d', 1)
+    record = self.buffer.records_since(0)[0]
+    self.assertEqual(record['revision'], 1)
+    self.assertEqual(record['level'], 'WARNING')
+    self.assertEqual(record['module'], 'test_log_buffer')
+    self.assertEqual(record['message'], 'first 1')
+
+    self.logger.error('second')
+    self.assertEqual(self._messages(0), ['first 1', 'second'])
+    self.assertEqual(self._messages(1), ['second'])
+    self.assertEqual(self._messages(2), [])
+
+  def test_ring(self):
+    for i in xrange(10):
+      self.logger.warning('%d', i)
+
+    # Only the newest records are kept.
+    self.assertEqual(self.buffer.revision(), 10)
+    self.assertEqual(self._messages(0), ['7', '8', '9'])
+    self.assertEqual(self._messages(8), ['8', '9'])
+
+  def test_long_message(self):
+    try:
+      raise ValueError('oops')
+    except ValueError:
+      self.logger.exception('failed: %s', 'x' * 10000)
+
+    message = self._messages(0)[0]
+    self.assertEqual(len(message), log_buffer.LogBuffer.MAX_MESSAGE)
+    self.assertTrue(message.startswith('failed: xxx'))
+
+    self.logger.exception('failed')
+    self.assertIn('ValueError: oops', self._messages(1)[0])
+
+  def test_bad_record(self):
+    # A record that can't be formatted is reported, not raised to the caller.
+    with mock.patch.object(self.buffer, 'handleError') as handle_error:
+      self.logger.warning('%d', 'not a number')
+    self.assertEqual(handle_error.call_count, 1)
+    self.assertEqual(self.buffer.revision(), 0)
+
+    self.logger.warning('fine')
+    self.assertEqual(self._messages(0), ['fine'])
+
+  def test_deferred(self):
+    self.logger.warning('first')
+
+    # Records after the revision already exist.
+    immediate = self.buffer.deferred(0)
+    self.assertEqual(self.successResultOf(immediate), 1)
+
+    waiting = self.buffer.deferred(1)
+    cancelled = self.buffer.deferred(1)
+    cancelled.cancel()
+    self.failureResultOf(cancelled, defer.CancelledError)
+
+    # A burst of records wakes waiters once, after the log calls.
+    self.logger.warning('second')
+    self.logger.warning('third')
+    self.assertNoResult(waiting)
+    self.clock.advance(0)
+    self.assertEqual(self.successResultOf(waiting), 3)
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+
+  def test_other_thread(self):
+    waiting = self.buffer.deferred(0)
+
+    thread = threading.Thread(target=self.logger.warning, args=('threaded',))
+    thread.start()
+    thread.join()
+
+    # Waiters are woken from the reactor thread, once it gets a turn.
+    self.assertEqual(self._messages(0), ['threaded'])
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def reactor_turn():
+      self.clock.advance(0)
+      self.assertEqual(self.successResultOf(waiting), 1)
+
+    return task.deferLater(reactor, 0, reactor_turn)
+
+
+if __name__ == '__main__':
+  unittest.main()
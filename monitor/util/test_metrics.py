@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import unittest
+
+from twisted.internet import defer
+
+import monitor.util.test_base
+from monitor.util import metrics
+
+
+class TestMetrics(monitor.util.test_base.TestBase):
+
+  def setUp(self):
+    self.registry = metrics.Registry()
+
+  def test_empty(self):
+    self.assertEqual(self.registry.render(), '\n')
+
+  def test_counter(self):
+    plain = self.registry.counter('plain_total', 'Plain.')
+    labelled = self.registry.counter('labelled_total', 'Labelled.',
+                                     ['rule', 'kind'])
+    plain.inc()
+    plain.inc(amount=2)
+    labelled.inc(('status://a/rule/"x"', 'b'))
+    labelled.inc(('status://a/rule/y', 'c'))
+
+    self.assertEqual(self.registry.render(), '\n'.join([
+        '# HELP labelled_total Labelled.',
+        '# TYPE labelled_total counter',
+        r'labelled_total{rule="status://a/rule/\"x\"",kind="b"} 1',
+        'labelled_total{rule="status://a/rule/y",kind="c"} 1',
+        '# HELP plain_total Plain.',
+        '# TYPE plain_total counter',
+        'plain_total 3',
+    ]) + '\n')
+
+  def test_gauge(self):
+    value = [1]
+    self.registry.gauge('plain', 'Plain.', lambda: value[0])
+    self.registry.gauge('labelled', 'Labelled.', lambda: {('a',): 2.5},
+                        ['name'])
+    value[0] = 7
+
+    self.assertEqual(self.registry.render(), '\n'.join([
+        '# HELP labelled Labelled.',
+        '# TYPE labelled gauge',
+        'labelled{name="a"} 2.5',
+        '# HELP plain Plain.',
+        '# TYPE plain gauge',
+        'plain 7',
+    ]) + '\n')
+
+  def test_histogram(self):
+    histogram = self.registry.histogram('latency_seconds', 'Latency.',
+                                        ['adapter'], buckets=[0.1, 1])
+    histogram.observe(('a',), 0.1)
+    histogram.observe(('a',), 0.5)
+    histogram.observe(('a',), 2)
+
+    self.assertEqual(self.registry.render(), '\n'.join([
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{adapter="a",le="0.1"} 1',
+        'latency_seconds_bucket{adapter="a",le="1"} 2',
+        'latency_seconds_bucket{adapter="a",le="+Inf"} 3',
+        'latency_seconds_sum{adapter="a"} 2.6',
+        'latency_seconds_count{adapter="a"} 3',
+    ]) + '\n')
+
+  def test_histogram_time(self):
+    histogram = self.registry.histogram('time_seconds', 'Time.', ['kind'])
+
+    self.assertEqual(histogram.time(('sync',), lambda x: x + 1, 1), 2)
+
+    def fail():
+      raise ValueError()
+    self.assertRaises(ValueError, histogram.time, ('raise',), fail)
+
+    # Deferreds are timed until they fire.
+    d = defer.Deferred()
+    self.assertIs(histogram.time(('deferred',), lambda: d), d)
+    self.assertNotIn('kind="deferred"', self.registry.render())
+    d.callback('result')
+    self.assertEqual(self.successResultOf(d), 'result')
+
+    rendered = self.registry.render()
+    for kind in ('sync', 'raise', 'deferred'):
+      self.assertIn('time_seconds_count{kind="%s"} 1' % kind, rendered)
+
+  def test_existing(self):
+    counter = self.registry.counter('name', 'Help.')
+    self.assertIs(self.registry.counter('name', 'Help.'), counter)
+    self.assertRaises(ValueError, self.registry.histogram, 'name', 'Help.')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+import threading
+import time
+import unittest
+
+import monitor.util.test_base
+from monitor.util import profiler
+
+
+def _busy(seconds):
+  end = time.time() + seconds
+  while time.time() < end:
+    pass
+
+
+class TestProfiler(monitor.util.test_base.TestBase):
+
+  def test_deterministic(self):
+    active = profiler.DeterministicProfiler(sort='tottime')
+    active.start()
+    _busy(0.01)
+    active.stop()
+
+    result = active.result()
+    self.assertIn('Ordered by: internal time', result)
+    self.assertRegexpMatches(result, r'test_profiler.py:\d+\(_busy\)')
+
+  def test_deterministic_bad_sort(self):
+    self.assertRaises(ValueError, profiler.DeterministicProfiler, 'bogus')
+
+  def test_sample(self):
+    sampler = profiler.StackSampler()
+    sampler.sample()
+    sampler.sample()
+
+    lines = sampler.result().splitlines()
+    self.assertEqual(len(lines), 1)
+    stack, count = lines[0].rsplit(' ', 1)
+    self.assertEqual(count, '2')
+    self.assertRegexpMatches(
+        stack, r';test_sample \(test_profiler.py:\d+\);'
+        r'sample \(profiler.py:\d+\)$')
+
+  def test_sample_thread(self):
+    sampler = profiler.StackSampler(threading.current_thread().ident,
+                                    interval=0.001)
+    sampler.start()
+    _busy(0.1)
+    sampler.stop()
+
+    busy = [line for line in sampler.result().splitlines()
+            if ';_busy (test_profiler.py:' in line]
+    self.assertTrue(busy)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import unittest
+
+from twisted.internet import task
+
+import monitor.util.test_base
+from monitor.util import timer_wheel
+
+
+class TestTimerWheel(monitor.util.test_base.TestBase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.wheel = timer_wheel.TimerWheel(self.clock)
+    self.calls = []
+
+  def _call_later(self, delay, name):
+    return self.wheel.call_later(
+        delay, lambda: self.calls.append((name, self.clock.seconds())))
+
+  def _advance_to(self, seconds):
+    """Advance the clock to each scheduled call in turn, like a reactor."""
+    while self.clock.getDelayedCalls():
+      self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+      next_call = self.clock.getDelayedCalls()[0].getTime()
+      if next_call > seconds:
+        break
+      self.clock.advance(next_call - self.clock.seconds())
+    self.clock.advance(seconds - self.clock.seconds())
+
+  def test_delays(self):
+    delays = [0, 0.5, 1, 2.5, 63, 64, 65, 100, 4095, 4096, 4097, 300000,
+              (1 << 24) + 5]
+    for delay in delays:
+      self._call_later(delay, delay)
+    self.assertEqual(len(self.wheel), len(delays))
+
+    self._advance_to((1 << 24) + 10)
+
+    # Calls due in the same tick are made in no particular order.
+    self.assertEqual(sorted(name for name, _ in self.calls), delays)
+
+    # Each call is made up to a tick late, never early.
+    for delay, seconds in self.calls:
+      self.assertGreaterEqual(seconds, delay)
+      self.assertLessEqual(seconds, delay + 1)
+
+    # Nothing is left scheduled.
+    self.assertEqual(len(self.wheel), 0)
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+
+  def test_skips_idle_ticks(self):
+    self._call_later(3600, 'hour')
+    wakeups = 0
+    while self.clock.getDelayedCalls():
+      wakeups += 1
+      delayed = self.clock.getDelayedCalls()[0]
+      self.clock.advance(delayed.getTime() - self.clock.seconds())
+
+    self.assertEqual(self.calls, [('hour', 3600)])
+    self.assertLess(wakeups, 10)
+
+  def test_late_reactor(self):
+    """Calls missed while the reactor was busy are all made at once."""
+    for delay in xrange(1, 200, 7):
+      self._call_later(delay, delay)
+
+    self.clock.advance(500)
+    self.assertEqual([name for name, _ in self.calls], range(1, 200, 7))
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+
+  def test_cancel(self):
+    first = self._call_later(5, 'first')
+    self._call_later(10, 'second')
+    first.cancel()
+    first.cancel()
+    self.assertEqual(len(self.wheel), 1)
+
+    self._advance_to(20)
+    self.assertEqual(self.calls, [('second', 10)])
+
+    # Cancelling the last call removes the reactor call.
+    self._call_later(10, 'third').cancel()
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+
+  def test_earlier_call_reschedules(self):
+    self._call_later(1000, 'late')
+    self._call_later(2, 'early')
+    self._advance_to(1001)
+    self.assertEqual(self.calls, [('early', 2), ('late', 1000)])
+
+  def test_reuse_after_idle(self):
+    self._call_later(5, 'first')
+    self._advance_to(10)
+    self.clock.advance(100000)
+
+    self._call_later(5, 'second')
+    self._advance_to(100020)
+    self.assertEqual(self.calls, [('first', 5), ('second', 100015)])
+
+  def test_call_from_call(self):
+    self.wheel.call_later(5, lambda: self._call_later(5, 'nested'))
+    self._advance_to(20)
+    self.assertEqual(self.calls, [('nested', 10)])
+
+  def test_call_raises(self):
+    def fail():
+      raise ValueError()
+
+    self.wheel.call_later(5, fail)
+    self._call_later(5, 'after')
+    self._advance_to(10)
+    self.assertEqual(self.calls, [('after', 5)])
+
+  def test_many(self):
+    for i in xrange(10000):
+      self._call_later(i % 600, i)
+    self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    self._advance_to(600)
+    self.assertEqual(len(self.calls), 10000)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+import time
+import unittest
+
+from twisted.internet import reactor
+from twisted.internet import task
+
+import monitor.util.test_base
+from monitor.util import watchdog
+
+
+class TestReactorWatchdog(monitor.util.test_base.TestBase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.watchdog = watchdog.ReactorWatchdog(threshold=0.5, interval=0.1,
+                                             clock=self.clock)
+    self.watchdog.start(watch=False)
+
+  def tearDown(self):
+    self.watchdog.stop()
+
+  def test_no_stall(self):
+    for _ in xrange(10):
+      self.clock.advance(0.1)
+      self.watchdog.check()
+    self.watchdog.check(self.clock.seconds() + 0.5)
+    self.assertEqual(self.watchdog.stalls(), [])
+
+  def test_stall(self):
+    self.clock.advance(0.1)
+
+    # The reactor (this thread) is stuck in here.
+    self.watchdog.check(self.clock.seconds() + 0.7)
+    self.watchdog.check(self.clock.seconds() + 0.9)
+
+    stalls = self.watchdog.stalls()
+    self.assertEqual(len(stalls), 1)
+    self.assertEqual(stalls[0]['time'], 0.2)
+    self.assertIsNone(stalls[0]['seconds'])
+    self.assertIn('in test_stall', '\n'.join(stalls[0]['stack']))
+
+    # Finally, the next tick.
+    self.clock.advance(1.0)
+    self.assertAlmostEqual(self.watchdog.stalls()[0]['seconds'], 0.9)
+
+    # Later stalls are sampled again.
+    self.watchdog.check(self.clock.seconds() + 0.7)
+    self.assertEqual(len(self.watchdog.stalls()), 2)
+
+  def test_max_stalls(self):
+    self.watchdog.stop()
+    self.watchdog = watchdog.ReactorWatchdog(threshold=0.5, interval=0.1,
+                                             max_stalls=2, clock=self.clock)
+    self.watchdog.start(watch=False)
+    for _ in xrange(3):
+      self.watchdog.check(self.clock.seconds() + 1)
+      self.clock.advance(1)
+    self.assertEqual([s['time'] for s in self.watchdog.stalls()],
+                     [1.1, 2.1])
+
+
+class TestReactorWatchdogThread(monitor.util.test_base.TestBase):
+
+  def test_blocked_reactor(self):
+    dog = watchdog.ReactorWatchdog(threshold=0.1, interval=0.02)
+    dog.start()
+
+    def block_reactor():
+      time.sleep(0.3)
+
+    def blocked(_):
+      dog.stop()
+      stalls = dog.stalls()
+      self.assertEqual(len(stalls), 1)
+      self.assertGreater(stalls[0]['seconds'], 0.1)
+      self.assertIn('in block_reactor', '\n'.join(stalls[0]['stack']))
+
+    d = task.deferLater(reactor, 0.05, block_reactor)
+    d.addCallback(lambda _: task.deferLater(reactor, 0.1, lambda: None))
+    d.addCallback(blocked)
+    return d
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+import struct
+import unittest
+
+from twisted.test import proto_helpers
+from twisted.web.test.test_web import DummyRequest
+
+import monitor.util.test_base
+from monitor.util import web_socket
+
+
+def client_frame(payload, opcode=0x1, final=True, mask='\x01\x02\x03\x04'):
+  """Build a masked frame, as a client would send it."""
+  length = len(payload)
+  if length < 126:
+    header = struct.pack('!BB', opcode | (0x80 if final else 0), 0x80 | length)
+  else:
+    header = struct.pack('!BBH', opcode | (0x80 if final else 0), 0x80 | 126,
+                         length)
+  masked = ''.join(chr(ord(c) ^ ord(mask[i % 4]))
+                   for i, c in enumerate(payload))
+  return header + mask + masked
+
+
+def server_frame(payload, opcode=0x1):
+  return struct.pack('!BB', 0x80 | opcode, len(payload)) + payload
+
+
+class _Recorder(web_socket.WebSocketProtocol):
+
+  def __init__(self):
+    web_socket.WebSocketProtocol.__init__(self)
+    self.messages = []
+
+  def message_received(self, message):
+    self.messages.append(message)
+
+
+class TestWebSocket(monitor.util.test_base.TestBase):
+
+  def setUp(self):
+    self.transport = proto_helpers.StringTransport()
+    self.protocol = _Recorder()
+    self.protocol.makeConnection(self.transport)
+
+  def test_accept_key(self):
+    # The example from RFC 6455.
+    self.assertEqual(web_socket.accept_key('dGhlIHNhbXBsZSBub25jZQ=='),
+                     's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+
+  def test_same_origin(self):
+    def _same_origin(origin, host='monitor:8080'):
+      request = DummyRequest([])
+      request.requestHeaders.setRawHeaders('host', [host])
+      if origin is not None:
+        request.requestHeaders.setRawHeaders('origin', [origin])
+      return web_socket.same_origin(request)
+
+    self.assertTrue(_same_origin(None))
+    self.assertTrue(_same_origin('http://monitor:8080'))
+    self.assertTrue(_same_origin('https://Monitor:8080'))
+    self.assertFalse(_same_origin('http://monitor'))
+    self.assertFalse(_same_origin('http://evil.example'))
+    self.assertFalse(_same_origin('null'))
+
+  def test_messages(self):
+    long_message = u'\u00e9' * 200
+    data = (client_frame('hello') +
+            client_frame(long_message.encode('utf-8')) +
+            client_frame('\x00\xff', opcode=0x2))
+
+    # Frames can arrive split at any point.
+    for i in xrange(0, len(data), 7):
+      self.protocol.dataReceived(data[i:i + 7])
+
+    self.assertEqual(self.protocol.messages,
+                     [u'hello', long_message, '\x00\xff'])
+
+  def test_fragments(self):
+    self.protocol.dataReceived(client_frame('hel', final=False))
+    # Control frames can be sent between fragments.
+    self.protocol.dataReceived(client_frame('ping', opcode=0x9))
+    self.protocol.dataReceived(client_frame('lo', opcode=0x0))
+
+    self.assertEqual(self.protocol.messages, [u'hello'])
+    self.assertEqual(self.transport.value(), server_frame('ping', opcode=0xA))
+
+  def test_send(self):
+    self.protocol.send_message(u'hi')
+    self.protocol.send_message('x' * 300)
+    self.assertEqual(self.transport.value(),
+                     server_frame('hi') +
+                     struct.pack('!BBH', 0x81, 126, 300) + 'x' * 300)
+
+  def test_close(self):
+    self.protocol.dataReceived(client_frame(struct.pack('!H', 1001),
+                                            opcode=0x8))
+    self.assertEqual(self.transport.value(),
+                     server_frame(struct.pack('!H', 1001), opcode=0x8))
+    self.assertTrue(self.transport.disconnecting)
+
+    # Nothing more is sent or received.
+    self.protocol.send_message(u'late')
+    self.protocol.dataReceived(client_frame('late'))
+    self.assertEqual(self.protocol.messages, [])
+
+  def test_unmasked(self):
+    self.protocol.dataReceived(server_frame('hello'))
+    self.assertEqual(self.protocol.messages, [])
+    self.assertEqual(self.transport.value(),
+                     server_frame(struct.pack('!H', 1002), opcode=0x8))
+
+  def test_too_big(self):
+    self.protocol.MAX_MESSAGE_BYTES = 10
+    self.protocol.dataReceived(client_frame('x' * 8, final=False))
+    self.protocol.dataReceived(client_frame('x' * 8, opcode=0x0))
+    self.assertEqual(self.protocol.messages, [])
+    self.assertEqual(self.transport.value(),
+                     server_frame(struct.pack('!H', 1009), opcode=0x8))
+
+
+if __name__ == '__main__':
+  unittest.main()
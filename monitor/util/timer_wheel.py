@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+import logging
+import math
+
+from twisted.internet import reactor
+
+
+class _Timer(object):
+  """A pending call scheduled with TimerWheel.call_later()."""
+
+  def __init__(self, wheel, due, deadline, func, args):
+    self._wheel = wheel
+    self.due = due
+    # When the call was asked for, in clock seconds. It's made at due.
+    self.deadline = deadline
+    self.func = func
+    self.args = args
+    self.bucket = None
+
+  def cancel(self):
+    """Don't make the call. Does nothing if it was already made or cancelled."""
+    if self.bucket is not None:
+      self._wheel._remove(self)  # pylint: disable=protected-access
+
+
+class TimerWheel(object):
+  """Run large numbers of delayed calls, with one reactor call at a time.
+
+  This is a hierarchical timing wheel. Time is counted in ticks of
+  resolution seconds. The lowest level has a bucket for each of the next
+  SLOTS ticks. Each level above has buckets covering SLOTS times as many ticks
+  as the level below. As time passes, buckets from higher levels are
+  redistributed into lower levels, until their timers are due.
+
+  Scheduling and cancelling take constant time, no matter how many calls are
+  pending. There is a single reactor delayed call, for the next tick with
+  calls due (or buckets to redistribute), and none while nothing is pending.
+  Calls are made up to one tick late, never early.
+
+  clock defaults to the reactor, but can be replaced for testing.
+  """
+
+  SLOT_BITS = 6
+  SLOTS = 1 << SLOT_BITS
+  LEVELS = 4
+
+  def __init__(self, clock=None, resolution=1.0):
+    self._clock = clock or reactor
+    self._resolution = resolution
+
+    self._levels = [[set() for _ in xrange(self.SLOTS)]
+                    for _ in xrange(self.LEVELS)]
+    self._count = 0
+
+    # Ticks are counted from _start, and _tick is the last one processed.
+    self._start = self._clock.seconds()
+    self._tick = 0
+    self._delayed_call = None
+    self._delayed_tick = None
+
+  def __len__(self):
+    return self._count
+
+  def seconds(self):
+    """The current time, from the clock used for delays."""
+    return self._clock.seconds()
+
+  def call_later(self, delay, func, *args):
+    """Call func(*args) after delay seconds.
+
+    Returns:
+      A timer, which can be cancelled.
+    """
+    now = self._clock.seconds()
+
+    if not self._count:
+      # With nothing pending, we can skip straight to the current tick.
+      self._tick = max(self._tick,
+                       int((now - self._start) / self._resolution + 1e-9))
+
+    due = int(math.ceil((now + delay - self._start) / self._resolution))
+    timer = _Timer(self, max(due, self._tick + 1), now + delay, func, args)
+    self._add(timer)
+    self._schedule()
+    return timer
+
+  def _add(self, timer):
+    delta = timer.due - self._tick
+    for level in xrange(self.LEVELS):
+      if delta < 1 << (self.SLOT_BITS * (level + 1)):
+        break
+    else:
+      # Too far off to place exactly. Park it in the furthest top level
+      # bucket, to be placed again when that bucket is redistributed.
+      level = self.LEVELS - 1
+      delta = (1 << (self.SLOT_BITS * self.LEVELS)) - 1
+
+    slot = ((self._tick + delta) >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+    timer.bucket = self._levels[level][slot]
+    timer.bucket.add(timer)
+    self._count += 1
+
+  def _remove(self, timer):
+    timer.bucket.remove(timer)
+    timer.bucket = None
+    self._count -= 1
+
+    if not self._count and self._delayed_call:
+      self._delayed_call.cancel()
+      self._delayed_call = None
+
+  def _next_tick(self):
+    """Return the next tick with calls due, or buckets to redistribute."""
+    result = None
+    for level in xrange(self.LEVELS):
+      shift = self.SLOT_BITS * level
+      base = self._tick >> shift
+      buckets = self._levels[level]
+      for offset in xrange(1, self.SLOTS + 1):
+        if buckets[(base + offset) & (self.SLOTS - 1)]:
+          tick = (base + offset) << shift
+          if result is None or tick < result:
+            result = tick
+          break
+    return result
+
+  def _schedule(self):
+    """Make sure the reactor will call us for the next tick needing work."""
+    next_tick = self._next_tick() if self._count else None
+    if self._delayed_call and self._delayed_tick == next_tick:
+      return
+
+    if self._delayed_call:
+      self._delayed_call.cancel()
+      self._delayed_call = None
+
+    if next_tick is not None:
+      delay = self._start + next_tick * self._resolution - self._clock.seconds()
+      self._delayed_call = self._clock.callLater(max(0, delay), self._advance)
+      self._delayed_tick = next_tick
+
+  def _advance(self):
+    """Process every tick that has passed, skipping those with no work."""
+    self._delayed_call = None
+
+    elapsed = (self._clock.seconds() - self._start) / self._resolution
+    target = max(self._delayed_tick, int(elapsed + 1e-9))
+
+    while self._count:
+      next_tick = self._next_tick()
+      if next_tick > target:
+        break
+      self._tick = next_tick
+      self._cascade()
+      self._run(self._levels[0][self._tick & (self.SLOTS - 1)])
+
+    self._tick = max(self._tick, target)
+    self._schedule()
+
+  def _cascade(self):
+    """Redistribute higher level buckets that the current tick has reached."""
+    for level in xrange(1, self.LEVELS):
+      if self._tick & ((1 << (self.SLOT_BITS * level)) - 1):
+        return
+
+      slot = (self._tick >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+      bucket = self._levels[level][slot]
+      self._levels[level][slot] = set()
+      for timer in bucket:
+        self._count -= 1
+        self._add(timer)
+
+  def _run(self, bucket):
+    for timer in list(bucket):
+      # An earlier call may have cancelled this one.
+      if timer.bucket is not bucket:
+        continue
+      self._remove(timer)
+
+      try:
+        timer.func(*timer.args)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Timer call failed: %s', timer.func)
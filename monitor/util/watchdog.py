@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import collections
+import logging
+import sys
+import threading
+import traceback
+
+from twisted.internet import reactor
+from twisted.internet import task
+
+import monitor.util.metrics
+
+_LAG_SECONDS = monitor.util.metrics.histogram(
+    'reactor_lag_seconds', 'How late each reactor watchdog tick ran.')
+_STALLS = monitor.util.metrics.counter(
+    'reactor_stalls_total', 'Times the reactor was blocked past the threshold.')
+
+
+class ReactorWatchdog(object):
+  """Notice when something blocks the reactor thread, and show where.
+
+  The reactor ticks every interval seconds. A separate thread watches the
+  ticks, and if one is more than threshold seconds late, it samples the stack
+  of the reactor thread (which is still inside the blocking call) and logs it.
+  The lag of every tick is also recorded in the reactor_lag_seconds metric.
+
+  The most recent stalls are kept for display on the web, as dictionaries:
+
+    {'time': 1380000000.0, 'seconds': 1.5, 'stack': ['File ...', ...]}
+
+  seconds is how long the reactor was blocked, and is None until it's
+  unblocked.
+
+  A C call which holds the GIL (a big json.loads(), say) can't be sampled
+  until it returns, so its stall may show the code that ran after it, or
+  only be noticed by the late tick.
+  """
+
+  def __init__(self, threshold=0.25, interval=0.05, max_stalls=50,
+               clock=None):
+    self.threshold = threshold
+    self._interval = interval
+    self._clock = clock or reactor
+
+    # Shared with the watching thread.
+    self._lock = threading.Lock()
+    self._stalls = collections.deque(maxlen=max_stalls)
+    self._last_tick = None
+    self._current_stall = None
+
+    self._reactor_thread = None
+    self._ticker = None
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def start(self, watch=True):
+    """Start ticking. Must be called from the reactor thread.
+
+    Args:
+      watch: Start the watching thread. Tests can call check() instead.
+    """
+    self._reactor_thread = threading.current_thread().ident
+    self._last_tick = self._clock.seconds()
+
+    self._ticker = task.LoopingCall(self._tick)
+    self._ticker.clock = self._clock
+    self._ticker.start(self._interval, now=False)
+
+    if watch:
+      self._stopped.clear()
+      self._thread = threading.Thread(target=self._watch,
+                                      name='ReactorWatchdog')
+      self._thread.daemon = True
+      self._thread.start()
+
+  def stop(self):
+    if self._ticker and self._ticker.running:
+      self._ticker.stop()
+    self._stopped.set()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+
+  def stalls(self):
+    """Return the most recent stalls, oldest first."""
+    with self._lock:
+      return [dict(stall) for stall in self._stalls]
+
+  def check(self, now=None):
+    """Sample the reactor thread's stack, if it's blocked.
+
+    Called from the watching thread. Each stall is only sampled once.
+    """
+    if now is None:
+      now = self._clock.seconds()
+
+    with self._lock:
+      if (self._current_stall is not None or
+          now - self._last_tick - self._interval < self.threshold):
+        return
+
+      frame = sys._current_frames().get(  # pylint: disable=protected-access
+          self._reactor_thread)
+      stack = traceback.format_stack(frame) if frame else []
+      self._current_stall = {
+          'time': self._last_tick + self._interval,
+          'seconds': None,
+          'stack': [line.rstrip('\n') for line in stack],
+      }
+      self._stalls.append(self._current_stall)
+
+    logging.warning('Reactor blocked for over %.3fs, in:\n%s',
+                    self.threshold, ''.join(stack))
+
+  def _tick(self):
+    now = self._clock.seconds()
+    lag = max(0, now - self._last_tick - self._interval)
+    _LAG_SECONDS.observe((), lag)
+
+    with self._lock:
+      self._last_tick = now
+      stall, self._current_stall = self._current_stall, None
+      if stall is not None:
+        stall['seconds'] = lag
+
+    if stall is not None:
+      _STALLS.inc()
+      logging.warning('Reactor was blocked for %.3fs.', lag)
+
+  def _watch(self):
+    while not self._stopped.wait(self._interval):
+      try:
+        self.check()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Reactor watchdog check failed.')
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+import base64
+import hashlib
+import logging
+import struct
+import urlparse
+
+from twisted.internet import protocol
+from twisted.protocols import policies
+
+# From RFC 6455, used to prove the server understood the handshake.
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+_CONTINUATION = 0x0
+_TEXT = 0x1
+_BINARY = 0x2
+_CLOSE = 0x8
+_PING = 0x9
+_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
+
+def accept_key(key):
+  """Return the Sec-WebSocket-Accept value for a Sec-WebSocket-Key."""
+  return base64.b64encode(hashlib.sha1(key + _GUID).digest())
+
+
+def same_origin(request):
+  """Check that a WebSocket handshake didn't come from another site's page.
+
+  Browsers don't apply CORS to WebSockets, so any page could otherwise
+  connect. They always send the Origin of the page, which must match the
+  Host the request was sent to. Other clients don't send Origin, and are
+  allowed.
+  """
+  origin = request.getHeader('origin')
+  if origin is None:
+    return True
+
+  host = request.getHeader('host') or ''
+  return bool(host) and urlparse.urlsplit(origin).netloc.lower() == host.lower()
+
+
+def upgrade(request, ws_protocol):
+  """Switch the connection of a web request over to a WebSocket protocol.
+
+  Args:
+    request: twisted.web request asking for a WebSocket connection.
+    ws_protocol: WebSocketProtocol to take over the connection.
+
+  Returns:
+    True if the connection was switched, in which case the request should
+    return server.NOT_DONE_YET, and is never finished. Otherwise the
+    response code is set to 400 (Bad Request).
+  """
+  key = request.getHeader('sec-websocket-key')
+  if ((request.getHeader('upgrade') or '').lower() != 'websocket' or
+      request.getHeader('sec-websocket-version') != '13' or not key):
+    request.setResponseCode(400)
+    return False
+
+  # Answer the handshake directly, since twisted.web would add its own
+  # headers (and expect a body) if the request wrote it.
+  transport = request.channel.transport
+  transport.write('HTTP/1.1 101 Switching Protocols\r\n'
+                  'Upgrade: websocket\r\n'
+                  'Connection: Upgrade\r\n'
+                  'Sec-WebSocket-Accept: %s\r\n\r\n' % accept_key(key))
+
+  # Take the connection away from twisted.web.
+  transport.unregisterProducer()
+  request.channel.transport = None
+  if isinstance(transport, policies.ProtocolWrapper):
+    # TLS connections are wrapped.
+    transport.wrappedProtocol = ws_protocol
+  else:
+    transport.protocol = ws_protocol
+  ws_protocol.makeConnection(transport)
+  return True
+
+
+class WebSocketProtocol(protocol.Protocol):
+  """The server side of a WebSocket connection (RFC 6455).
+
+  Handles framing, fragmented messages, ping and close. Subclasses
+  implement message_received(), and use send_message() and close().
+  """
+
+  MAX_MESSAGE_BYTES = 1024 * 1024
+
+  def __init__(self):
+    self._buffer = ''
+    self._fragments = []
+    self._fragments_opcode = None
+    self._closing = False
+
+  def message_received(self, message):
+    """Called with each complete text (unicode) or binary (str) message."""
+    raise NotImplementedError()
+
+  def send_message(self, message):
+    """Send a text message (unicode, or UTF-8 str)."""
+    if isinstance(message, unicode):
+      message = message.encode('utf-8')
+    self._send_frame(_TEXT, message)
+
+  def close(self, code=CLOSE_NORMAL, reason=''):
+    """Start closing the connection. Nothing more can be sent."""
+    if self._closing:
+      return
+    self._send_frame(_CLOSE, struct.pack('!H', code) + reason)
+    self._closing = True
+    self.transport.loseConnection()
+
+  def dataReceived(self, data):
+    self._buffer += data
+    while not self._closing:
+      frame = self._parse_frame()
+      if frame is None:
+        return
+      self._frame_received(*frame)
+
+  def _send_frame(self, opcode, payload):
+    if self._closing:
+      return
+
+    length = len(payload)
+    if length < 126:
+      header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+      header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+      header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    self.transport.write(header + payload)
+
+  def _parse_frame(self):
+    """Remove the next complete frame from the buffer.
+
+    Returns:
+      (final, opcode, payload), or None if a frame hasn't been fully
+      received, or the connection is being closed because of a bad frame.
+    """
+    buf = self._buffer
+    if len(buf) < 2:
+      return None
+
+    first, second = struct.unpack('!BB', buf[:2])
+    final = bool(first & 0x80)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    offset = 2
+
+    if first & 0x70 or not second & 0x80:
+      # Extensions were not negotiated, and clients must mask every frame.
+      self.close(CLOSE_PROTOCOL_ERROR)
+      return None
+
+    if length == 126:
+      if len(buf) < 4:
+        return None
+      length = struct.unpack('!H', buf[2:4])[0]
+      offset = 4
+    elif length == 127:
+      if len(buf) < 10:
+        return None
+      length = struct.unpack('!Q', buf[2:10])[0]
+      offset = 10
+
+    if length > self.MAX_MESSAGE_BYTES:
+      self.close(CLOSE_TOO_BIG)
+      return None
+
+    if len(buf) < offset + 4 + length:
+      return None
+
+    mask = bytearray(buf[offset:offset + 4])
+    payload = bytearray(buf[offset + 4:offset + 4 + length])
+    for i in xrange(length):
+      payload[i] ^= mask[i & 3]
+
+    self._buffer = buf[offset + 4 + length:]
+    return final, opcode, str(payload)
+
+  def _frame_received(self, final, opcode, payload):
+    if opcode == _PING:
+      self._send_frame(_PONG, payload)
+    elif opcode == _PONG:
+      pass
+    elif opcode == _CLOSE:
+      # Echo the status code, as required.
+      code = CLOSE_NORMAL
+      if len(payload) >= 2:
+        code = struct.unpack('!H', payload[:2])[0]
+      self.close(code)
+    elif opcode in (_TEXT, _BINARY, _CONTINUATION):
+      self._data_received(final, opcode, payload)
+    else:
+      self.close(CLOSE_PROTOCOL_ERROR)
+
+  def _data_received(self, final, opcode, payload):
+    # Continuation frames are only valid inside a fragmented message, and
+    # new messages aren't valid inside one.
+    if (opcode == _CONTINUATION) != (self._fragments_opcode is not None):
+      self.close(CLOSE_PROTOCOL_ERROR)
+      return
+
+    if opcode != _CONTINUATION:
+      self._fragments_opcode = opcode
+    self._fragments.append(payload)
+
+    if sum(len(f) for f in self._fragments) > self.MAX_MESSAGE_BYTES:
+      self.close(CLOSE_TOO_BIG)
+      return
+
+    if not final:
+      return
+
+    message = ''.join(self._fragments)
+    opcode = self._fragments_opcode
+    self._fragments = []
+    self._fragments_opcode = None
+
+    if opcode == _TEXT:
+      try:
+        message = message.decode('utf-8')
+      except UnicodeDecodeError:
+        self.close(CLOSE_INVALID_DATA)
+        return
+
+    try:
+      self.message_received(message)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('WebSocket message failed: %r', message)
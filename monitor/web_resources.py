@@ -1,21 +1,176 @@
 #!/usr/bin/python
 
+import hmac
 import json
 import logging
 import os
+import threading
 import time
 
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.web import server
+from twisted.web.resource import EncodingResourceWrapper
 from twisted.web.resource import Resource
 
+try:
+  import msgpack
+except ImportError:
+  # MessagePack responses are optional.
+  msgpack = None
+
 import monitor.adapter
+import monitor.status
+from monitor.util import profiler
+from monitor.util import web_socket
 
 class UnknownComponent(Exception):
   pass
 
 
+def _not_modified(request, etag):
+  """Set the ETag header, and check it against If-None-Match.
+
+  A strong ETag identifies the exact bytes sent, so if the response will be
+  compressed (see compressed()), the content coding is added to it.
+
+  Returns:
+    True if the client already has this version, in which case the response
+    code is set to 304 (Not Modified), and no body should be sent.
+  """
+  content_encoding = request.responseHeaders.getRawHeaders('content-encoding')
+  if content_encoding:
+    etag = '%s-%s"' % (etag[:-1], ','.join(content_encoding))
+  request.setHeader('etag', etag)
+
+  tags = request.getHeader('if-none-match')
+  if tags:
+    tags = [t.strip() for t in tags.split(',')]
+    if etag in tags or '*' in tags:
+      request.setResponseCode(304)
+      return True
+
+  return False
+
+
+def _json_object(members):
+  """Encode a dictionary the way json.dumps(sort_keys=True, indent=4) does.
+
+  Args:
+    members: Dictionary of key to value, with each value already encoded as
+             JSON for nesting level 1.
+  """
+  return '{\n    %s\n}' % ', \n    '.join(
+      '%s: %s' % (json.dumps(key), members[key]) for key in sorted(members))
+
+
+def _compact_json_object(members):
+  """Like _json_object(), but for values encoded as compact JSON."""
+  return '{%s}' % ','.join(
+      '%s:%s' % (json.dumps(key), members[key]) for key in sorted(members))
+
+
+# Content types which ask for MessagePack.
+_MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def _response_encoding(request):
+  """Decide how to encode a response.
+
+  Clients that Accept MessagePack get it, if it's available. Browsers get
+  indented JSON (for people to read), and everything else gets compact JSON.
+  ?pretty=1 or ?pretty=0 overrides the choice of JSON.
+
+  Returns:
+    'msgpack', 'compact' or 'pretty'.
+  """
+  accept = request.getHeader('accept') or ''
+  if msgpack is not None and any(t in accept for t in _MSGPACK_TYPES):
+    return 'msgpack'
+
+  pretty = request.args.get('pretty', [None])[0]
+  if pretty is not None:
+    return 'compact' if pretty in ('0', 'false') else 'pretty'
+
+  # Every browser claims to be Mozilla.
+  if 'Mozilla' in (request.getHeader('user-agent') or ''):
+    return 'pretty'
+  return 'compact'
+
+
+def _encode_response(encoding, members, status=None, status_url=None):
+  """Encode a response object.
+
+  Args:
+    encoding: Result of _response_encoding().
+    members: Dictionary of values to send.
+    status, status_url: If given, the response includes the value of
+                        status_url as 'status', using cached JSON.
+
+  Returns:
+    (content_type, body)
+  """
+  if encoding == 'msgpack':
+    if status_url is not None:
+      members['status'] = status.get(status_url)
+    content_type = 'application/msgpack'
+    body = msgpack.packb(members, use_bin_type=True)
+  elif encoding == 'compact':
+    encoded = {key: json.dumps(value, sort_keys=True, separators=(',', ':'))
+               for key, value in members.iteritems()}
+    if status_url is not None:
+      encoded['status'] = status.get_json(status_url, compact=True)
+    content_type = 'application/json'
+    body = _compact_json_object(encoded)
+  else:
+    encoded = {key: json.dumps(value, sort_keys=True,
+                               indent=4).replace('\n', '\n    ')
+               for key, value in members.iteritems()}
+    if status_url is not None:
+      # The serialized status is cached, and shared by every client
+      # waiting for this revision.
+      encoded['status'] = status.get_json(status_url, level=1)
+    content_type = 'application/json'
+    body = _json_object(encoded)
+
+  return content_type, body
+
+
+def _write_response(request, content_type, body):
+  """Write an encoded response, and finish the request."""
+  request.setResponseCode(200)
+  request.setHeader('content-type', content_type)
+  request.setHeader('vary', 'Accept, Accept-Encoding, User-Agent')
+  request.write(body)
+  request.finish()
+
+
+def compressed(resource):
+  """Wrap a resource to gzip its responses, for clients that accept it."""
+  gzip = server.GzipEncoderFactory()
+  # The default (9) takes about three times as long, for 1% smaller
+  # responses. See 'python -m monitor.benchmark wire'.
+  gzip.compressLevel = 6
+  return EncodingResourceWrapper(resource, [gzip])
+
+
+def _push_button(status, component_id):
+  """Remember when the button was pushed."""
+  button_search_url = os.path.join('status://*/button', component_id)
+  button_urls = status.get_matching_urls(button_search_url)
+
+  if not button_urls:
+    raise UnknownComponent(component_id)
+
+  now = int(time.time())
+
+  for url in button_urls:
+    # Update when the button was pushed.
+    pushed_url = os.path.join(url, 'pushed')
+    status.set(pushed_url, now)
+
+
 class _ConfigHandler(Resource):
   """Create a handler uses the POST handler for GET requests."""
   isLeaf = True
@@ -46,38 +201,26 @@ class Button(_ConfigHandler):
     return self.render_action(request, component_id)
 
   def render_action(self, request, component_id):
-    # Remember when the button was pushed.
-    button_search_url = os.path.join('status://*/button', component_id)
-    button_urls = self.status.get_matching_urls(button_search_url)
-
-    if not button_urls:
-      raise UnknownComponent(component_id)
-
-    now = int(time.time())
-
-    for url in button_urls:
-      # Update when the button was pushed.
-      pushed_url = os.path.join(url, 'pushed')
-      self.status.set(pushed_url, now)
-
+    _push_button(self.status, component_id)
     request.setResponseCode(200)
     return 'Success'
 
 
 class Log(Resource):
+  """Serve recent log records from a LogBuffer.
+
+  /log returns every record still kept. /log?revision=N returns the records
+  after N, waiting until there is at least one.
+  """
 
-  def __init__(self, log_handler, log_buffer):
+  def __init__(self, log_buffer):
     Resource.__init__(self)
-    self._log_handler = log_handler
     self._log_buffer = log_buffer
 
-  def get_log(self):
-    self._log_handler.flush()
-    log = self._log_buffer.getvalue().split('\n')
-
+  def get_log(self, revision=0):
     return {
-        'revision': len(log),
-        'log': log,
+        'revision': self._log_buffer.revision(),
+        'log': self._log_buffer.records_since(revision),
     }
 
   def render_GET(self, request):
@@ -87,28 +230,40 @@ class Log(Resource):
     logging.info('Request: %s', request.uri)
 
     # args['revision'] -> ['123'] if present at all
-    revision = int(request.args.get('revision', [0])[0])
+    if 'revision' not in request.args:
+      self._send_update(request, 0)
+      return server.NOT_DONE_YET
 
-    if revision == 0:
-      delay = 0
-    else:
-      delay = 10
-
-    # Pretend we have a real deferred to tell us logs were updated.
-    notify = reactor.callLater(delay, self._send_update, request)
+    revision = int(request.args['revision'][0])
 
     # If we get cut off while waiting to respond, it's pretty normal. Don't
-    # error out.
+    # error out. This is hooked up first, since new records may already be
+    # waiting, and the request finished right away.
     finish_deferred = request.notifyFinish()
-    finish_deferred.addErrback(lambda _err: notify.cancel())
+
+    notification = self._log_buffer.deferred(revision)
+    notification.addCallbacks(lambda _: self._send_update(request, revision),
+                              lambda failure: failure.trap(
+                                  defer.CancelledError))
+    finish_deferred.addErrback(lambda _err: notification.cancel())
 
     return server.NOT_DONE_YET
 
-  def _send_update(self, request):
-    request.setResponseCode(200)
-    request.setHeader('content-type', 'application/json')
-    request.write(json.dumps(self.get_log(), sort_keys=True, indent=4))
-    request.finish()
+  def _send_update(self, request, revision):
+    _write_response(request, *_encode_response(_response_encoding(request),
+                                               self.get_log(revision)))
+
+
+class Metrics(Resource):
+  """Serve a metrics Registry, in the Prometheus text format."""
+
+  def __init__(self, registry):
+    Resource.__init__(self)
+    self._registry = registry
+
+  def render_GET(self, request):
+    request.setHeader('content-type', 'text/plain; version=0.0.4')
+    return self._registry.render()
 
 
 class Restart(_ConfigHandler):
@@ -119,6 +274,125 @@ class Restart(_ConfigHandler):
     return 'Success'
 
 
+class Profile(Resource):
+  """Profile the running server for a while, and return the results.
+
+  /profile?seconds=N profiles the reactor thread for N seconds with cProfile,
+  and returns pstats text (sorted by ?sort=, cumulative by default).
+  ?format=collapsed samples its stack instead, which barely slows it down,
+  and returns collapsed stacks for flamegraph.pl.
+
+  Requests must send 'Authorization: Bearer <token>'. Without a token,
+  profiling is disabled. Only one profile runs at a time.
+  """
+  isLeaf = True
+
+  DEFAULT_SECONDS = 10
+  MAX_SECONDS = 300
+
+  def __init__(self, token, clock=None):
+    Resource.__init__(self)
+    self._token = token
+    self._clock = clock or reactor
+    self._running = False
+
+  def render_GET(self, request):
+    return self.render_POST(request)
+
+  def render_POST(self, request):
+    if not self._token:
+      request.setResponseCode(403)
+      return 'Profiling is disabled.'
+
+    authorization = request.getHeader('authorization') or ''
+    if not hmac.compare_digest(authorization, 'Bearer %s' % self._token):
+      request.setResponseCode(401)
+      request.setHeader('www-authenticate', 'Bearer')
+      return 'Unauthorized.'
+
+    try:
+      seconds = float(request.args.get('seconds',
+                                       [self.DEFAULT_SECONDS])[0])
+      if not 0 < seconds <= self.MAX_SECONDS:
+        raise ValueError(seconds)
+
+      result_format = request.args.get('format', ['pstats'])[0]
+      if result_format == 'collapsed':
+        active = profiler.StackSampler(threading.current_thread().ident)
+      elif result_format == 'pstats':
+        active = profiler.DeterministicProfiler(
+            request.args.get('sort', ['cumulative'])[0])
+      else:
+        raise ValueError(result_format)
+    except ValueError as e:
+      request.setResponseCode(400)
+      return 'Bad request: %s' % e
+
+    if self._running:
+      request.setResponseCode(409)
+      return 'Already profiling.'
+
+    logging.info('Profiling for %ss: %s', seconds, result_format)
+    self._running = True
+    active.start()
+
+    def finish():
+      active.stop()
+      self._running = False
+      request.setHeader('content-type', 'text/plain')
+      request.write(active.result())
+      request.finish()
+
+    delayed = self._clock.callLater(seconds, finish)
+
+    # If the client gives up, stop profiling.
+    def disconnected(_err):
+      delayed.cancel()
+      active.stop()
+      self._running = False
+    request.notifyFinish().addErrback(disconnected)
+
+    return server.NOT_DONE_YET
+
+
+class Watchdog(Resource):
+  """Serve the recent stalls seen by a ReactorWatchdog.
+
+  /watchdog returns the threshold, and a list of the most recent times the
+  reactor was blocked for longer, with the stack it was blocked in.
+  """
+
+  def __init__(self, watchdog):
+    Resource.__init__(self)
+    self._watchdog = watchdog
+
+  def render_GET(self, request):
+    _write_response(request, *_encode_response(
+        _response_encoding(request),
+        {'threshold': self._watchdog.threshold,
+         'stalls': self._watchdog.stalls()}))
+    return server.NOT_DONE_YET
+
+
+class _Waiters(object):
+  """Requests waiting for the same status url to change from a revision."""
+
+  def __init__(self, notification):
+    # {request: arguments}, see Status._request_args().
+    self.requests = {}
+    self.notification = notification
+
+
+def _once(function):
+  """Wrap a function of no arguments, so it's only run once."""
+  result = []
+  def wrapper():
+    if not result:
+      result.append(function())
+    return result[0]
+  return wrapper
+
+
 class Status(Resource):
 
   isLeaf = True
@@ -127,52 +401,200 @@ class Status(Resource):
     Resource.__init__(self)
     self.status = status
 
+    # Long polls waiting on the same url and revision share a single status
+    # notification, as {(url, revision): _Waiters}.
+    self._waiters = {}
+
   def render_GET(self, request):
     logging.info('GET Request: %s', request.uri)
 
     # args['revision'] -> ['123'] if present at all
     revision = int(request.args.get('revision', [0])[0])
     status_url = os.path.join('status://', *request.postpath)
+    key = (status_url, revision)
+    request_args = self._request_args(request)
 
-    def _send_update(value):
-      response_value = {
-          'revision': self.status.revision(status_url),
-          'status': self.status.get(status_url),
-          'url': os.path.join(str(request.URLPath()), *request.postpath)
-      }
+    waiters = self._waiters.get(key)
+    new_waiters = waiters is None
+    if new_waiters:
+      # Setup a deferred to notify us if the status we are watching is
+      # updated. This raises UnknownUrl if the url doesn't exist, so it's
+      # done before anything is registered.
+      waiters = _Waiters(self.status.deferred(revision, status_url))
+      self._waiters[key] = waiters
 
-      request.setResponseCode(200)
-      request.setHeader('content-type', 'application/json')
-      request.write(json.dumps(response_value, sort_keys=True, indent=4))
-      request.finish()
-      return value
+    waiters.requests[request] = request_args
 
-    def cancel_ok(failure):
-      failure.trap(defer.CancelledError)
+    # If the connection closes, stop waiting for it.
+    request.notifyFinish().addErrback(
+        lambda _err: self._disconnected(key, waiters, request))
 
-    # Setup deferreds to notify us if the connection is closed, or if the
-    # status we are watching is updated.
-    finish_deferred = request.notifyFinish()
-    notification = self.status.deferred(revision, status_url)
+    if new_waiters:
+      # This fires right away if revision is out of date.
+      waiters.notification.addCallbacks(
+          lambda _urls: self._send_updates(key, waiters), self._cancel_ok)
 
-    # If the connection closes, cancel the status notification.
-    finish_deferred.addErrback(lambda _err: notification.cancel())
+    return server.NOT_DONE_YET
 
-    # If we get a status notification, tell our web client, and accept cancels.
-    notification.addCallbacks(_send_update, cancel_ok)
+  def _request_args(self, request):
+    """Return (encoding, format, depth, offset, limit, url) for a request.
+
+    Requests with the same arguments get the same response.
+    """
+    # format=changes asks for only the changes since revision, and
+    # format=patch for a JSON Patch from revision, if they are still known.
+    response_format = request.args.get('format', [None])[0]
+
+    # depth limits how deep the returned status is, and offset/limit select a
+    # range of its children.
+    depth, offset, limit = [
+        int(request.args[arg][0]) if arg in request.args else None
+        for arg in ('depth', 'offset', 'limit')]
+
+    # The same as str(request.URLPath()), without parsing it again.
+    url = os.path.join(request.prePathURL(), *request.postpath)
+    return (_response_encoding(request), response_format, depth, offset,
+            limit, url)
+
+  @staticmethod
+  def _cancel_ok(failure):
+    failure.trap(defer.CancelledError)
+
+  def _disconnected(self, key, waiters, request):
+    waiters.requests.pop(request, None)
+    if not waiters.requests and self._waiters.get(key) is waiters:
+      del self._waiters[key]
+      waiters.notification.cancel()
+
+  def _send_updates(self, key, waiters):
+    """Answer every request waiting on a status change.
+
+    Each distinct response is encoded once, and written to every request
+    that asked for it. Nothing is encoded for requests which already have
+    the current version.
+    """
+    if self._waiters.get(key) is waiters:
+      del self._waiters[key]
+
+    status_url, revision = key
+    responses = {}
+    for request, args in waiters.requests.items():
+      try:
+        response = responses.get(args)
+        if response is None:
+          response = self._prepare_update(status_url, revision, *args)
+          responses[args] = response
+
+        etag, encode = response
+        if etag and _not_modified(request, etag):
+          request.finish()
+        else:
+          _write_response(request, *encode())
+      except monitor.status.UnknownUrl:
+        # The url was removed while we waited.
+        request.setResponseCode(404)
+        request.finish()
+      except Exception:  # pylint: disable=broad-except
+        # Don't let one failed request keep the others waiting. Answer this
+        # one too, unless it failed after that.
+        logging.exception('Long poll failed: %s', request.uri)
+        if not request.finished:
+          request.setResponseCode(500)
+          request.finish()
+
+  def _prepare_update(self, status_url, revision, encoding, response_format,
+                      depth, offset, limit, url):
+    """Prepare the response to a long poll which has completed.
+
+    Only the ETag is found up front, so a request which already has this
+    version can be answered without serializing anything.
+
+    Returns:
+      (etag, encode) where encode() returns (content_type, body), and only
+      does the work once. etag is None if the response shouldn't have one.
+    """
+    current_revision = self.status.revision(status_url)
+    response_members = {
+        'revision': current_revision,
+        'url': url,
+    }
 
-    return server.NOT_DONE_YET
+    changes = None
+    patch = None
+    if response_format == 'changes':
+      changes = self.status.changes_since(revision, status_url)
+    elif response_format == 'patch':
+      patch = self.status.patch_since(revision, status_url)
+
+    if changes is not None:
+      response_members['changes'] = [
+          {'revision': r, 'url': u, 'value': v} for r, u, v in changes]
+      return None, _once(lambda: _encode_response(encoding, response_members))
+
+    if patch is not None:
+      response_members['patch'] = patch
+      return None, _once(lambda: _encode_response(encoding, response_members))
+
+    # The revision of a url changes whenever its content does. Each encoding
+    # is a different representation.
+    etag = '"%d-%s"' % (current_revision, encoding)
+
+    if depth is None and offset is None and limit is None:
+      return etag, _once(lambda: _encode_response(
+          encoding, response_members, self.status, status_url))
+
+    def encode():
+      status_value, total = self._get_page(status_url, depth, offset, limit)
+      response_members['status'] = status_value
+      if total is not None:
+        response_members['total'] = total
+      return _encode_response(encoding, response_members)
+
+    return etag, _once(encode)
+
+  def _get_page(self, status_url, depth, offset, limit):
+    """Read status_url, limited by depth and optionally paged.
+
+    If offset or limit are given, only that range of children (sorted by
+    key) is included.
+
+    Returns:
+      (value, total) where total is the number of children of status_url if
+      the value was paged, or None.
+    """
+    if offset is None and limit is None:
+      return self.status.get(status_url, depth=depth), None
+
+    children = self.status.get(status_url, depth=0)
+    if not isinstance(children, dict):
+      return children, None
+
+    start = offset or 0
+    end = start + limit if limit is not None else None
+    keys = sorted(children)[start:end]
+
+    if depth is not None and depth <= 0:
+      value = {key: children[key] for key in keys}
+    else:
+      child_depth = depth - 1 if depth is not None else None
+      value = {key: self.status.get(os.path.join(status_url, key),
+                                    depth=child_depth)
+               for key in keys}
+    return value, len(children)
 
   def render_PUT(self, request):
     logging.info('PUT Request: %s', request.uri)
 
     status_url = os.path.join('status://', *request.postpath)
 
-    assert monitor.adapter.WebAdapter.web_updatable(status_url)
-
     logging.info('PUT args: %s', request.args)
     logging.info('PUT content: %s', request.content.getvalue())
 
+    if request.args.get('format', [None])[0] == 'batch':
+      return self._put_batch(request, status_url)
+
+    assert monitor.adapter.WebAdapter.web_updatable(status_url)
+
     # Revision None means don't verify the revision.
     revision = None
     if 'revision' in request.args:
@@ -181,12 +603,355 @@ class Status(Resource):
     value_str = request.content.getvalue()
     value_parsed = json.loads(value_str)
 
-    # Do the actual PUT.
+    # Do the actual PUT. set() checks the ttl before changing anything.
     try:
-      self.status.set(status_url, value_parsed, revision=revision)
+      # ttl None means the value never expires.
+      ttl = None
+      if 'ttl' in request.args:
+        ttl = float(request.args['ttl'][0])
+
+      self.status.set(status_url, value_parsed, revision=revision, ttl=ttl)
     except monitor.status.RevisionMismatch:
       request.setResponseCode(412) # Precondition Failure
       return 'Revision mismatch.'
+    except ValueError as e:
+      request.setResponseCode(400)
+      return 'Bad request: %s' % e
 
     request.setResponseCode(200)
     return 'Success'
+
+  def _put_batch(self, request, status_url):
+    """Write several values at once, only if none of them changed.
+
+    The content is {"<url>": {"revision": X, "value": V}, ...} with urls
+    relative to status_url. A missing revision isn't checked.
+    """
+    updates = {}
+    for relative_url, update in json.loads(request.content.getvalue()).items():
+      url = status_url
+      if relative_url:
+        url = os.path.join(status_url, relative_url)
+      assert monitor.adapter.WebAdapter.web_updatable(url)
+      updates[url] = (update.get('revision'), update['value'])
+
+    try:
+      self.status.compare_and_set(updates)
+    except monitor.status.RevisionMismatch:
+      request.setResponseCode(412) # Precondition Failure
+      return 'Revision mismatch.'
+
+    request.setResponseCode(200)
+    return 'Success'
+
+
+def _sse_event(event, revision, data):
+  """Format an event for a text/event-stream.
+
+  Args:
+    event: Name of the event.
+    revision: Used as the event id, which the browser sends back as
+              Last-Event-ID if it reconnects.
+    data: Value to send as compact (single line) JSON.
+  """
+  return 'event: %s\nid: %d\ndata: %s\n\n' % (
+      event, revision, json.dumps(data, sort_keys=True, separators=(',', ':')))
+
+
+class _EventStream(object):
+  """Every client streaming events for one status url.
+
+  A single status deferred watches the url for all of them, and each event
+  is formatted once, then written to every client.
+  """
+
+  def __init__(self, status, status_url):
+    self.status = status
+    self.status_url = status_url
+    self.requests = set()
+
+    # The revision of status_url as of the last event sent.
+    self.revision = status.revision(status_url)
+    self._notification = None
+    self._watch()
+
+  def catch_up(self, last_revision):
+    """Return the events a client that saw last_revision has missed.
+
+    Args:
+      last_revision: Revision from the client's Last-Event-ID, or None for a
+                     new client.
+    """
+    # We may be part way through notifying about a change.
+    self._send_pending()
+
+    if last_revision == self.revision:
+      return ''
+    return self._events_since(last_revision)
+
+  def close(self):
+    self._notification.cancel()
+
+  def _watch(self):
+    self._notification = self.status.deferred(self.revision, self.status_url)
+    self._notification.addCallbacks(self._changed, self._cancelled)
+
+  def _cancelled(self, failure):
+    failure.trap(defer.CancelledError)
+
+  def _changed(self, _urls):
+    try:
+      self._send_pending()
+    except monitor.status.UnknownUrl:
+      # The url was removed, perhaps by replacing a parent. There is nothing
+      # left to watch, so tell the clients, and end their streams.
+      self._send_removed()
+      return
+    except Exception:  # pylint: disable=broad-except
+      # Keep watching, or the clients would silently stop getting events.
+      logging.exception('Failed to send events for %s', self.status_url)
+    self._watch()
+
+  def _send_removed(self):
+    event = _sse_event('removed', self.status.revision(), None)
+    # Finishing a request removes it from self.requests.
+    for request in list(self.requests):
+      request.write(event)
+      request.finish()
+
+  def _send_pending(self):
+    if self.status.revision(self.status_url) == self.revision:
+      return
+
+    events = self._events_since(self.revision)
+    self.revision = self.status.revision(self.status_url)
+    for request in self.requests:
+      request.write(events)
+
+  def _events_since(self, revision):
+    """Describe the changes after revision as a single 'changes' event per
+    revision. If they aren't known, send a 'status' event with everything.
+    """
+    changes = None
+    if revision is not None:
+      changes = self.status.changes_since(revision, self.status_url)
+
+    if changes is None:
+      return _sse_event('status', self.status.revision(self.status_url),
+                        self.status.get(self.status_url))
+
+    events = []
+    for change in changes:
+      if not events or events[-1][0] != change[0]:
+        events.append((change[0], []))
+      events[-1][1].append(
+          {'revision': change[0], 'url': change[1], 'value': change[2]})
+
+    return ''.join(_sse_event('changes', r, c) for r, c in events)
+
+
+class Events(Resource):
+  """Stream status changes as Server-Sent Events.
+
+  GET /events/<status path> holds the connection open. The client first
+  receives a 'status' event with the full value, then a 'changes' event for
+  each revision that touches the path. Reconnecting with Last-Event-ID
+  resumes from that revision, if its changes are still known. If the path is
+  removed, a 'removed' event is sent, and the stream ends.
+  """
+
+  isLeaf = True
+
+  KEEPALIVE_SECONDS = 30
+
+  def __init__(self, status, clock=None):
+    Resource.__init__(self)
+    self.status = status
+    self._clock = clock or reactor
+    self._streams = {}
+    self._keepalive = None
+
+  def render_GET(self, request):
+    logging.info('Events Request: %s', request.uri)
+
+    status_url = os.path.join('status://', *request.postpath)
+
+    # The browser sends the id of the last event it saw when it reconnects.
+    last_revision = request.getHeader('last-event-id')
+    if last_revision is None:
+      last_revision = request.args.get('revision', [None])[0]
+    if last_revision is not None:
+      last_revision = int(last_revision)
+
+    stream = self._streams.get(status_url)
+    if stream is None:
+      try:
+        stream = _EventStream(self.status, status_url)
+      except monitor.status.UnknownUrl:
+        request.setResponseCode(404)
+        return 'Unknown url.'
+      self._streams[status_url] = stream
+
+    request.setResponseCode(200)
+    request.setHeader('content-type', 'text/event-stream')
+    request.setHeader('cache-control', 'no-cache')
+    request.write(stream.catch_up(last_revision))
+    stream.requests.add(request)
+
+    if self._keepalive is None:
+      self._keepalive = task.LoopingCall(self._send_keepalive)
+      self._keepalive.clock = self._clock
+      self._keepalive.start(self.KEEPALIVE_SECONDS, now=False)
+
+    # Closing the connection is the only way a stream ends.
+    request.notifyFinish().addBoth(
+        lambda _: self._disconnected(stream, request))
+
+    return server.NOT_DONE_YET
+
+  def _disconnected(self, stream, request):
+    stream.requests.discard(request)
+    if not stream.requests:
+      stream.close()
+      del self._streams[stream.status_url]
+
+    if not self._streams and self._keepalive:
+      self._keepalive.stop()
+      self._keepalive = None
+
+  def _send_keepalive(self):
+    """Send a comment, so idle connections aren't dropped by proxies."""
+    for stream in self._streams.values():
+      for request in stream.requests:
+        request.write(':\n\n')
+
+
+class _StatusSocket(web_socket.WebSocketProtocol):
+  """One WebSocket connection, carrying any number of requests.
+
+  Each message is a JSON object with an "op", and an "id" which is returned
+  with the reply: {"id": <id>, "result": "Success"} or
+  {"id": <id>, "error": "<message>"}. The ops are:
+
+    {"op": "subscribe", "url": <url, wildcards allowed>}
+    {"op": "unsubscribe", "subscription": <id of the subscribe>}
+    {"op": "set", "url": <url>, "value": <value>, "revision": <optional>,
+     "ttl": <optional>}
+    {"op": "compare_and_set", "updates": {<url>: {"revision": <optional>,
+                                                 "value": <value>}}}
+    {"op": "button", "button": <component id>}
+
+  Subscriptions immediately, and after every change, send
+  {"subscription": <id>, "revision": <revision>, "values": {<url>: <value>}}
+  with every url matching the subscription.
+  """
+
+  def __init__(self, status):
+    web_socket.WebSocketProtocol.__init__(self)
+    self.status = status
+    self._subscriptions = {}
+
+  def connectionLost(self, reason=None):
+    for notification in self._subscriptions.values():
+      notification.cancel()
+    self._subscriptions.clear()
+
+  def message_received(self, message):
+    try:
+      request = json.loads(message)
+      request_id = request.get('id')
+    except (ValueError, AttributeError):
+      self._send({'id': None, 'error': 'Invalid request.'})
+      return
+
+    handler = getattr(self, '_op_%s' % request.get('op'), None)
+    if handler is None:
+      self._send({'id': request_id, 'error': 'Unknown op.'})
+      return
+
+    try:
+      handler(request_id, request)
+    except monitor.status.RevisionMismatch:
+      self._send({'id': request_id, 'error': 'Revision mismatch.'})
+    except (KeyError, TypeError, ValueError, AssertionError, UnknownComponent,
+            monitor.status.BadUrl, monitor.status.UnknownUrl):
+      logging.exception('WebSocket request failed: %s', message)
+      self._send({'id': request_id, 'error': 'Invalid request.'})
+    else:
+      self._send({'id': request_id, 'result': 'Success'})
+
+  def _send(self, message):
+    self.send_message(json.dumps(message, sort_keys=True,
+                                 separators=(',', ':')))
+
+  def _op_subscribe(self, request_id, request):
+    url = request['url']
+    self.status.get_matching_urls(url)  # Validate the url.
+    assert request_id not in self._subscriptions
+
+    # Send the current values, and watch for changes.
+    self._subscriptions[request_id] = None
+    self._subscription_update(request_id, url)
+
+  def _op_unsubscribe(self, _request_id, request):
+    notification = self._subscriptions.pop(request['subscription'])
+    if notification:
+      notification.cancel()
+
+  def _subscription_update(self, request_id, url):
+    if request_id not in self._subscriptions:
+      return
+
+    self._send({
+        'subscription': request_id,
+        'revision': self.status.revision(),
+        'values': {u: self.status.get(u)
+                   for u in self.status.get_matching_urls(url)},
+    })
+
+    notification = self.status.deferred(url=url)
+    notification.addCallbacks(
+        lambda _urls: self._subscription_update(request_id, url),
+        lambda failure: failure.trap(defer.CancelledError))
+    self._subscriptions[request_id] = notification
+
+  def _op_set(self, _request_id, request):
+    url = request['url']
+    assert monitor.adapter.WebAdapter.web_updatable(url)
+    self.status.set(url, request['value'], revision=request.get('revision'),
+                    ttl=request.get('ttl'))
+
+  def _op_compare_and_set(self, _request_id, request):
+    updates = {}
+    for url, update in request['updates'].items():
+      assert monitor.adapter.WebAdapter.web_updatable(url)
+      updates[url] = (update.get('revision'), update['value'])
+    self.status.compare_and_set(updates)
+
+  def _op_button(self, _request_id, request):
+    _push_button(self.status, request['button'])
+
+
+class Socket(Resource):
+  """Accept WebSocket connections for reading and writing status.
+
+  Browsers may only connect from pages served by this server. See
+  _StatusSocket for the messages.
+  """
+
+  isLeaf = True
+
+  def __init__(self, status):
+    Resource.__init__(self)
+    self.status = status
+
+  def render_GET(self, request):
+    logging.info('Socket Request: %s', request.uri)
+
+    if not web_socket.same_origin(request):
+      request.setResponseCode(403)
+      return 'Cross origin WebSocket refused.'
+
+    if not web_socket.upgrade(request, _StatusSocket(self.status)):
+      return 'WebSocket upgrade required.'
+    return server.NOT_DONE_YET